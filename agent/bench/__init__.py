@@ -0,0 +1 @@
+"""Benchmarks for lpp_agent; run with `python -m bench` from agent/."""
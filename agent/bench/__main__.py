@@ -0,0 +1,117 @@
+"""
+Micro-benchmarks of the agent's hot paths.
+
+    cd agent
+    python -m bench                     # run every case, compare with bench/baseline.json
+    python -m bench -k file_edit        # only cases whose name contains "file_edit"
+    python -m bench --update-baseline   # store the current numbers as the baseline
+
+Each case runs in a fresh interpreter with LPP_{CONF,STATE,LOG}_DIR under a
+temp dir and bench/bin first on PATH (stub apt-get, dpkg-query, systemctl,
+sysctl and sudo), so nothing on the host is touched. Reported per iteration:
+wall time (median), forks, bytes on the wire to the stand-in server, plus the
+peak RSS of the run. Any metric worse than the baseline beyond its tolerance
+is a regression and the exit status is 1. Baselines are machine-specific;
+refresh them on the machine that compares against them.
+"""
+from __future__ import annotations
+import argparse, json, os, resource, statistics, subprocess, sys, tempfile, time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+BASELINE = HERE/"baseline.json"
+
+# allowed growth over the baseline: relative, plus an absolute floor for noisy metrics
+TOLERANCE = {"wall_ms": (0.5, 2.0), "forks": (0.0, 0), "peak_rss_kb": (0.25, 2048), "wire_bytes": (0.1, 0)}
+
+FORK_EVENTS = ("subprocess.Popen", "os.fork", "os.forkpty", "os.posix_spawn", "os.spawn")
+
+def _measure(name: str, iterations: int) -> dict[str, float]:
+    from bench.cases import CASES
+    tmp = Path(os.environ["LPP_STATE_DIR"]).parent
+    once, srv = CASES[name](tmp)
+    once()  # warm-up: first apply, caches, imports
+    forks = [0]
+
+    def audit(event: str, args) -> None:
+        if event in FORK_EVENTS:
+            forks[0] += 1
+    sys.addaudithook(audit)
+    wire0 = _wire(srv)
+    times = []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        once()
+        times.append(time.perf_counter() - t)
+    out = {
+        "wall_ms": round(statistics.median(times) * 1000, 2),
+        "forks": round(forks[0] / iterations, 1),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "wire_bytes": round((_wire(srv) - wire0) / iterations),
+    }
+    if srv:
+        srv.stop()
+    return out
+
+def _wire(srv) -> int:
+    if srv is None:
+        return 0
+    st = srv.stats.snapshot()
+    return st["bytes_in"] + st["bytes_out"]
+
+def _run_case(name: str, iterations: int) -> dict[str, float]:
+    with tempfile.TemporaryDirectory(prefix=f"lpp-bench-{name}-") as tmp:
+        env = {**os.environ,
+               "PATH": f"{HERE/'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+               "PYTHONPATH": os.pathsep.join(filter(None, [str(HERE.parent), os.environ.get("PYTHONPATH")]))}
+        for d in ("CONF", "STATE", "LOG"):
+            env[f"LPP_{d}_DIR"] = str(Path(tmp)/d.lower())
+        cp = subprocess.run([sys.executable, "-m", "bench", "--child", name, "-n", str(iterations)],
+                            cwd=HERE.parent, env=env, capture_output=True, text=True)
+        if cp.returncode != 0:
+            raise SystemExit(f"case {name} failed:\n{cp.stderr}")
+        return json.loads(cp.stdout.strip().splitlines()[-1])
+
+def _compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]]) -> list[str]:
+    bad = []
+    print(f"{'case':<20} {'metric':<12} {'value':>12} {'baseline':>12} {'change':>8}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            change, flag = "", ""
+            if base is not None:
+                rel, floor = TOLERANCE[metric]
+                change = f"{(value - base) / base:+.0%}" if base else ""
+                if value > base * (1 + rel) + floor:
+                    flag = "  REGRESSION"
+                    bad.append(f"{name}.{metric}: {value} vs baseline {base}")
+            print(f"{name:<20} {metric:<12} {value:>12} {'' if base is None else base:>12} {change:>8}{flag}")
+    return bad
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench")
+    ap.add_argument("-k", dest="select", help="only cases whose name contains this")
+    ap.add_argument("-n", dest="iterations", type=int, default=20, help="timed iterations per case")
+    ap.add_argument("--update-baseline", action="store_true")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(_measure(args.child, args.iterations)))
+        return 0
+
+    from bench.cases import CASES
+    names = [n for n in CASES if not args.select or args.select in n]
+    results = {n: _run_case(n, args.iterations) for n in names}
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    if args.update_baseline:
+        BASELINE.write_text(json.dumps({**baseline, **results}, indent=2, sort_keys=True) + "\n")
+        print(f"baseline updated: {', '.join(names)}")
+        return 0
+    bad = _compare(results, baseline)
+    for line in bad:
+        print(f"REGRESSION: {line}", file=sys.stderr)
+    return 1 if bad else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,98 @@
+"""
+Benchmark cases. Each case prepares a fake host under `tmp` and returns
+(one_iteration, stand_in_or_None); the harness times the iterations.
+"""
+from __future__ import annotations
+import json, os
+from pathlib import Path
+from typing import Any, Callable
+
+from lpp_agent import exec as lpp_exec, fingerprint, plan
+from lpp_agent.facts import facts
+from lpp_agent.plugins import file_edit, pkg, sysctl
+from lpp_agent.standin import StandIn
+
+PACKAGES = [f"benchpkg{n}" for n in range(20)]
+SERVICES = [f"bench{n}" for n in range(5)]
+SYSCTLS = [f"net.bench.key{n}" for n in range(5)]
+LARGE_FILE_LINES = 100_000
+
+def _host(tmp: Path) -> Path:
+    """Stub package database, /proc/sys and /etc under tmp; facts pinned to a systemd apt host."""
+    status = tmp/"dpkg-status"
+    # half the packages are already there
+    status.write_text("".join(f"Package: {p}\nStatus: install ok installed\n\n" for p in PACKAGES[::2]))
+    os.environ["BENCH_DPKG_STATUS"] = str(status)
+    pkg.DB["apt-get"] = str(status)
+    fingerprint.PKG_DB["apt-get"] = (str(status),)
+    sysctl.PROC = tmp/"proc"
+    sysctl.DROPIN = tmp/"sysctl.d"/"99-lpp.conf"
+    for key in SYSCTLS:
+        p = sysctl.PROC/key.replace(".", "/")
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text("0\n")
+    plan.cache = plan.PlanCache(tmp/"plans")
+    facts.pin("init", "systemd")
+    facts.pin("pkg_manager", "apt-get")
+    etc = tmp/"etc"
+    etc.mkdir(exist_ok=True)
+    (etc/"sshd_config").write_text("".join(f"Option{n} value{n}\n" for n in range(200)))
+    return etc
+
+def _policy_yaml(etc: Path, tag: str = "") -> str:
+    rules: list[dict[str, Any]] = [{"id": f"pkg-{p}", "type": "pkg.ensure", "name": p} for p in PACKAGES]
+    rules += [{"id": f"svc-{s}", "type": "service.manage", "service": s, "state": "started"} for s in SERVICES]
+    rules += [{"id": f"sysctl-{n}", "type": "sysctl.set", "param": k, "value": 1} for n, k in enumerate(SYSCTLS)]
+    rules += [
+        {"id": "sshd", "type": "file.kv_set", "file": str(etc/"sshd_config"),
+         "values": {f"Option{n}": f"bench{n}" for n in range(0, 200, 10)}, "notify": "systemctl restart bench0"},
+        {"id": "motd", "type": "file.ensure_lines", "file": str(etc/"motd"), "present": ["managed by lpp"]},
+        {"id": "hook", "type": "bash", "code": "true"},
+    ]
+    # the YAML loader reads JSON; `tag` changes the content hash without changing what is applied
+    return json.dumps({"policy": {"id": "bench", "tag": tag}, "rules": rules}, indent=1)
+
+def apply_policy_yaml(tmp: Path):
+    text = _policy_yaml(_host(tmp))
+    return lambda: lpp_exec.apply_policy_yaml(text, max_workers=4), None
+
+def file_edit_large(tmp: Path):
+    big = tmp/"large.conf"
+    big.write_text("".join(f"key{n} value{n}\n" for n in range(LARGE_FILE_LINES)))
+    present = [f"key{n} value{n}" for n in range(0, LARGE_FILE_LINES, 100)]
+    n = [0]
+
+    def once():
+        n[0] += 1  # a new value every time, so every iteration writes the file
+        file_edit.replace_kv(str(big), f"key{LARGE_FILE_LINES - 1}", f"v{n[0]}")
+        file_edit.ensure_lines(str(big), present)
+    return once, None
+
+def runner_apply(tmp: Path):
+    from lpp_agent.runner import Runner
+    _host(tmp)
+    policies = [{"id": f"pol-{n}", "packageName": " ".join(PACKAGES[n::5]), "bash": "true"} for n in range(5)]
+    r = Runner("http://127.0.0.1:9", "bench")
+    return lambda: r._apply_policies({"policies": policies}), None
+
+def run_once(tmp: Path):
+    from lpp_agent.config import DEFAULTS
+    from lpp_agent.main import run_once as cycle
+    etc = _host(tmp)
+    srv = StandIn([{"id": "bench", "yaml": _policy_yaml(etc)}]).start()
+    cfg = {**DEFAULTS, "api": srv.url, "agent_id": "1", "drift_scan_sec": 0}
+    n = [0]
+
+    def once():
+        # a new rev whose content hash changed: fetch, apply (mostly fingerprint hits), send, heartbeat
+        n[0] += 1
+        srv.bump([{"id": "bench", "yaml": _policy_yaml(etc, tag=str(n[0]))}])
+        cycle(cfg)
+    return once, srv
+
+CASES: dict[str, Callable[[Path], Any]] = {
+    "apply_policy_yaml": apply_policy_yaml,
+    "file_edit_large": file_edit_large,
+    "runner_apply": runner_apply,
+    "run_once": run_once,
+}
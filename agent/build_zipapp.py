@@ -0,0 +1,77 @@
+"""
+Build the agent as one executable file: lpp_agent plus its dependencies,
+runnable with nothing but a Python interpreter.
+
+    cd agent
+    python3 build_zipapp.py                  # -> dist/lpp-agent.pyz
+    sudo install -m 0755 dist/lpp-agent.pyz /usr/local/bin/lpp-agent
+
+Tuned for cold start (`lpp-agent once` from a timer):
+  - bytecode is compiled into the archive next to each module (unchecked
+    hash pycs), so nothing is compiled at import time; a zipimport can't
+    write a cache. Build with the interpreter the hosts run: another
+    Python version ignores the bytecode and compiles every run.
+  - stored, not deflated: no decompression on import.
+  - `python3 -IS`: no site-packages scan, no user site, no PYTHON* env;
+    everything needed is in the archive.
+  - C extensions can't be imported from a zip, so they are left out;
+    PyYAML and charset_normalizer fall back to their pure-Python code.
+Plugins from other packages (entry points) aren't visible to the zipapp;
+the built-in rule types are.
+"""
+from __future__ import annotations
+import argparse, compileall, py_compile, shutil, subprocess, sys, tempfile, zipapp
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+SKIP = shutil.ignore_patterns("__pycache__", "*.pyc", "*.so", "*.dist-info", "bin", "tests")
+
+MAIN = """\
+from lpp_agent.cli import cli
+raise SystemExit(cli())
+"""
+
+def _requirements() -> list[str]:
+    try:
+        import tomllib
+    except ImportError:  # Python < 3.11
+        import tomli as tomllib
+    return tomllib.loads((HERE/"pyproject.toml").read_text())["project"]["dependencies"]
+
+def build(out: Path, interpreter: str, vendor: bool = True) -> Path:
+    with tempfile.TemporaryDirectory(prefix="lpp-zipapp-") as tmp:
+        root = Path(tmp)/"app"
+        shutil.copytree(HERE/"lpp_agent", root/"lpp_agent", ignore=SKIP)
+        if vendor:
+            deps = Path(tmp)/"deps"
+            subprocess.run([sys.executable, "-m", "pip", "install", "--quiet", "--no-compile",
+                            "--target", str(deps), *_requirements()], check=True)
+            skipped = SKIP(str(deps), [p.name for p in deps.iterdir()])
+            for p in deps.iterdir():
+                if p.name in skipped:
+                    continue
+                if p.is_dir():
+                    shutil.copytree(p, root/p.name, ignore=SKIP)
+                elif p.suffix == ".py":
+                    shutil.copy2(p, root/p.name)
+        (root/"__main__.py").write_text(MAIN)
+        compileall.compile_dir(root, quiet=1, legacy=True,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        zipapp.create_archive(root, out, interpreter=interpreter, compressed=False)
+    return out
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(prog="build_zipapp.py")
+    ap.add_argument("-o", "--output", type=Path, default=HERE/"dist"/"lpp-agent.pyz")
+    ap.add_argument("--python", default="/usr/bin/python3", help="interpreter for the #! line")
+    ap.add_argument("--no-vendor", action="store_true",
+                    help="leave dependencies out (they must be installed for --python; runs without -S)")
+    args = ap.parse_args(argv)
+    flags = "-I" if args.no_vendor else "-IS"
+    out = build(args.output, f"{args.python} {flags}", vendor=not args.no_vendor)
+    print(f"{out} ({out.stat().st_size // 1024} KiB)")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,307 @@
+from __future__ import annotations
+import logging, os, platform, signal, subprocess, threading, time, uuid
+from pathlib import Path
+from typing import Any
+
+log = logging.getLogger(__name__)
+
+# What policy steps may use. Every step starts in its own session (process
+# group), is reniced and ioniced as a group, and, when the agent's cgroup is
+# delegated to it (Delegate=yes in lpp-agent.service), gets a transient
+# cgroup v2 child with the configured cpu.max / memory.max / io.weight that
+# also accounts for the whole process tree. A timeout kills the group and the
+# cgroup. Heavy steps (package transactions) can be held to a maintenance
+# window and until the load average drops. Niceness and IO priority carry
+# over to daemons a step starts outside systemd, so steps aren't reniced
+# unless exec_nice is set.
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+CONTROLLERS = ("cpu", "memory", "io")
+CPU_PERIOD_US = 100_000
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_WHO_PGRP = 2
+# ioprio_set isn't in os; syscall numbers per architecture
+IOPRIO_SET = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "riscv64": 30,
+              "armv7l": 314, "ppc64le": 273, "ppc64": 273, "s390x": 282}
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+def _bytes(v: Any) -> int:
+    s = str(v).strip().upper().rstrip("B")
+    return int(float(s[:-1]) * UNITS[s[-1]]) if s and s[-1] in UNITS else int(s)
+
+def _ioprio(spec: str | None) -> int | None:
+    """"idle", "best-effort:7", "realtime:0" -> the ioprio_set value."""
+    if not spec:
+        return None
+    name, _, level = str(spec).partition(":")
+    cls = IOPRIO_CLASSES[name.strip()]
+    return (cls << 13) | (0 if cls == 3 else int(level or 4))
+
+class Window:
+    """A daily local-time window "HH:MM-HH:MM"; it may span midnight."""
+    def __init__(self, spec: str):
+        a, _, b = spec.partition("-")
+        self.spec = spec
+        self.start, self.end = self._minute(a), self._minute(b)
+
+    @staticmethod
+    def _minute(hhmm: str) -> int:
+        h, _, m = hhmm.strip().partition(":")
+        return int(h) * 60 + int(m or 0)
+
+    def _now(self, t: float) -> tuple[int, float]:
+        lt = time.localtime(t)
+        return lt.tm_hour * 60 + lt.tm_min, lt.tm_sec
+
+    def open(self, t: float | None = None) -> bool:
+        m, _ = self._now(time.time() if t is None else t)
+        if self.start <= self.end:
+            return self.start <= m < self.end
+        return m >= self.start or m < self.end
+
+    def until_open(self, t: float | None = None) -> float:
+        """Seconds until the window next opens (0 while open)."""
+        t = time.time() if t is None else t
+        if self.open(t):
+            return 0.0
+        m, s = self._now(t)
+        return ((self.start - m) % 1440) * 60 - s
+
+def _delegated(own: Path) -> bool:
+    """
+    Whether systemd delegated this cgroup to us (Delegate=yes). Root can
+    write any cgroup, so access says nothing; systemd 251+ marks delegated
+    cgroups with an xattr, older ones only have the unit's property.
+    """
+    for attr in ("trusted.delegate", "user.delegate"):
+        try:
+            if os.getxattr(own, attr) == b"1":
+                return True
+        except OSError:
+            pass
+    if not own.name.endswith((".service", ".scope")):
+        return False  # a login session's or cron's processes: not ours to reorganize
+    try:
+        cp = subprocess.run(["systemctl", "show", "-p", "Delegate", "--value", own.name],
+                            capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return cp.returncode == 0 and cp.stdout.strip() == "yes"
+
+class Cgroup:
+    """A transient child cgroup of the agent's; usage() reads its accounting."""
+    def __init__(self, path: Path):
+        self.path = path
+
+    def _read(self, name: str) -> str:
+        try:
+            return (self.path/name).read_text()
+        except OSError:
+            return ""
+
+    def usage(self) -> dict[str, Any]:
+        out: dict[str, Any] = {}
+        cpu = dict(ln.split() for ln in self._read("cpu.stat").splitlines() if ln.count(" ") == 1)
+        if "usage_usec" in cpu:
+            out["tree_cpu_s"] = round(int(cpu["usage_usec"]) / 1e6, 3)
+        peak = self._read("memory.peak").strip()  # kernel 5.19+
+        if peak.isdigit():
+            out["tree_mem_peak_kb"] = int(peak) >> 10
+        rd = wr = 0
+        for ln in self._read("io.stat").splitlines():
+            for kv in ln.split()[1:]:
+                k, _, v = kv.partition("=")
+                if k == "rbytes":
+                    rd += int(v)
+                elif k == "wbytes":
+                    wr += int(v)
+        if self._read("io.stat"):
+            out["io_read_kb"], out["io_write_kb"] = rd >> 10, wr >> 10
+        for ln in self._read("memory.events").splitlines():
+            k, _, v = ln.partition(" ")
+            if k == "oom_kill" and int(v):
+                out["oom_kills"] = int(v)
+        return out
+
+    def kill(self) -> None:
+        try:
+            (self.path/"cgroup.kill").write_text("1")  # kernel 5.14+
+            return
+        except OSError:
+            pass
+        for pid in self._read("cgroup.procs").split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except OSError:
+                pass
+
+    def remove(self) -> None:
+        # a step may leave a daemon behind on purpose; its cgroup stays
+        # until it exits and a later sweep removes it
+        try:
+            self.path.rmdir()
+        except OSError:
+            pass
+
+class Budget:
+    def __init__(self):
+        self.nice = 0
+        self.ionice: int | None = _ioprio("best-effort:7")
+        self.cpu_quota: float | None = None  # percent of one CPU
+        self.memory_max: int | None = None
+        self.io_weight: int | None = None
+        self.use_cgroups = True
+        self.window: Window | None = None
+        self.quiet_load: float | None = None  # 1-min load average per CPU
+        self.quiet_wait_sec = 900.0
+        self._base: Path | None = None
+        self._checked = False
+        self._lock = threading.Lock()
+        self._ioprio_nr = IOPRIO_SET.get(platform.machine())
+        self._libc: Any = None
+
+    def configure(self, cfg: dict[str, Any]) -> None:
+        self.nice = int(cfg.get("exec_nice", 0))
+        self.ionice = _ioprio(cfg.get("exec_ionice", "best-effort:7"))
+        self.cpu_quota = float(cfg["exec_cpu_quota"]) if cfg.get("exec_cpu_quota") else None
+        self.memory_max = _bytes(cfg["exec_memory_max"]) if cfg.get("exec_memory_max") else None
+        self.io_weight = int(cfg["exec_io_weight"]) if cfg.get("exec_io_weight") else None
+        self.use_cgroups = bool(cfg.get("exec_cgroups", True))
+        self.window = Window(cfg["maintenance_window"]) if cfg.get("maintenance_window") else None
+        self.quiet_load = float(cfg["quiet_load"]) if cfg.get("quiet_load") else None
+        self.quiet_wait_sec = float(cfg.get("quiet_wait_sec", 900))
+
+    # ---- cgroups ----
+
+    def _setup(self) -> Path | None:
+        """The agent's own cgroup, prepared for children; None if it isn't ours to manage."""
+        try:
+            rel = next(ln[3:] for ln in Path("/proc/self/cgroup").read_text().splitlines() if ln.startswith("0::"))
+        except (OSError, StopIteration):
+            return None  # not cgroup v2
+        own = CGROUP_ROOT/rel.strip().lstrip("/")
+        if own == CGROUP_ROOT or not os.access(own/"cgroup.subtree_control", os.W_OK):
+            return None
+        if not _delegated(own):
+            log.debug("cgroup %s is not delegated to the agent (Delegate=yes); using process groups only", own)
+            return None
+        try:
+            wanted = set((own/"cgroup.controllers").read_text().split()) & set(CONTROLLERS)
+            enabled = set((own/"cgroup.subtree_control").read_text().split())
+            if wanted - enabled:
+                # a cgroup with processes can't enable controllers for its
+                # children: move the agent into a leaf of its own first
+                leaf = own/"agent"
+                leaf.mkdir(exist_ok=True)
+                for pid in (own/"cgroup.procs").read_text().split():
+                    try:
+                        (leaf/"cgroup.procs").write_text(pid)
+                    except OSError:
+                        pass
+                (own/"cgroup.subtree_control").write_text(" ".join(f"+{c}" for c in sorted(wanted - enabled)))
+            for stale in own.glob("step-*"):  # left by steps that daemonized, or a crash
+                try:
+                    stale.rmdir()
+                except OSError:
+                    pass
+        except OSError as e:
+            log.info("cgroup %s not usable for policy steps (%s); using process groups only", own, e)
+            return None
+        log.debug("policy steps get child cgroups of %s", own)
+        return own
+
+    def _cgroup(self, pid: int) -> Cgroup | None:
+        with self._lock:
+            if not self._checked:
+                self._base, self._checked = self._setup(), True
+            base = self._base
+        if base is None:
+            return None
+        cg = Cgroup(base/f"step-{uuid.uuid4().hex[:12]}")
+        try:
+            cg.path.mkdir()
+            if self.cpu_quota:
+                (cg.path/"cpu.max").write_text(f"{int(self.cpu_quota / 100 * CPU_PERIOD_US)} {CPU_PERIOD_US}")
+            if self.memory_max:
+                (cg.path/"memory.max").write_text(str(self.memory_max))
+            if self.io_weight:
+                (cg.path/"io.weight").write_text(f"default {self.io_weight}")
+            (cg.path/"cgroup.procs").write_text(str(pid))
+        except OSError as e:
+            log.debug("cgroup for pid %d: %s", pid, e)
+            cg.remove()
+            return None
+        # whatever the step forked before it was moved is still beside the
+        # agent; it shares the step's process group
+        for leaf in (base/"agent", base):
+            try:
+                procs = (leaf/"cgroup.procs").read_text().split()
+            except OSError:
+                continue
+            for p in procs:
+                try:
+                    if int(p) != pid and os.getpgid(int(p)) == pid:
+                        (cg.path/"cgroup.procs").write_text(p)
+                except OSError:
+                    pass
+        return cg
+
+    # ---- per step ----
+
+    def confine(self, pid: int) -> Cgroup | None:
+        """
+        Apply the budget to a just-started step: pid leads its own process
+        group (start_new_session=True). Returns its cgroup, if one was made.
+        """
+        if self.nice:
+            try:
+                os.setpriority(os.PRIO_PGRP, pid, self.nice)
+            except OSError as e:
+                log.debug("renice of %d: %s", pid, e)
+        if self.ionice is not None and self._ioprio_nr is not None:
+            import ctypes
+            if self._libc is None:
+                self._libc = ctypes.CDLL(None, use_errno=True)
+            if self._libc.syscall(self._ioprio_nr, IOPRIO_WHO_PGRP, pid, self.ionice) != 0:
+                log.debug("ionice of %d: errno %d", pid, ctypes.get_errno())
+        return self._cgroup(pid) if self.use_cgroups else None
+
+    @staticmethod
+    def kill(pid: int, cg: Cgroup | None = None) -> None:
+        """Kill a step's whole process tree: its process group, and its cgroup for anything that left the group."""
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        if cg:
+            cg.kill()
+
+    # ---- heavy steps ----
+
+    def _load(self) -> float:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def hold(self) -> str | None:
+        """
+        Wait until a heavy step may start: inside the maintenance window and,
+        if quiet_load is set, for the load to drop (up to quiet_wait_sec).
+        Returns None to go ahead, else why the step is deferred.
+        """
+        if self.window and not self.window.open():
+            return f"outside maintenance window {self.window.spec}"
+        if not self.quiet_load:
+            return None
+        deadline = time.monotonic() + self.quiet_wait_sec
+        while (load := self._load()) >= self.quiet_load:
+            if time.monotonic() >= deadline:
+                return f"host busy (load {load:.2f} per CPU)"
+            time.sleep(min(15.0, max(0.0, deadline - time.monotonic())))
+        return None
+
+    def retry_in(self) -> float:
+        """When to try deferred heavy steps again."""
+        if self.window and not self.window.open():
+            return self.window.until_open() + 1
+        return max(300.0, self.quiet_wait_sec)
+
+budget = Budget()
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import logging, os, selectors, subprocess, threading, time
+from typing import Callable
+
+from .budget import budget
+
+log = logging.getLogger(__name__)
+
+HEAD_BYTES = 1024
+TAIL_BYTES = 4096
+LIVE_BUFFER = 64 << 10  # unsent live output kept per stream
+
+class Ring:
+    """Keeps the first `head` and last `tail` bytes of a stream, counting what was dropped."""
+    __slots__ = ("head", "tail", "_head", "_tail", "total")
+
+    def __init__(self, head: int = HEAD_BYTES, tail: int = TAIL_BYTES):
+        self.head, self.tail = head, tail
+        self._head = bytearray()
+        self._tail = bytearray()
+        self.total = 0
+
+    def feed(self, chunk: bytes) -> None:
+        self.total += len(chunk)
+        room = self.head - len(self._head)
+        if room > 0:
+            self._head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self._tail += chunk
+            if len(self._tail) > self.tail:
+                del self._tail[:len(self._tail) - self.tail]
+
+    def text(self) -> str:
+        omitted = self.total - len(self._head) - len(self._tail)
+        mid = f"\n…[{omitted} bytes omitted]…\n".encode() if omitted > 0 else b""
+        return (bytes(self._head) + mid + bytes(self._tail)).decode(errors="replace")
+
+class Captured:
+    """subprocess.CompletedProcess look-alike with bounded output and resource usage."""
+    __slots__ = ("args", "returncode", "stdout", "stderr", "usage")
+
+    def __init__(self, args, returncode: int, stdout: str, stderr: str, usage: dict[str, float]):
+        self.args, self.returncode = args, returncode
+        self.stdout, self.stderr, self.usage = stdout, stderr, usage
+
+def run(argv: list[str], timeout: float | None = None, env: dict[str, str] | None = None,
+        on_output: Callable[[str, bytes], None] | None = None,
+        head: int = HEAD_BYTES, tail: int = TAIL_BYTES) -> Captured:
+    """
+    Run argv reading stdout/stderr incrementally into head+tail rings, so memory
+    stays bounded however chatty the child is. on_output(stream, chunk) sees
+    every chunk as it arrives. The child is reaped with wait4 to record wall
+    time, CPU time, max RSS and block IO; overhead_ms is the time spent
+    starting it. It runs in its own process group under the resource budget
+    (see budget); with a cgroup, usage also covers its whole process tree.
+    On timeout the whole tree is killed and subprocess.TimeoutExpired raised,
+    like subprocess.run.
+    """
+    start = time.monotonic()
+    p = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, env=env, start_new_session=True)
+    cg = budget.confine(p.pid)
+    spawned = time.monotonic()
+    rings = {"stdout": Ring(head, tail), "stderr": Ring(head, tail)}
+    sel = selectors.DefaultSelector()
+    sel.register(p.stdout, selectors.EVENT_READ, "stdout")
+    sel.register(p.stderr, selectors.EVENT_READ, "stderr")
+    deadline = start + timeout if timeout else None
+    timed_out = False
+    try:
+        while sel.get_map():
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                timed_out = True
+                budget.kill(p.pid, cg)
+                break
+            for key, _ in sel.select(timeout=wait):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    continue
+                rings[key.data].feed(chunk)
+                if on_output:
+                    try:
+                        on_output(key.data, chunk)
+                    except Exception as e:
+                        log.debug("live output callback failed: %s", e)
+    finally:
+        sel.close()
+        p.stdout.close(); p.stderr.close()
+    _, status, ru = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        "wall_s": round(time.monotonic() - start, 3),
+        "cpu_user_s": round(ru.ru_utime, 3),
+        "cpu_sys_s": round(ru.ru_stime, 3),
+        "max_rss_kb": ru.ru_maxrss,
+        "io_read_kb": ru.ru_inblock // 2,  # 512-byte blocks
+        "io_write_kb": ru.ru_oublock // 2,
+        "overhead_ms": round((spawned - start) * 1000, 3),  # fork/exec and confinement
+    }
+    if cg:
+        usage.update(cg.usage())
+        cg.remove()
+    out, err = rings["stdout"].text(), rings["stderr"].text()
+    if timed_out:
+        raise subprocess.TimeoutExpired(argv, timeout, output=out, stderr=err)
+    return Captured(argv, p.returncode, out, err, usage)
+
+class LiveTail:
+    """
+    on_output adapter for long-running steps: once a step has run for `after`
+    seconds, buffered output is handed to send(stream, text) at most every
+    `every` seconds. Call close() when the step ends to send what's left.
+    """
+    def __init__(self, send: Callable[[str, str], None], after: float = 10.0, every: float = 2.0):
+        self.send, self.after, self.every = send, after, every
+        self._start = self._last = time.monotonic()
+        self._buf: dict[str, bytearray] = {"stdout": bytearray(), "stderr": bytearray()}
+        self._lock = threading.Lock()
+        self._live = False
+
+    def __call__(self, stream: str, chunk: bytes) -> None:
+        with self._lock:
+            buf = self._buf[stream]
+            buf += chunk
+            if len(buf) > LIVE_BUFFER:
+                del buf[:len(buf) - LIVE_BUFFER]
+            now = time.monotonic()
+            if now - self._start < self.after or now - self._last < self.every:
+                return
+            self._live, self._last = True, now
+            self._flush()
+
+    def _flush(self) -> None:
+        for stream, buf in self._buf.items():
+            if buf:
+                text = buf.decode(errors="replace")
+                buf.clear()
+                try:
+                    self.send(stream, text)
+                except Exception as e:
+                    log.debug("live output send failed: %s", e)
+
+    def close(self) -> None:
+        # short steps never go live; their output is in the result anyway
+        with self._lock:
+            if self._live:
+                self._flush()
@@ -0,0 +1,78 @@
+from __future__ import annotations
+import sys
+
+# The console script. Commands import what they need when they run, so
+# `lpp-agent once` on an unchanged policy never loads requests, yaml or the
+# executor.
+
+def cli(argv: list[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv == ["once"]:  # the timer path: skip building the parser
+        from .once import cmd_once
+        return cmd_once()
+
+    import argparse, logging
+    parser = argparse.ArgumentParser(prog="lpp-agent")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_enr = sub.add_parser("enroll", help="Enroll device")
+    p_enr.add_argument("token", help="enr_… token")
+    p_enr.add_argument("api", help="API base (include /api), e.g. http://host:3000/api")
+
+    sub.add_parser("run", help="Run agent loop")
+    sub.add_parser("once", help="One iteration and exit (for systemd timers); exits early when nothing changed")
+    sub.add_parser("plan", help="Show drift from the effective policy without changing anything")
+
+    p_his = sub.add_parser("history", help="Recent runs and per-rule results from the local state store")
+    what = p_his.add_mutually_exclusive_group()
+    what.add_argument("--rule", metavar="ID", help="results of one rule across runs")
+    what.add_argument("--slowest", action="store_true", help="rules by average duration")
+    what.add_argument("--failed", action="store_true", help="failed, skipped, deferred and drifted results")
+    p_his.add_argument("--since", metavar="AGE", help="only the last AGE, e.g. 30m, 24h, 7d")
+    p_his.add_argument("-n", "--limit", type=int, default=20)
+    p_his.add_argument("--json", action="store_true", help="JSON instead of a table")
+
+    p_sim = sub.add_parser("simulate", help="Load-test the control plane with N virtual agents")
+    p_sim.add_argument("--agents", type=int, default=100)
+    p_sim.add_argument("--duration", type=float, default=60, help="seconds")
+    p_sim.add_argument("--api", help="API base (include /api); default: a local stand-in server")
+    p_sim.add_argument("--interval", type=float, default=60, help="poll interval without long-poll")
+    p_sim.add_argument("--jitter", type=float, default=1, help="random seconds added to each agent's poll slot")
+    p_sim.add_argument("--max-interval", type=float, default=600, help="longest poll interval after a run of 304s")
+    p_sim.add_argument("--stretch-after", type=int, default=10, help="double the interval after this many 304s (0 = never)")
+    p_sim.add_argument("--long-poll-sec", type=int, default=55, help="0 = plain polling")
+    p_sim.add_argument("--heartbeat-sec", type=float, default=30)
+    p_sim.add_argument("--ramp", type=float, default=0, help="spread first requests over this many seconds (0 = all at once, like a restart)")
+    p_sim.add_argument("--bump-every", type=float, default=0, help="stand-in only: new policy rev every N seconds")
+    p_sim.add_argument("--workers", type=int, default=0, help="worker threads (0 = auto)")
+    p_sim.add_argument("--report-sec", type=float, default=5)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "enroll":
+        from .main import cmd_enroll
+        return cmd_enroll(args.token, args.api)
+    if args.cmd == "run":
+        from .main import cmd_run
+        return cmd_run()
+    if args.cmd == "once":
+        from .once import cmd_once
+        return cmd_once()
+    if args.cmd == "plan":
+        from .main import cmd_plan
+        return cmd_plan()
+    if args.cmd == "history":
+        from .history import cmd_history
+        return cmd_history(rule=args.rule, slowest=args.slowest, failed=args.failed,
+                           since_spec=args.since, limit=args.limit, as_json=args.json)
+    if args.cmd == "simulate":
+        from . import simulate
+        logging.basicConfig(level=logging.WARNING)
+        return simulate.run(args.api, args.agents, args.duration, bump_every=args.bump_every,
+                            interval=args.interval, jitter=args.jitter, long_poll_sec=args.long_poll_sec,
+                            heartbeat_sec=args.heartbeat_sec, ramp=args.ramp, workers=args.workers,
+                            report_sec=args.report_sec, max_interval=args.max_interval,
+                            stretch_after=args.stretch_after)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(cli())
@@ -1,49 +1,113 @@
 from __future__ import annotations
-import os, sys, json, logging
+import os, json, logging
 from pathlib import Path
 from typing import Any
 
 APP = "lpp"
-CONF_DIR = Path("/etc")/APP
-STATE_DIR = Path("/var/lib")/APP
-LOG_DIR = Path("/var/log")/APP
+USER_AGENT = "lpp-agent/0.2.0"
+# LPP_*_DIR relocate everything, e.g. to run unprivileged or under agent/bench
+CONF_DIR = Path(os.environ.get("LPP_CONF_DIR") or Path("/etc")/APP)
+STATE_DIR = Path(os.environ.get("LPP_STATE_DIR") or Path("/var/lib")/APP)
+LOG_DIR = Path(os.environ.get("LPP_LOG_DIR") or Path("/var/log")/APP)
 CONF_FILE = CONF_DIR/"agent.toml"
-STATE_FILE = STATE_DIR/"state.json"
+STATE_FILE = STATE_DIR/"state.json"  # before state.db (see store); migrated on first open
 LOG_FILE = LOG_DIR/"agent.log"
+OUTBOX_DIR = STATE_DIR/"outbox"
 
 DEFAULTS = {
     "api": "http://10.0.203.182:8080",
     "agent_id": None,
     "jwt": None,
     "tenant": 1,
-    "interval_sec": 60,
+    "interval_sec": 60,      # poll interval without long-poll; each agent keeps its own slot in it
+    "poll_max_sec": 600,     # stretch the interval up to this while nothing changes
+    "poll_stretch_after": 10,  # double the interval after this many 304s in a row (0 = never)
+    "heartbeat_sec": 30,     # heartbeats run on their own ticker, even mid-apply
+    "send_sec": 10,          # outbox drain interval
+    "http_pool_size": 4,     # keep-alive connections to the API (watch, heartbeat, send, …)
+    "http_retries": 3,       # transparent retries of idempotent requests on connect errors/5xx
+    "long_poll_sec": 55,     # hold policy requests open this long (0 = plain polling)
     "max_backoff_sec": 600,
+    "full_reconcile_sec": 21600,  # re-apply every policy this often, changed or not
+    "drift_scan_sec": 300,   # check (never change) policies this often and report drift; 0 = off
     "hostname": None,
     "tags": [],              # arbitrary host tags (e.g., prod, gpu)
     "allow_bash": True,      # allow bash from server policies
+    "bash_workers": 2,       # persistent shells kept for bash rules (0 = a new bash per rule)
+    "bash_login_env": True,  # run bash rules with the login environment (profile PATH etc.), snapshotted
+    "exec_nice": 0,          # niceness of bash/package steps (0 = the agent's); daemons a step starts inherit it
+    "exec_ionice": "best-effort:7",  # their IO class[:level]: idle, best-effort:0-7, realtime:0-7 (inherited too)
+    "exec_cgroups": True,    # a cgroup per step when the service is delegated one (Delegate=yes)
+    "exec_cpu_quota": None,  # percent of one CPU per step, e.g. 50 (needs exec_cgroups)
+    "exec_memory_max": None, # e.g. "1G"; a step above it is OOM-killed (needs exec_cgroups)
+    "exec_io_weight": None,  # 1-10000, default 100 (needs exec_cgroups)
+    "maintenance_window": None,  # e.g. "02:00-05:00" local time: package transactions wait for it
+    "quiet_load": None,      # hold package transactions while the 1-min load per CPU is above this
+    "quiet_wait_sec": 900,   # …for at most this long, then defer them
+    "pkg_prefetch": True,    # download the packages of a deferred transaction in the background (download-only) so the window only installs
+    "live_output": False,    # stream output of long-running bash/pkg steps to the server
+    "max_parallel": 4,       # rules applied concurrently when independent
+    "outbox_max_mb": 64,     # cap on unsent results kept under /var/lib/lpp/outbox
+    "outbox_batch_kb": 256,  # results per gzip batch
+    "history_runs": 500,     # runs kept in the local history (`lpp-agent history`)…
+    "history_days": 30,      # …and for at most this long
+    "fingerprint_ttl_sec": 86400,  # skip rules whose inputs are unchanged for up to this long; 0 = off
+    "facts_ttl_sec": 3600,   # re-gather host facts (pkg manager, distro, …) after this
+    "metrics_textfile": None,  # e.g. /var/lib/node_exporter/textfile_collector/lpp.prom
+    "metrics_socket": None,  # e.g. /run/lpp/metrics.sock: GET /metrics, /trace
+    "trace_file": None,      # spans of each apply cycle as JSON lines, e.g. /var/log/lpp/trace.jsonl
+    "log_format": "text",    # agent.log lines: text, or json (one object per line, with the cycle id)
+    "log_max_mb": 16,        # roll agent.log over at this size…
+    "log_rotate_sec": 86400, # …or when this period (UTC-aligned) ends; 0 = size only
+    "log_backups": 7,        # rolled files kept, gzipped
+    "log_repeat_limit": 5,   # same warning/error at most this often a minute; 0 = no limit
 }
 
 def ensure_dirs():
     for p in (CONF_DIR, STATE_DIR, LOG_DIR):
         p.mkdir(parents=True, exist_ok=True)
 
+def _read_conf() -> dict[str, Any]:
+    """What agent.toml sets; empty if it is missing or unreadable."""
+    if not CONF_FILE.exists():
+        return {}
+    try:
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+        return tomllib.loads(CONF_FILE.read_text())
+    except Exception:
+        return {}
+
 def load_conf() -> dict[str, Any]:
-    ensure_dirs()
+    # read-only: nothing is created on disk until something is written
     data = DEFAULTS.copy()
-    if CONF_FILE.exists():
-        try:
-            import tomli
-            data.update(tomli.loads(CONF_FILE.read_text()))
-        except Exception: pass
+    data.update(_read_conf())
     if not data.get("hostname"):
-        import socket
-        data["hostname"] = socket.gethostname()
+        data["hostname"] = os.uname().nodename
     return data
 
+def state_key(api: str, agent_id: str) -> str:
+    """Key of this agent's entries in the state sections (see store)."""
+    return f"{api}::{agent_id}"
+
+# written even when they equal DEFAULTS: a new default must not move an enrolled agent
+ENROLLMENT = ("api", "agent_id", "jwt")
+
 def save_conf(conf: dict[str, Any]) -> None:
+    """
+    Write agent.toml: the enrollment, keys already in the file, and others
+    only where they differ from DEFAULTS, so later defaults still apply.
+    """
     ensure_dirs()
+    explicit = set(_read_conf()) | set(ENROLLMENT)
     lines = []
     for k,v in conf.items():
+        if v is None:
+            continue  # TOML has no null; unset keys fall back to DEFAULTS
+        if k in DEFAULTS and v == DEFAULTS[k] and k not in explicit:
+            continue
         if isinstance(v, str):
             lines.append(f'{k} = "{v}"')
         elif isinstance(v, bool):
@@ -52,26 +116,11 @@ def save_conf(conf: dict[str, Any]) -> None:
             lines.append(f"{k} = {json.dumps(v)}")
     CONF_FILE.write_text("\n".join(lines)+"\n")
 
-def load_state() -> dict[str, Any]:
-    ensure_dirs()
-    if STATE_FILE.exists():
-        try:
-            return json.loads(STATE_FILE.read_text())
-        except Exception:
-            return {}
-    return {}
-
-def save_state(st: dict[str, Any]) -> None:
-    ensure_dirs()
-    STATE_FILE.write_text(json.dumps(st, indent=2))
-
-def setup_logging(level=logging.INFO) -> None:
+def setup_logging(level=logging.INFO, cfg: dict[str, Any] | None = None) -> None:
+    from . import logs
     ensure_dirs()
-    logging.basicConfig(
-        level=level,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.FileHandler(LOG_FILE),
-            logging.StreamHandler(sys.stdout),
-        ]
-    )
+    cfg = {**DEFAULTS, **(cfg or {})}
+    logs.setup(LOG_FILE, level, fmt=str(cfg["log_format"]),
+               max_bytes=int(float(cfg["log_max_mb"]) * (1 << 20)),
+               backups=int(cfg["log_backups"]), period_sec=float(cfg["log_rotate_sec"]),
+               repeat_limit=int(cfg["log_repeat_limit"]))
@@ -0,0 +1,118 @@
+from __future__ import annotations
+import copy, logging, sqlite3, threading
+from pathlib import Path
+from typing import Any
+
+from . import metrics, shell, store
+from .budget import budget
+from .fingerprint import FingerprintStore
+from .http import Api
+from .outbox import Outbox
+
+log = logging.getLogger(__name__)
+
+class State:
+    """
+    The store's key/value sections held in memory. Reads never touch the
+    disk; writes mark entries dirty and flush() commits those in one
+    transaction, only when there are any.
+    """
+    def __init__(self, db: store.Store):
+        self.db = db
+        self._data = db.load()
+        self._dirty: set[tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            return (self._data.get(section) or {}).get(key, default)
+
+    def set(self, section: str, key: str, value: Any) -> None:
+        with self._lock:
+            sec = self._data.setdefault(section, {})
+            if sec.get(key) != value:
+                sec[key] = value
+                self._dirty.add((section, key))
+
+    def flush(self) -> bool:
+        with self._lock:
+            if not self._dirty:
+                return False
+            dirty, self._dirty = self._dirty, set()
+            items = [(s, k, copy.deepcopy(self._data[s][k])) for s, k in dirty]
+        try:
+            self.db.put(items)
+        except sqlite3.Error as e:
+            with self._lock:
+                self._dirty |= dirty
+            log.warning("could not save state: %s", e)
+            return False
+        return True
+
+class AgentContext:
+    """
+    What outlives a single iteration: one keep-alive HTTP pool, the store and
+    the in-memory state, the outbox (so send backoff carries over too), the rule
+    fingerprints, the metrics exporters and the bash worker pool.
+    """
+    def __init__(self, cfg: dict[str, Any]):
+        self.api = Api(cfg["api"], cfg.get("jwt"),
+                       pool_size=int(cfg.get("http_pool_size", 4)),
+                       retries=int(cfg.get("http_retries", 3)))
+        self.store = store.get()
+        self.state = State(self.store)
+        self.history = (int(cfg.get("history_runs", 500)), float(cfg.get("history_days", 30)) * 86400)
+        self.outbox = Outbox(max_bytes=int(cfg.get("outbox_max_mb", 64)) << 20,
+                             batch_bytes=int(cfg.get("outbox_batch_kb", 256)) << 10)
+        ttl = float(cfg.get("fingerprint_ttl_sec", 86400))
+        self.fingerprints = FingerprintStore(ttl=ttl) if ttl > 0 else None
+        budget.configure(cfg)
+        if not cfg.get("pkg_prefetch", True):
+            from .plugins import pkg
+            pkg.prefetcher.enabled = False
+        shell.pool.size = int(cfg.get("bash_workers", 2))
+        shell.login_env = bool(cfg.get("bash_login_env", True))
+        self.metrics_file = cfg.get("metrics_textfile")
+        self.metrics_server = None
+        if cfg.get("metrics_socket"):
+            try:
+                self.metrics_server = metrics.MetricsServer(cfg["metrics_socket"])
+            except OSError as e:
+                log.warning("metrics socket %s: %s", cfg["metrics_socket"], e)
+        if cfg.get("trace_file"):
+            metrics.tracer.path = Path(cfg["trace_file"])
+        metrics.tracer.enabled = bool(cfg.get("trace_file") or self.metrics_server)
+        if self.metrics_file or self.metrics_server:
+            metrics.count_forks()
+            metrics.registry.collector(lambda: metrics.registry.set("lpp_outbox_bytes", self.outbox.depth()))
+
+    def record(self, run: str, mode: str, rev: Any, ms: float, results: list[dict[str, Any]]) -> None:
+        """Keep a run and its rule results in the local history (`lpp-agent history`)."""
+        max_runs, max_age = self.history
+        try:
+            self.store.record_run(run, mode, rev, ms, results, max_runs=max_runs, max_age_sec=max_age)
+        except sqlite3.Error as e:
+            log.warning("could not record run history: %s", e)
+
+    def export(self) -> None:
+        """Refresh the metrics textfile, if one is configured."""
+        if self.metrics_file:
+            metrics.registry.write_textfile(self.metrics_file)
+
+    def close(self) -> None:
+        self.state.flush()
+        self.export()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        shell.pool.close()
+        self.store.close()
+        self.api.close()
+
+_ctx: AgentContext | None = None
+
+def get(cfg: dict[str, Any]) -> AgentContext:
+    """The process-wide context, created on first use."""
+    global _ctx
+    if _ctx is None:
+        _ctx = AgentContext(cfg)
+    return _ctx
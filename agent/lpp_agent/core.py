@@ -0,0 +1,167 @@
+from __future__ import annotations
+import asyncio, logging, signal, threading
+from typing import Any, Callable, Protocol
+
+from .schedule import Backoff, error_hint
+
+log = logging.getLogger(__name__)
+
+class Agent(Protocol):
+    """What AgentCore drives. Every method blocks and is called off the event loop."""
+    def fetch(self) -> tuple[Any | None, float]:
+        """Wait for a policy change: (change or None, seconds until the next fetch)."""
+    def apply(self, change: Any) -> None: ...
+    def heartbeat(self) -> None: ...
+    def send(self) -> None: ...
+    # optional: scan() runs every scan_sec while no apply is in flight,
+    # close() is called once the loop has stopped
+
+def _settle(fut: asyncio.Future, res: Any, exc: BaseException | None) -> None:
+    if fut.cancelled():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(res)
+
+async def _in_thread(fn: Callable[..., Any], *args: Any) -> Any:
+    """
+    Like asyncio.to_thread, but on a daemon thread: a cancelled agent exits
+    without joining an apply or long-poll that is still in flight.
+    """
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def work():
+        try:
+            res, exc = fn(*args), None
+        except BaseException as e:
+            res, exc = None, e
+        try:
+            loop.call_soon_threadsafe(_settle, fut, res, exc)
+        except RuntimeError:
+            pass  # loop already closed (shutting down)
+
+    threading.Thread(target=work, name=f"lpp-{getattr(fn, '__name__', 'task')}", daemon=True).start()
+    return await fut
+
+class AgentCore:
+    """
+    One event loop running independent tasks: heartbeat ticker, policy watcher,
+    apply worker and result sender. Failed fetches back off with decorrelated
+    jitter, never sooner than a Retry-After. The watcher hands changes to the worker
+    through a latest-wins slot, so a long apply never delays heartbeats or
+    result sends. A drift scanner runs the agent's scan() on its own interval;
+    scans and applies share one lock, so they never overlap (an apply waits
+    for a running scan, a scan tick is skipped while an apply runs or is
+    pending). SIGTERM/SIGINT cancel every task.
+    """
+    def __init__(self, agent: Agent, heartbeat_sec: float = 30, send_sec: float = 10,
+                 max_backoff_sec: float = 600, scan_sec: float = 0):
+        self.agent = agent
+        self.heartbeat_sec = heartbeat_sec
+        self.send_sec = send_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.scan_sec = scan_sec
+        self._pending: Any = None
+        self._tasks: list[asyncio.Task] = []
+
+    def run(self) -> int:
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close = getattr(self.agent, "close", None)
+            if close:
+                close()
+        return 0
+
+    def stop(self) -> None:
+        log.info("Stopping agent")
+        for t in self._tasks:
+            t.cancel()
+
+    async def _main(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        self._wake = asyncio.Event()
+        self._send_now = asyncio.Event()
+        self._busy = asyncio.Lock()  # an apply or a scan
+        self._tasks = [
+            asyncio.create_task(self._heartbeats(), name="heartbeat"),
+            asyncio.create_task(self._watch(), name="watch"),
+            asyncio.create_task(self._apply(), name="apply"),
+            asyncio.create_task(self._send(), name="send"),
+        ]
+        if self.scan_sec > 0 and hasattr(self.agent, "scan"):
+            self._tasks.append(asyncio.create_task(self._scans(), name="scan"))
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            pass
+
+    async def _heartbeats(self) -> None:
+        while True:
+            try:
+                await _in_thread(self.agent.heartbeat)
+            except Exception as e:
+                log.warning("heartbeat error: %s", e)
+            await asyncio.sleep(self.heartbeat_sec)
+
+    async def _watch(self) -> None:
+        retry = Backoff(cap=self.max_backoff_sec)
+        while True:
+            try:
+                change, delay = await _in_thread(self.agent.fetch)
+                retry.reset()
+            except Exception as e:
+                delay = retry.next(error_hint(e))
+                log.error("loop error: %s; retrying in %.0fs", e, delay)
+                await asyncio.sleep(delay)
+                continue
+            if change is not None:
+                self._pending = change
+                self._wake.set()
+            await asyncio.sleep(delay)
+
+    async def _apply(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            async with self._busy:
+                change, self._pending = self._pending, None  # the latest, after waiting for a scan
+                if change is None:
+                    continue
+                try:
+                    await _in_thread(self.agent.apply, change)
+                except Exception:
+                    log.exception("apply failed")
+            self._send_now.set()
+
+    async def _scans(self) -> None:
+        while True:
+            await asyncio.sleep(self.scan_sec)
+            if self._busy.locked() or self._pending is not None:
+                continue  # the apply will report; its transient state isn't drift
+            async with self._busy:
+                try:
+                    await _in_thread(self.agent.scan)
+                except Exception as e:
+                    log.warning("drift scan error: %s", e)
+
+    async def _send(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._send_now.wait(), self.send_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._send_now.clear()
+            try:
+                await _in_thread(self.agent.send)
+            except Exception as e:
+                log.warning("send error: %s", e)
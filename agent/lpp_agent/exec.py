@@ -1,46 +1,456 @@
 from __future__ import annotations
-import logging, subprocess, yaml
-from typing import Any
-from .plugins import file_edit, systemd, pkg, sysctl
+import hashlib, json, logging, os, time
+from typing import Any, Callable
+from . import capture, handlers as handlers_mod, metrics, plan, registry, scheduler, shell
+from .fingerprint import FingerprintStore
+from .facts import facts
 
 log = logging.getLogger(__name__)
 
-PLUGIN_MAP = {
-    "file.replace_kv": file_edit.replace_kv,
-    "file.ensure_lines": file_edit.ensure_lines,
-    "service.manage": systemd.manage,
-    "pkg.ensure": pkg.ensure,
-    "sysctl.set": sysctl.set,
-}
-
-def apply_policy_yaml(text: str, allow_bash: bool = True) -> list[dict[str, Any]]:
-    y = yaml.safe_load(text) if text.strip() else {}
-    results: list[dict[str, Any]] = []
-    rules = y.get("rules", [])
-    for r in rules:
-        rid = r.get("id")
-        rtype = r.get("type")
+# Plugins are looked up in the registry per rule type, so a run imports only
+# the plugins its rules use. The built-in types below are batched per run by
+# exec itself (one file transaction, one package transaction, …).
+FILE_TYPES = ("file.replace_kv", "file.ensure_lines", "file.kv_set")
+
+# rule keys consumed by the scheduler, never passed to plugins
+RESERVED = ("id", "type", "after", "requires", "locks")
+
+# rules that may read files edited earlier in the run; pending edits are written first
+FLUSH_BEFORE = ("bash", "service.manage")
+
+# policy fields that change what gets applied
+DIGEST_KEYS = ("yaml", "bash", "packageName", "args")
+
+def policy_digest(p: dict[str, Any]) -> str:
+    body = json.dumps({k: p.get(k) for k in DIGEST_KEYS}, sort_keys=True,
+                      separators=(",", ":"), default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+def on_remove_rules(p: dict[str, Any]) -> list[dict[str, Any]]:
+    """Cleanup rules a policy declares under `on_remove:`, run once it is unassigned."""
+    try:
+        return plan.compile_policy(p).on_remove
+    except plan.PolicyError:
+        return []
+
+def _params(r: dict[str, Any]) -> dict[str, Any]:
+    return {k: v for k, v in r.items() if k not in RESERVED}
+
+def _as_list(v: Any) -> list[str]:
+    if v is None:
+        return []
+    return [str(x) for x in v] if isinstance(v, (list, tuple)) else [str(v)]
+
+def _resources(r: dict[str, Any]) -> set[str]:
+    """What a rule touches; rules sharing a resource run in their listed order."""
+    rtype = r.get("type") or ""
+    if rtype.startswith("file."):
+        return {"path:" + os.path.abspath(str(r.get("file", "")))}
+    if rtype == "service.manage":
+        return {"unit:" + str(r.get("service", ""))}
+    if rtype == "sysctl.set":
+        return {"sysctl:" + str(r.get("param", ""))}
+    return set()
+
+def _pkg_items(name: str, state: str = "present") -> list[tuple[str, str]]:
+    # same signature as pkg.ensure, so bad rules fail the way they used to; the
+    # server's packageName can list several packages in `name`
+    from .plugins import pkg
+    return pkg.items(name, state)
+
+def _plan_pkgs(rules: list[dict[str, Any]], live: Callable[[str], Any] | None = None,
+               skip: set[int] = frozenset(), only: set[int] | None = None) -> dict[int, dict[str, Any]]:
+    """Converge the pkg.ensure rules of the run (those in only, but not in skip) in one package transaction."""
+    done: dict[int, dict[str, Any]] = {}
+    items: list[tuple[int, list[tuple[str, str]]]] = []
+    for i, r in enumerate(rules):
+        if r.get("type") != "pkg.ensure" or i in skip or (only is not None and i not in only):
+            continue
         try:
-            if rtype == "bash":
-                if not allow_bash:
-                    results.append({"id": rid, "type": rtype, "status": "error", "detail": "bash disabled"})
-                    continue
-                code = r.get("code", "")
-                cp = subprocess.run(["bash","-lc", code], text=True, capture_output=True)
-                status = "pass" if cp.returncode == 0 else "error"
-                results.append({"id": rid, "type": rtype, "status": status,
-                                "stdout": cp.stdout[-4000:], "stderr": cp.stderr[-4000:]})
-                continue
-
-            fn = PLUGIN_MAP.get(rtype)
-            if not fn:
-                results.append({"id": rid, "type": rtype, "status": "error", "detail": f"unknown rule type {rtype}"})
-                continue
-
-            # pass only parameters the function expects
-            kws = {k: v for k, v in r.items() if k not in ("id", "type")}
-            status = fn(**kws)
-            results.append({"id": rid, "type": rtype, "status": status})
+            items.append((i, _pkg_items(**_params(r))))
         except Exception as e:
-            results.append({"id": rid, "type": rtype, "status": "error", "detail": str(e)})
+            done[i] = {"status": "error", "detail": str(e)}
+    if not items:
+        return done
+    from .plugins import pkg
+    tail = live("pkg") if live else None
+    try:
+        flat, out = pkg.ensure_many([it for _, its in items for it in its], on_output=tail, prefetch=True)
+    except Exception as e:
+        return {**done, **{i: {"status": "error", "detail": str(e)} for i, _ in items}}
+    finally:
+        if tail:
+            tail.close()
+    if out.get("deferred"):
+        log.info("Package transaction deferred: %s%s", out["deferred"],
+                 f"; prefetching {len(out['prefetching'])} packages" if out.get("prefetching") else "")
+    else:
+        log.info("Package transaction via %s: %d rules, rc=%s", out.get("pm"), len(items), out.get("rc"))
+    statuses = iter(flat)
+    for i, its in items:
+        status = pkg.rollup([next(statuses) for _ in its])
+        done[i] = {"status": status}
+        if out.get("usage"):
+            done[i]["usage"] = out["usage"]
+        if status == "error":
+            done[i]["detail"] = out.get("stderr") or ""
+        elif status == "deferred":
+            done[i]["detail"] = out["deferred"]
+    return done
+
+def _apply_rule(r: dict[str, Any], allow_bash: bool, plugins: dict[str, Any] | None = None,
+                live: Callable[[str], Any] | None = None) -> dict[str, Any]:
+    rid = r.get("id")
+    rtype = r.get("type")
+    try:
+        if rtype == "bash":
+            if not allow_bash:
+                return {"id": rid, "type": rtype, "status": "error", "detail": "bash disabled"}
+            code = r.get("code", "")
+            tail = live(str(rid)) if live else None
+            try:
+                cp = shell.run(code, on_output=tail)
+            finally:
+                if tail:
+                    tail.close()
+            status = "pass" if cp.returncode == 0 else "error"
+            return {"id": rid, "type": rtype, "status": status,
+                    "stdout": cp.stdout, "stderr": cp.stderr, "usage": cp.usage}
+
+        fn = (plugins or {}).get(rtype) or registry.applier(rtype)
+        if not fn:
+            return {"id": rid, "type": rtype, "status": "error", "detail": f"unknown rule type {rtype}"}
+
+        # pass only parameters the function expects
+        status = fn(**_params(r))
+        return {"id": rid, "type": rtype, "status": status}
+    except Exception as e:
+        return {"id": rid, "type": rtype, "status": "error", "detail": str(e)}
+
+def _batched(types: set[Any], handlers: handlers_mod.HandlerQueue | None = None
+             ) -> tuple[Any, Any, Any, dict[str, Callable[..., Any]]]:
+    """
+    Per-run state of the built-in plugins the rules use, each None when
+    unused: (file transaction, systemd, sysctl, their rule type -> function).
+    """
+    files = units = sysctls = None
+    plugins: dict[str, Callable[..., Any]] = {}
+    if types & set(FILE_TYPES):
+        from .plugins import file_edit
+        files = file_edit.Transaction(handlers)
+        plugins.update({t: getattr(files, t[5:]) for t in FILE_TYPES})
+    if "service.manage" in types:
+        from .plugins import systemd
+        units = systemd.Systemd(handlers)
+        plugins["service.manage"] = units.manage
+    if "sysctl.set" in types:
+        from .plugins import sysctl
+        sysctls = sysctl.Sysctl()
+        plugins["sysctl.set"] = sysctls.set
+    return files, units, sysctls, plugins
+
+def _apply_rules(rules: list[dict[str, Any]], allow_bash: bool = True, max_workers: int = 1,
+                 policy_of: list[int] | None = None,
+                 on_result: Callable[[int, dict[str, Any]], None] | None = None,
+                 live: Callable[[str, str, str], None] | None = None,
+                 fingerprints: FingerprintStore | None = None) -> list[dict[str, Any]]:
+    """
+    Run rules as a dependency graph. Edges come from explicit `after:` /
+    `requires:` ids plus implicit ones: rules on the same file, unit or sysctl
+    key keep their order, services wait for packages, and a bash rule is a
+    barrier inside its own policy. pkg.ensure rules form one node (one package
+    transaction) per phase: a rule's phase is the number of bash rules before
+    it in its policy, so "add a repo in bash, then install" keeps its order.
+    bash rules hold the "pkg" lock unless they declare `locks:`, so scripts
+    that call apt/dnf never race a package transaction. File rules share one
+    file transaction that is written before any bash/service rule and at the
+    end. Restarts/reloads from
+    notify and `restarted` services are queued, deduplicated per unit and run
+    once after everything else. sysctl keys persist into one drop-in written
+    at the end. Results are returned in rule order.
+
+    on_result(i, result) is called as each rule finishes, and again for a rule
+    whose result is corrected by the end-of-run flushes. live(rule_id, stream,
+    text) receives output of bash/pkg steps that run long.
+
+    With a fingerprint store, rules whose params and watched inputs are
+    unchanged since they last converged report "pass" without running; each
+    cacheable result carries cache: hit|miss.
+
+    Rules that ran carry `ms`; package rules share the time of their one
+    transaction evenly. Timings also go to metrics (lpp_rule_seconds by
+    type, lpp_phase_seconds for the batched steps) and to the cycle's trace.
+    """
+    policy_of = policy_of or [0] * len(rules)
+    results: list[dict[str, Any] | None] = [None] * len(rules)
+    by_id: dict[str, list[int]] = {}
+    for i, r in enumerate(rules):
+        by_id.setdefault(str(r.get("id")), []).append(i)
+    pkg_idx = [i for i, r in enumerate(rules) if r.get("type") == "pkg.ensure"]
+    handlers = handlers_mod.HandlerQueue()
+    files, units, sysctls, plugins = _batched({r.get("type") for r in rules}, handlers)
+    services = [str(r["service"]) for r in rules if r.get("type") == "service.manage" and r.get("service")]
+    if units and services and facts.get("init") == "systemd":
+        units.prefetch(services)
+
+    tails = None
+    if live:
+        tails = lambda rid: capture.LiveTail(lambda stream, text: live(rid, stream, text))
+
+    cache: dict[int, str] = {}
+
+    def finish(i: int, res: dict[str, Any]):
+        if i in cache:
+            res = {**res, "cache": cache[i]}
+        results[i] = res
+        if on_result:
+            on_result(i, res)
+
+    def cached(i: int) -> bool:
+        state = fingerprints.lookup(rules[i]) if fingerprints else None
+        if state:
+            cache[i] = state
+        if state == "hit":
+            finish(i, {"id": rules[i].get("id"), "type": rules[i].get("type"), "status": "pass"})
+        return state == "hit"
+
+    def phase(name: str, fn: Callable[[], Any]) -> Any:
+        with metrics.tracer.span(name), metrics.registry.timer("lpp_phase_seconds", phase=name):
+            return fn()
+
+    def run_pkgs(only: set[int]):
+        skip = {i for i in only if cached(i)}
+        t = time.monotonic()
+        done = phase("pkg", lambda: _plan_pkgs(rules, tails, skip, only))
+        share = (time.monotonic() - t) / max(1, len(done))
+        for i, res in done.items():
+            metrics.registry.observe("lpp_rule_seconds", share, type="pkg.ensure", status=res["status"])
+            finish(i, {"id": rules[i].get("id"), "type": "pkg.ensure", **res, "ms": round(share * 1000, 1)})
+
+    def timed(r: dict[str, Any]) -> dict[str, Any]:
+        t = time.monotonic()
+        with metrics.tracer.span("rule", id=r.get("id"), type=r.get("type")):
+            res = _apply_rule(r, allow_bash, plugins, tails)
+        dt = time.monotonic() - t
+        metrics.registry.observe("lpp_rule_seconds", dt, type=r.get("type"), status=res["status"])
+        return {**res, "ms": round(dt * 1000, 1)}
+
+    def run_one(i: int):
+        r = rules[i]
+        for ref in _as_list(r.get("requires")):
+            if ref not in by_id:
+                finish(i, {"id": r.get("id"), "type": r.get("type"), "status": "error",
+                           "detail": f"requires unknown rule {ref}"})
+                return
+            bad = [j for j in by_id[ref] if (results[j] or {}).get("status") not in ("pass", "fixed")]
+            if bad:
+                finish(i, {"id": r.get("id"), "type": r.get("type"), "status": "skipped",
+                           "detail": f"required rule {ref} did not succeed"})
+                return
+        if cached(i):
+            return
+        if files and r.get("type") in FLUSH_BEFORE:
+            phase("file.commit", files.commit)
+        finish(i, timed(r))
+
+    # phase of each rule: bash rules before it in its policy
+    stage: list[int] = []
+    seen: dict[int, int] = {}
+    for i, r in enumerate(rules):
+        stage.append(seen.get(policy_of[i], 0))
+        if r.get("type") == "bash":
+            seen[policy_of[i]] = stage[i] + 1
+    tasks: list[scheduler.Task] = []
+    node: dict[int, int] = {}
+    pkg_node: dict[int, int] = {}  # phase -> task
+    for k in sorted({stage[i] for i in pkg_idx}):
+        members = {i for i in pkg_idx if stage[i] == k}
+        pkg_node[k] = len(tasks)
+        tasks.append(scheduler.Task(lambda members=members: run_pkgs(members), {"pkg"}))
+        for i in members:
+            node[i] = pkg_node[k]
+            tasks[-1].locks.update(_as_list(rules[i].get("locks")))
+    for k, t in pkg_node.items():  # one transaction after the other
+        if k - 1 in pkg_node:
+            tasks[t].deps.add(pkg_node[k - 1])
+    for i, r in enumerate(rules):
+        if i not in node:
+            node[i] = len(tasks)
+            locks = set(_as_list(r.get("locks")))
+            if r.get("type") == "bash" and not locks:
+                locks.add("pkg")
+            tasks.append(scheduler.Task(lambda i=i: run_one(i), _resources(r) | locks))
+
+    last: dict[str, int] = {}
+    barrier: dict[int, int] = {}
+    since: dict[int, list[int]] = {}
+    for i, r in enumerate(rules):
+        rtype, pol = r.get("type"), policy_of[i]
+        deps = {j for ref in _as_list(r.get("after")) + _as_list(r.get("requires")) for j in by_id.get(ref, ())}
+        if rtype != "pkg.ensure":
+            for key in _resources(r):
+                if key in last:
+                    deps.add(last[key])
+                last[key] = i
+            if rtype == "service.manage":
+                # packages of its phase and before; later ones wait for a bash rule after it
+                deps.update(j for j in pkg_idx if stage[j] <= stage[i])
+            if rtype == "bash":
+                deps.update(since.get(pol, ()))
+                since[pol] = []
+            if pol in barrier:
+                deps.add(barrier[pol])
+            if rtype == "bash":
+                barrier[pol] = i
+        elif pol in barrier:
+            deps.add(barrier[pol])  # its phase's transaction waits for the bash rule before it
+        since.setdefault(pol, []).append(i)
+        tasks[node[i]].deps.update(node[d] for d in deps if node[d] != node[i])
+
+    outs = scheduler.run(tasks, max_workers=max_workers)
+    failed = phase("file.commit", files.commit) if files else {}
+    sysctl_err = phase("sysctl.flush", sysctls.flush) if sysctls else None
+    handler_rc = phase("handlers", handlers.flush)
+    for i, r in enumerate(rules):
+        path = os.path.abspath(str(r.get("file", "")))
+        if str(r.get("type", "")).startswith("file.") and path in failed and results[i] \
+                and results[i]["status"] == "fixed":
+            finish(i, {**results[i], "status": "error", "detail": f"write failed: {failed[path]}"})
+        if sysctl_err and r.get("type") == "sysctl.set" and r.get("persist", True) and results[i] \
+                and results[i]["status"] == "fixed":
+            finish(i, {**results[i], "status": "error", "detail": sysctl_err})
+        if results[i] and results[i]["status"] == "fixed":
+            if r.get("type") == "service.manage":
+                ks = [f"restart {handlers_mod.unit_name(str(r.get('service')))}"]
+            else:
+                ks = handlers_mod.keys(str(r["notify"])) if r.get("notify") else []
+            bad = [k for k in ks if handler_rc.get(k)]
+            if bad:
+                finish(i, {**results[i], "status": "error", "detail": f"handler failed: {bad[0]}"})
+        if results[i] is None:
+            err = outs[node[i]]
+            finish(i, {"id": r.get("id"), "type": r.get("type"), "status": "error",
+                       "detail": str(err) if isinstance(err, Exception) else "not run"})
+    if fingerprints:
+        # inputs as they are now that files, drop-ins and restarts have landed
+        for i, r in enumerate(rules):
+            if cache.get(i) == "miss":
+                if results[i]["status"] in ("pass", "fixed"):
+                    fingerprints.record(r)
+                else:
+                    fingerprints.forget(r)
+        fingerprints.save()
+        if cache:
+            hits = sum(1 for s in cache.values() if s == "hit")
+            log.info("Rule fingerprints: %d hits, %d misses", hits, len(cache) - hits)
+    return results  # type: ignore[return-value]
+
+def _check_rules(rules: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Check rules without changing anything. Package rules share one database
+    snapshot, services one `systemctl show`, file rules one uncommitted
+    transaction (so later rules see earlier edits), sysctl keys are read from
+    /proc/sys. bash rules can't be checked and report "unchecked".
+    """
+    files, units, sysctls, _ = _batched({r.get("type") for r in rules})
+    checks: dict[str, Callable[..., Any]] = {}
+    if files:
+        for rtype in FILE_TYPES:
+            fn = getattr(files, rtype[5:])
+            checks[rtype] = lambda fn=fn, **kws: "drift" if fn(**kws) == "fixed" else "pass"
+    if units:
+        checks["service.manage"] = units.check
+    if sysctls:
+        checks["sysctl.set"] = sysctls.check
+    services = [str(r["service"]) for r in rules if r.get("type") == "service.manage" and r.get("service")]
+    if units and services and facts.get("init") == "systemd":
+        units.prefetch(services)
+    pkg_idx = [i for i, r in enumerate(rules) if r.get("type") == "pkg.ensure"]
+    pkg_status = {}
+    if pkg_idx:
+        from .plugins import pkg
+        per_rule = [_pkg_items(**_params(rules[i])) for i in pkg_idx]
+        flat = iter(pkg.check_many([it for its in per_rule for it in its]))
+        pkg_status = {i: pkg.rollup([next(flat) for _ in its]) for i, its in zip(pkg_idx, per_rule)}
+
+    results = []
+    for i, r in enumerate(rules):
+        res = {"id": r.get("id"), "type": r.get("type")}
+        if i in pkg_status:
+            res["status"] = pkg_status[i]
+        elif r.get("type") == "bash":
+            res["status"] = "unchecked"
+        else:
+            try:
+                fn = checks.get(r["type"]) or registry.checker(r["type"])
+                res["status"] = fn(**_params(r)) if fn else "unchecked"
+            except Exception as e:
+                res.update(status="error", detail=str(e))
+        results.append(res)
+    return results
+
+def apply_policy_yaml(text: str, allow_bash: bool = True, max_workers: int = 1) -> list[dict[str, Any]]:
+    """Apply one policy document; raises plan.PolicyError before running anything if it is invalid."""
+    return _apply_rules(plan.cache.get(text).rules, allow_bash=allow_bash, max_workers=max_workers)
+
+def apply_policies(policies: list[dict[str, Any]], allow_bash: bool = True, max_workers: int = 1,
+                   on_result: Callable[[dict[str, Any]], None] | None = None,
+                   live: Callable[[str, str, str], None] | None = None,
+                   fingerprints: FingerprintStore | None = None) -> list[dict[str, Any]]:
+    """
+    Apply all policies of a run as one rule graph, so package rules from every
+    policy share one transaction and independent rules run in parallel.
+    Results keep rule order and are tagged with their policy_id; on_result
+    receives each tagged result as soon as its rule finishes. A policy that
+    fails to compile runs none of its rules and yields a single error result.
+    """
+    ids, per_policy, rejected = _compile(policies, on_result)
+    return rejected + _run_policies(ids, per_policy, allow_bash, max_workers, on_result, live, fingerprints)
+
+def check_policies(policies: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Drift report for policies: results like apply_policies, but nothing is changed."""
+    ids, per_policy, rejected = _compile(policies, None)
+    results = _check_rules([r for rules in per_policy for r in rules])
+    owners = [pid for pid, rules in zip(ids, per_policy) for _ in rules]
+    return rejected + [{**res, "policy_id": pid} for res, pid in zip(results, owners)]
+
+def _compile(policies: list[dict[str, Any]], on_result: Callable[[dict[str, Any]], None] | None
+             ) -> tuple[list[Any], list[list[dict[str, Any]]], list[dict[str, Any]]]:
+    """(policy ids, rules per policy, error results of policies that failed to compile)."""
+    ids, per_policy, rejected = [], [], []
+    for p in policies:
+        try:
+            per_policy.append(plan.compile_policy(p).rules)
+            ids.append(p.get("id"))
+        except plan.PolicyError as e:
+            log.error("Rejected %s", e)
+            res = {"id": None, "type": "policy", "status": "error", "detail": str(e), "policy_id": p.get("id")}
+            rejected.append(res)
+            if on_result:
+                on_result(res)
+    return ids, per_policy, rejected
+
+def remove_policies(hooks: dict[Any, list[dict[str, Any]]], allow_bash: bool = True, max_workers: int = 1,
+                    on_result: Callable[[dict[str, Any]], None] | None = None,
+                    live: Callable[[str, str, str], None] | None = None) -> list[dict[str, Any]]:
+    """Run the `on_remove:` rules of policies no longer assigned, keyed by policy id."""
+    return _run_policies(list(hooks), list(hooks.values()), allow_bash, max_workers, on_result, live)
+
+def _run_policies(ids: list[Any], per_policy: list[list[dict[str, Any]]], allow_bash: bool,
+                  max_workers: int, on_result: Callable[[dict[str, Any]], None] | None,
+                  live: Callable[[str, str, str], None] | None,
+                  fingerprints: FingerprintStore | None = None) -> list[dict[str, Any]]:
+    flat = [r for rules in per_policy for r in rules]
+    policy_of = [n for n, rules in enumerate(per_policy) for _ in rules]
+    emit = None
+    if on_result:
+        emit = lambda i, res: on_result({**res, "policy_id": ids[policy_of[i]]})
+    results = _apply_rules(flat, allow_bash=allow_bash, max_workers=max_workers,
+                           policy_of=policy_of, on_result=emit, live=live, fingerprints=fingerprints)
+    spent: dict[Any, float] = {}
+    for r, n in zip(results, policy_of):
+        r["policy_id"] = ids[n]
+        spent[ids[n]] = spent.get(ids[n], 0.0) + r.get("ms", 0.0)
+    for pid, ms in spent.items():
+        metrics.registry.set("lpp_policy_last_seconds", ms / 1000, policy=pid)
     return results
@@ -0,0 +1,95 @@
+from __future__ import annotations
+import os, shutil, threading, time
+from pathlib import Path
+from typing import Any, Callable
+
+# order matters; pick a “canonical” manager
+PKG_MANAGERS = ("apt-get", "dnf", "yum", "zypper", "pacman", "apk", "brew")
+
+def _pkg_manager() -> str | None:
+    for pm in PKG_MANAGERS:
+        if shutil.which(pm):
+            return pm
+    return None
+
+def _sudo() -> str | None:
+    try:
+        if os.geteuid() == 0:
+            return None
+    except AttributeError:
+        pass
+    return shutil.which("sudo")
+
+def _os_release() -> dict[str, str]:
+    for p in ("/etc/os-release", "/usr/lib/os-release"):
+        try:
+            text = Path(p).read_text()
+        except OSError:
+            continue
+        out = {}
+        for ln in text.splitlines():
+            k, sep, v = ln.partition("=")
+            if sep and not k.startswith("#"):
+                out[k.strip()] = v.strip().strip("'\"")
+        return out
+    return {}
+
+def _distro() -> str:
+    osr = _os_release()
+    if not osr.get("ID"):
+        return "linux-unknown"
+    return f"{osr['ID']}-{osr.get('VERSION_ID', '')}"
+
+def _init() -> str:
+    if Path("/run/systemd/system").is_dir():
+        return "systemd"
+    try:
+        return Path("/proc/1/comm").read_text().strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def _kernel() -> str:
+    return os.uname().release
+
+GATHER: dict[str, Callable[[], Any]] = {
+    "pkg_manager": _pkg_manager,
+    "sudo": _sudo,
+    "distro": _distro,
+    "init": _init,
+    "kernel": _kernel,
+}
+
+class HostFacts:
+    """
+    Host facts gathered in-process (no shells), cached per fact for `ttl` seconds.
+    Anything that changes the host in a way a fact depends on calls invalidate().
+    """
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self._vals: dict[str, tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Any:
+        with self._lock:
+            hit = self._vals.get(name)
+            if hit and time.monotonic() - hit[0] < self.ttl:
+                return hit[1]
+        val = GATHER[name]()
+        with self._lock:
+            self._vals[name] = (time.monotonic(), val)
+        return val
+
+    def pin(self, name: str, value: Any) -> None:
+        """Fix a fact until it is invalidated (benchmarks, tests)."""
+        with self._lock:
+            self._vals[name] = (float("inf"), value)  # never stale
+
+    def invalidate(self, *names: str) -> None:
+        with self._lock:
+            for n in names or list(self._vals):
+                self._vals.pop(n, None)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {n: self.get(n) for n in GATHER}
+
+facts = HostFacts()
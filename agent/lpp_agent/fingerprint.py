@@ -0,0 +1,135 @@
+from __future__ import annotations
+import glob, hashlib, json, logging, os, threading, time
+from pathlib import Path
+from typing import Any
+
+from . import metrics
+from .config import STATE_DIR
+from .facts import facts
+from .handlers import unit_name
+from .util import atomic_write
+
+log = logging.getLogger(__name__)
+
+STORE_FILE = STATE_DIR/"fingerprints.json"
+MAX_ENTRIES = 10000
+
+# files whose mtime moves whenever the package database changes
+PKG_DB = {
+    "apt-get": ("/var/lib/dpkg/status",),
+    "dnf": ("/var/lib/rpm/rpmdb.sqlite", "/var/lib/rpm/Packages"),
+    "yum": ("/var/lib/rpm/rpmdb.sqlite", "/var/lib/rpm/Packages"),
+    "zypper": ("/var/lib/rpm/rpmdb.sqlite", "/var/lib/rpm/Packages"),
+    "pacman": ("/var/lib/pacman/local",),
+    "apk": ("/lib/apk/db/installed",),
+}
+UNIT_DIRS = ("/etc/systemd/system", "/run/systemd/system", "/usr/lib/systemd/system", "/lib/systemd/system")
+# one symlink per running unit, replaced on every (re)start (systemd >= 236)
+INVOCATIONS = "/run/systemd/units"
+
+# rule keys that don't change what a rule does
+_IGNORED = ("id", "after", "requires", "locks")
+# states that ask for an action every apply rather than describe an end state
+ACTIONS = frozenset({"restarted", "reloaded"})
+
+def _stat(path: str, follow: bool = True) -> str:
+    try:
+        st = os.stat(path, follow_symlinks=follow)
+    except OSError:
+        return "-"
+    return f"{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+
+def inputs(rule: dict[str, Any]) -> list[str] | None:
+    """
+    What the outcome of a rule depends on, without forking; None if it can't
+    be watched, or if the rule is an action (a restart) that has to run every
+    time its policy is applied.
+    """
+    rtype = rule.get("type") or ""
+    if rule.get("state") in ACTIONS:
+        return None
+    if rtype.startswith("file."):
+        return [_stat(os.path.abspath(str(rule.get("file", ""))))]
+    if rtype == "sysctl.set":
+        from .plugins import sysctl
+        param = str(rule.get("param", ""))
+        return [str(sysctl.read(param)), _stat(str(sysctl.DROPIN))]
+    if rtype == "pkg.ensure":
+        paths = PKG_DB.get(facts.get("pkg_manager") or "")
+        return [_stat(p) for p in paths] if paths else None
+    if rtype == "service.manage":
+        if not os.path.isdir(INVOCATIONS):
+            return None  # no way to see restarts/stops without systemctl
+        unit = unit_name(str(rule.get("service", "")))
+        out = [_stat(os.path.join(INVOCATIONS, f"invocation:{unit}"), follow=False)]
+        out += [_stat(os.path.join(d, unit)) for d in UNIT_DIRS]
+        out += [_stat(d) for d in sorted(glob.glob("/etc/systemd/system/*.wants"))]
+        return out
+    return None
+
+def _digest(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+def key(rule: dict[str, Any]) -> str:
+    return _digest({k: v for k, v in rule.items() if k not in _IGNORED})
+
+class FingerprintStore:
+    """
+    Fingerprint of each rule's watched inputs as of its last successful apply.
+    A rule whose params and inputs are unchanged since then can be reported as
+    "pass" without running. Entries expire after `ttl` seconds so drift the
+    inputs can't see is still corrected eventually.
+    """
+    def __init__(self, path: Path = STORE_FILE, ttl: float = 86400):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        try:
+            self._data: dict[str, list[Any]] = json.loads(self.path.read_bytes())
+        except (OSError, ValueError):
+            self._data = {}
+
+    def lookup(self, rule: dict[str, Any]) -> str | None:
+        """"hit" if the rule can be skipped, "miss" if it must run, None if it isn't cacheable."""
+        fp = inputs(rule)
+        if fp is None:
+            return None
+        with self._lock:
+            entry = self._data.get(key(rule))
+            hit = bool(entry) and entry[0] == _digest(fp) and time.time() - entry[1] < self.ttl
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.registry.inc("lpp_fingerprint_total", result="hit" if hit else "miss")
+        return "hit" if hit else "miss"
+
+    def record(self, rule: dict[str, Any]) -> None:
+        """Remember a rule that just converged; call once its changes are on disk."""
+        fp = inputs(rule)
+        if fp is None:
+            return
+        with self._lock:
+            self._data.pop(key(rule), None)
+            self._data[key(rule)] = [_digest(fp), time.time()]
+            while len(self._data) > MAX_ENTRIES:
+                self._data.pop(next(iter(self._data)))
+            self._dirty = True
+
+    def forget(self, rule: dict[str, Any]) -> None:
+        with self._lock:
+            if self._data.pop(key(rule), None) is not None:
+                self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            data, self._dirty = json.dumps(self._data, separators=(",", ":")), False
+        try:
+            atomic_write(self.path, data, mode=0o600)
+        except OSError as e:
+            log.warning("could not save rule fingerprints: %s", e)
@@ -0,0 +1,96 @@
+from __future__ import annotations
+import logging, subprocess, threading
+
+log = logging.getLogger(__name__)
+
+UNIT_SUFFIXES = (".service", ".socket", ".timer", ".target", ".mount", ".path", ".slice", ".scope")
+
+def unit_name(name: str) -> str:
+    return name if name.endswith(UNIT_SUFFIXES) else f"{name}.service"
+
+def parse(cmd: str) -> list[tuple[str, str]] | None:
+    """Map a notify command to [(action, unit), …], or None if it is not a restart/reload."""
+    argv = cmd.split()
+    if len(argv) >= 3 and argv[0].endswith("systemctl") and argv[1] in ("restart", "reload"):
+        return [(argv[1], unit_name(u)) for u in argv[2:] if not u.startswith("-")]
+    if len(argv) == 3 and argv[0].endswith("service") and argv[2] in ("restart", "reload"):
+        return [(argv[2], unit_name(argv[1]))]
+    return None
+
+def keys(cmd: str) -> list[str]:
+    """Keys flush() reports a notify command under."""
+    acts = parse(cmd)
+    return [f"{a} {u}" for a, u in acts] if acts else [cmd]
+
+class HandlerQueue:
+    """
+    Restart/reload requests collected during a run. Requests are deduplicated
+    per unit (a restart covers a reload) and run once, batched, by flush().
+    Commands that aren't unit restarts/reloads are deduplicated verbatim.
+    """
+    def __init__(self):
+        self._units: dict[str, str] = {}
+        self._cmds: list[str] = []
+        self._lock = threading.Lock()
+
+    def notify(self, cmd: str) -> None:
+        acts = parse(cmd)
+        with self._lock:
+            if acts is None:
+                if cmd not in self._cmds:
+                    self._cmds.append(cmd)
+                return
+            for action, unit in acts:
+                if self._units.get(unit) != "restart":
+                    self._units[unit] = action
+
+    def restart(self, unit: str) -> None:
+        self.notify(f"systemctl restart {unit}")
+
+    def reload(self, unit: str) -> None:
+        self.notify(f"systemctl reload {unit}")
+
+    def flush(self) -> dict[str, int]:
+        """Run everything queued; returns {key: returncode}."""
+        with self._lock:
+            units, cmds = self._units, self._cmds
+            self._units, self._cmds = {}, []
+        out: dict[str, int] = {}
+        for action in ("restart", "reload"):
+            batch = [u for u, a in units.items() if a == action]
+            if not batch:
+                continue
+            try:
+                rc = subprocess.call(["systemctl", action, *batch])
+            except OSError:
+                rc = 127  # no systemctl: every unit fails, like a command not found
+            if rc not in (0, 127) and len(batch) > 1:
+                # systemctl went on past the failing units; retry only those
+                # that aren't active, so the rest aren't restarted twice
+                for u, active in zip(batch, _active(batch)):
+                    out[f"{action} {u}"] = 0 if active else _call(["systemctl", action, u])
+            else:
+                out.update({f"{action} {u}": rc for u in batch})
+        for cmd in cmds:
+            out[cmd] = _call(cmd.split())
+        for k, rc in out.items():
+            if rc != 0:
+                log.warning("handler failed: %s (rc=%s)", k, rc)
+        return out
+
+def _call(argv: list[str]) -> int:
+    try:
+        return subprocess.call(argv)
+    except OSError:
+        return 127  # like the shell: command not found
+
+def _active(units: list[str]) -> list[bool]:
+    """`systemctl is-active` per unit, in order; all False if it can't tell."""
+    try:
+        cp = subprocess.run(["systemctl", "is-active", "--", *units], capture_output=True, text=True)
+    except OSError:
+        return [False] * len(units)
+    states = cp.stdout.split()
+    if len(states) != len(units):
+        return [False] * len(units)
+    return [s == "active" for s in states]
@@ -0,0 +1,69 @@
+from __future__ import annotations
+import json, re, sqlite3, sys, time
+from typing import Any
+
+from .store import DB_FILE, Store
+
+# `lpp-agent history`: read-only queries over the run history in the state
+# store. Needs neither the network nor the executor.
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+def since(spec: str | None) -> float:
+    """"7d", "24h", "30m" (or plain seconds) -> a unix timestamp that long ago; 0 for everything."""
+    if not spec:
+        return 0.0
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*", spec)
+    if not m:
+        raise ValueError(f"bad duration {spec!r} (e.g. 30m, 24h, 7d)")
+    return time.time() - float(m.group(1)) * UNITS[m.group(2) or "s"]
+
+def _ts(t: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+
+def _table(rows: list[dict[str, Any]], cols: list[str]) -> None:
+    cells = [[("" if r.get(c) is None else _ts(r[c]) if c == "ts" else str(r[c])) for c in cols] for r in rows]
+    widths = [max([len(c)] + [len(row[i]) for row in cells]) for i, c in enumerate(cols)]
+    print("  ".join(c.upper().ljust(w) for c, w in zip(cols, widths)).rstrip())
+    for row in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+
+def cmd_history(rule: str | None = None, slowest: bool = False, failed: bool = False,
+                since_spec: str | None = None, limit: int = 20, as_json: bool = False) -> int:
+    try:
+        t0 = since(since_spec)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if not DB_FILE.exists():
+        print(f"no history yet ({DB_FILE} does not exist)", file=sys.stderr)
+        return 1
+    try:
+        db = Store(readonly=True)
+        try:
+            if rule:
+                rows = db.rule(rule, limit, t0)
+                cols = ["ts", "run", "mode", "rev", "policy", "status", "ms", "cache", "detail"]
+            elif slowest:
+                rows = db.slowest(limit, t0)
+                cols = ["policy", "rule", "type", "runs", "avg_ms", "max_ms"]
+            elif failed:
+                rows = db.failures(limit, t0)
+                cols = ["ts", "run", "policy", "rule", "type", "status", "detail"]
+            else:
+                rows = db.runs(limit, t0)
+                cols = ["ts", "id", "mode", "rev", "ms", "rules", "failed"]
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        print(f"cannot read {DB_FILE}: {e}", file=sys.stderr)
+        return 1
+    if as_json:
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+    elif rows:
+        for r in rows:
+            if r.get("detail"):
+                r["detail"] = " ".join(str(r["detail"]).split())[:80]
+        _table(rows, cols)
+    return 0
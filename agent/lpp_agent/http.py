@@ -1,18 +1,61 @@
 from __future__ import annotations
-import logging, time
+import logging, re, time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Any, Tuple
 
+from . import metrics
+from .config import USER_AGENT
+from .schedule import hint
+from .util import backoff
+
 log = logging.getLogger(__name__)
 
+LONG_POLL_REPROBE_SEC = 600  # retry long-poll this often against a poll-only server
+_ENDPOINT = re.compile(r"/(effective-policy|heartbeat|output|enroll|ingest)/?$")
+
+def _observe(r: requests.Response, *args, **kwargs) -> None:
+    """Response hook: request latency (up to the headers) by endpoint and status."""
+    m = _ENDPOINT.search(r.request.path_url.partition("?")[0])
+    metrics.registry.observe("lpp_http_request_seconds", r.elapsed.total_seconds(),
+                             endpoint=m.group(1) if m else "other", status=r.status_code)
+
+def session(pool_size: int = 4, retries: int = 3) -> requests.Session:
+    """
+    Keep-alive session sized for the agent's concurrent callers. Idempotent
+    requests are retried on connect errors and 502/503/504, honouring
+    Retry-After; POSTs are left to the outbox's own retry.
+    """
+    s = requests.Session()
+    retry = Retry(total=retries, connect=retries, read=0, backoff_factor=0.5,
+                  status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET", "HEAD"}),
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    s.headers.update({"User-Agent": USER_AGENT})
+    s.hooks["response"].append(_observe)
+    return s
+
 class Api:
-    def __init__(self, api_base: str, jwt: str | None = None, timeout=20):
+    def __init__(self, api_base: str, jwt: str | None = None, timeout=20,
+                 pool_size: int = 4, retries: int = 3):
         self.base = api_base.rstrip("/")
         self.jwt = jwt
         self.timeout = timeout
-        self._session = requests.Session()
         # NB: content-type only where needed (POSTs); GETs can omit
-        self._session.headers.update({"User-Agent": "lpp-agent/0.2.0"})
+        self._session = session(pool_size, retries)
+        # None until the server has answered a long-poll request
+        self.long_poll: bool | None = None
+        # last policy response only held entries changed since the requested rev
+        self.delta = False
+        # seconds the last policy response asked us to wait (Retry-After / X-Next-Poll)
+        self.next_poll: float | None = None
+        self._poll_only_since = 0.0
+
+    def close(self) -> None:
+        self._session.close()
 
     def _h(self) -> dict[str,str]:
         h = {"Content-Type": "application/json"}
@@ -28,7 +71,8 @@ class Api:
         return r.json()
 
     # --- policy fetch with ETag ---
-    def effective_policy_etag(self, agent_id: int | str, etag: str | None) -> Tuple[bool, list[dict[str, Any]], str | None, int | None]:
+    def effective_policy_etag(self, agent_id: int | str, etag: str | None,
+                              since: int | None = None) -> Tuple[bool, list[dict[str, Any]], str | None, int | None]:
         """
         Returns (changed, policies, new_etag, rev)
           - changed=False when server returns 304
@@ -37,12 +81,67 @@ class Api:
         headers = {}
         if etag:
             headers["If-None-Match"] = etag
-        r = self._session.get(u, headers=headers, timeout=self.timeout)
+        params = {"since": since} if since is not None else None
+        r = self._session.get(u, headers=headers, params=params, timeout=self.timeout)
+        return self._policy_response(r)
+
+    def _policy_response(self, r: requests.Response) -> Tuple[bool, list[dict[str, Any]], str | None, int | None]:
+        """
+        A server answering `?since=<rev>` may send {"delta": true, "policies":
+        [changed…], "removed": [ids…]}; removed ids come back as
+        {"id": …, "removed": True} entries and `delta` is set.
+        """
+        self.delta = False
+        self.next_poll = hint(r.headers)
         if r.status_code == 304:
             return False, [], r.headers.get("ETag"), None
         r.raise_for_status()
         data = r.json()
-        return True, data.get("policies", []), r.headers.get("ETag"), data.get("rev")
+        policies = data.get("policies", [])
+        if data.get("delta"):
+            self.delta = True
+            policies = policies + [{"id": pid, "removed": True} for pid in data.get("removed", [])]
+        return True, policies, r.headers.get("ETag"), data.get("rev")
+
+    def watch_policy(self, agent_id: int | str, etag: str | None, wait: int = 55,
+                     retries: int = 3, since: int | None = None) -> Tuple[bool, list[dict[str, Any]], str | None, int | None]:
+        """
+        Long-poll variant of effective_policy_etag. The request carries
+        If-None-Match plus `Prefer: wait=N`; a server that supports it holds the
+        request until the rev changes (answering 200 right away) or N seconds
+        pass (304 with `Preference-Applied: wait=N`). Dropped connections are
+        retried with backoff. A 304 without Preference-Applied marks the server
+        poll-only (long_poll=False) and later calls fall back to a plain
+        conditional GET, re-probing every LONG_POLL_REPROBE_SEC. `since` asks
+        for a delta against that rev; servers that don't know it send everything.
+        """
+        if not wait or (self.long_poll is False
+                        and time.monotonic() - self._poll_only_since < LONG_POLL_REPROBE_SEC):
+            return self.effective_policy_etag(agent_id, etag, since)
+        u = f"{self.base}/agents/{agent_id}/effective-policy"
+        headers = {"Prefer": f"wait={int(wait)}"}
+        if etag:
+            headers["If-None-Match"] = etag
+        params: dict[str, Any] = {"wait": int(wait)}
+        if since is not None:
+            params["since"] = since
+        delay = 0.0
+        for attempt in range(retries + 1):
+            try:
+                r = self._session.get(u, headers=headers, params=params,
+                                      timeout=(self.timeout, wait + self.timeout))
+                break
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == retries:
+                    raise
+                delay = backoff(delay, cap=30)
+                log.debug("long-poll dropped (%s); reconnecting in %.1fs", e, delay)
+                time.sleep(delay)
+        if r.status_code == 304:
+            self.long_poll = "wait" in r.headers.get("Preference-Applied", "")
+            if not self.long_poll:
+                self._poll_only_since = time.monotonic()
+        return self._policy_response(r)
 
     # Back-compat (unused by new loop, but keep if other code calls it)
     def effective_policy(self, agent_id: int | str) -> list[dict[str, Any]]:
@@ -57,10 +156,27 @@ class Api:
         r = self._session.post(u, json=payload, headers=self._h(), timeout=self.timeout)
         r.raise_for_status()
 
+    def post_batch(self, body: bytes, idempotency_key: str) -> None:
+        """POST a gzip-compressed ingest payload; the key lets the server drop replays."""
+        u = f"{self.base}/results/ingest"
+        h = {**self._h(), "Content-Encoding": "gzip", "Idempotency-Key": idempotency_key}
+        r = self._session.post(u, data=body, headers=h, timeout=self.timeout)
+        r.raise_for_status()
+
+    # --- live output of long-running steps ---
+    def post_output(self, agent_id: int | str, rule_id: str, stream: str, text: str) -> None:
+        u = f"{self.base}/agents/{agent_id}/output"
+        r = self._session.post(u, headers=self._h(), timeout=self.timeout,
+                               json={"rule_id": rule_id, "stream": stream, "text": text, "ts": int(time.time())})
+        r.raise_for_status()
+
     # --- heartbeat (optional hook) ---
-    def heartbeat(self, agent_id: int | str) -> None:
+    def heartbeat(self, agent_id: int | str, facts: dict[str, Any] | None = None) -> None:
         try:
             u = f"{self.base}/agents/{agent_id}/heartbeat"
-            self._session.post(u, headers=self._h(), json={"ts": int(time.time())}, timeout=self.timeout)
-        except Exception:
-            pass
+            body: dict[str, Any] = {"ts": int(time.time())}
+            if facts:
+                body["facts"] = facts
+            self._session.post(u, headers=self._h(), json=body, timeout=self.timeout)
+        except Exception as e:
+            log.debug("heartbeat failed: %s", e)
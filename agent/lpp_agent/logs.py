@@ -0,0 +1,157 @@
+from __future__ import annotations
+import atexit, contextlib, contextvars, copy, gzip, json, logging, os, queue, shutil, sys, threading, time, uuid
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Iterator
+
+# Logging calls only format the message and put the record on a queue; one
+# listener thread does the writes, rollovers and compression, so a slow or
+# full disk never stalls an apply.
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+# id of the apply/scan cycle the logging code runs in; the tracer uses it as
+# the trace id, so log lines and spans of one cycle correlate
+cycle_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("lpp_cycle", default=None)
+
+@contextlib.contextmanager
+def cycle() -> Iterator[str]:
+    cid = uuid.uuid4().hex
+    token = cycle_id.set(cid)
+    try:
+        yield cid
+    finally:
+        cycle_id.reset(token)
+
+class RateLimit(logging.Filter):
+    """
+    Lets `burst` warnings/errors with the same message template through per
+    `window` seconds and drops the rest (an outage repeats `loop error: …`
+    for as long as it lasts). The first one let through after a window that
+    dropped some carries the count as `suppressed`.
+    """
+    MAX_KEYS = 512
+
+    def __init__(self, burst: int = 5, window: float = 60):
+        super().__init__()
+        self.burst, self.window = burst, window
+        self._lock = threading.Lock()
+        self._seen: dict[tuple[str, int, str], list[float]] = {}  # key -> [window start, count, dropped]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            s = self._seen.get(key)
+            if s is None or now - s[0] >= self.window:
+                if s and s[2]:
+                    record.suppressed = int(s[2])
+                if s is None and len(self._seen) >= self.MAX_KEYS:
+                    self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+                self._seen[key] = [now, 1, 0]
+                return True
+            s[1] += 1
+            if s[1] <= self.burst:
+                return True
+            s[2] += 1
+            return False
+
+class _Queue(QueueHandler):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not super().filter(record):
+            return False
+        record.cycle = cycle_id.get()  # read here: the listener thread has no context
+        return True
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # like QueueHandler.prepare, but the traceback stays apart from the
+        # message so the JSON formatter can put it in its own field
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        s = super().format(record)
+        n = getattr(record, "suppressed", 0)
+        return f"{s} ({n} similar suppressed)" if n else s
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, plus cycle, suppressed and exc when set."""
+    def format(self, record: logging.LogRecord) -> str:
+        d = {"ts": round(record.created, 3), "level": record.levelname.lower(),
+             "logger": record.name, "msg": record.getMessage()}
+        if getattr(record, "cycle", None):
+            d["cycle"] = record.cycle
+        if getattr(record, "suppressed", 0):
+            d["suppressed"] = record.suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            d["exc"] = record.exc_text
+        return json.dumps(d, ensure_ascii=False, default=str)
+
+def _gzip(source: str, dest: str) -> None:
+    try:
+        with open(source, "rb") as f, gzip.open(dest, "wb", compresslevel=6) as g:
+            shutil.copyfileobj(f, g)
+    except FileNotFoundError:
+        return
+    os.remove(source)
+
+class RotatingFile(RotatingFileHandler):
+    """
+    Rolls over at max_bytes, or on the first record of a new period_sec
+    (aligned to UTC; 86400 = daily), whichever comes first. Rolled files are
+    gzipped to <name>.1.gz … <name>.<backups>.gz.
+    """
+    def __init__(self, path: str | Path, max_bytes: int, backups: int, period_sec: float):
+        super().__init__(path, maxBytes=max_bytes, backupCount=max(1, backups), encoding="utf-8", delay=True)
+        self.period = period_sec
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _gzip
+        try:
+            started = os.stat(self.baseFilename).st_mtime  # a file left by an earlier run belongs to its period
+        except OSError:
+            started = time.time()
+        self._period = self._period_of(started)
+
+    def _period_of(self, t: float) -> int:
+        return int(t // self.period) if self.period > 0 else 0
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self._period_of(record.created) != self._period:
+            self._period = self._period_of(record.created)
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+                return True
+        return bool(super().shouldRollover(record))
+
+_listener: QueueListener | None = None
+
+def setup(path: str | Path, level: int = logging.INFO, fmt: str = "text", max_bytes: int = 16 << 20,
+          backups: int = 7, period_sec: float = 86400, repeat_limit: int = 5) -> None:
+    """Route the root logger through the queue to `path` and stdout. Once per process."""
+    global _listener
+    if _listener is not None:
+        return
+    text = TextFormatter(TEXT_FORMAT)
+    file = RotatingFile(path, max_bytes, backups, period_sec)
+    file.setFormatter(JsonFormatter() if fmt == "json" else text)
+    out = logging.StreamHandler(sys.stdout)  # journald timestamps and levels it; keep it plain text
+    out.setFormatter(text)
+
+    q: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    handler = _Queue(q)
+    if repeat_limit > 0:
+        handler.addFilter(RateLimit(repeat_limit))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    _listener = QueueListener(q, file, out)
+    _listener.start()
+    atexit.register(_listener.stop)  # drains the queue before logging's own shutdown closes the files
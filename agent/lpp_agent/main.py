@@ -1,21 +1,23 @@
 # lpp_agent/main.py
 from __future__ import annotations
-import argparse, logging, time, random
+import logging, threading, time, uuid
 from typing import Any
 
-from .config import load_conf, save_conf, load_state, save_state, setup_logging
-from .util import distro_id, backoff_sleep
+from .config import load_conf, save_conf, setup_logging, state_key
+from .util import distro_id
+from .core import AgentCore
+from .facts import facts
 from .http import Api
-from .exec import apply_policy_yaml
+from .schedule import PollSchedule
+from .exec import apply_policies, check_policies, remove_policies, policy_digest, on_remove_rules
+from . import context, metrics, shell
+from .budget import budget
 
 log = logging.getLogger(__name__)
 
-def _state_key(api: str, agent_id: str) -> str:
-    return f"{api}::{agent_id}"
-
 def cmd_enroll(token: str, api: str) -> int:
     cfg = load_conf()
-    setup_logging()
+    setup_logging(cfg=cfg)
     cfg["api"] = api.rstrip("/")
     a = Api(cfg["api"])
     dist = distro_id()
@@ -26,84 +28,219 @@ def cmd_enroll(token: str, api: str) -> int:
     log.info("Enrolled as agent %s", cfg["agent_id"])
     return 0
 
-def run_once(cfg: dict[str, Any]) -> None:
+class PolicyAgent:
     """
-    One iteration:
-      - GET effective policy using If-None-Match (ETag)
-      - If 304 → heartbeat only
-      - Else apply YAML policies, POST results, heartbeat
-      - Cache ETag so restarts don’t re-apply
+    The YAML-policy agent driven by core.AgentCore: long-polls the effective
+    policy, applies changes, spools results to the outbox and sends them.
+
+    Only policies whose digest changed since they last applied cleanly are run;
+    unassigned ones run their `on_remove:` rules. Every full_reconcile_sec the
+    whole policy set is fetched and applied regardless, sooner when package
+    changes were deferred to a maintenance window. Without long-poll each
+    agent polls in its own slot of interval_sec (see schedule). scan() checks the
+    current policies without changing anything and spools only what drifted;
+    it also retries a failed background prefetch (see pkg.Prefetcher).
     """
-    api = cfg["api"]
-    agent_id = str(cfg["agent_id"])
-    allow_bash = bool(cfg.get("allow_bash", True))
-
-    # restore etag from state
-    st = load_state()
-    key = _state_key(api, agent_id)
-    etag = (st.get("etags") or {}).get(key)
-
-    a = Api(api, cfg.get("jwt"))
-    changed, policies, new_etag, rev = a.effective_policy_etag(agent_id, etag)
-
-    if not changed:
-        a.heartbeat(agent_id)
-        log.debug("No policy change (etag=%s)", etag)
-        return
-
-    log.info("Policy change detected (rev=%s). Applying %d policies…", rev, len(policies))
-
-    all_results: list[dict[str, Any]] = []
-    for p in policies:
-        yml = p.get("yaml", "")
-        res = apply_policy_yaml(yml, allow_bash=allow_bash)
-        for r in res:
-            r["policy_id"] = p.get("id")
-        all_results.extend(res)
-
-    a.post_results({"agent_id": agent_id, "results": all_results, "rev": rev})
-    a.heartbeat(agent_id)
-
-    # persist new etag
-    st.setdefault("etags", {})[key] = new_etag
-    save_state(st)
-    log.info("Applied policies. Stored ETag %s", new_etag)
+    def __init__(self, cfg: dict[str, Any]):
+        self.cfg = cfg
+        self.agent_id = str(cfg["agent_id"])
+        self.ctx = ctx = context.get(cfg)
+        self.api, self.state, self.outbox = ctx.api, ctx.state, ctx.outbox
+        self.fingerprints = ctx.fingerprints
+        self.key = state_key(cfg["api"], self.agent_id)
+        facts.ttl = float(cfg.get("facts_ttl_sec", 3600))
+        # restore etag from state; `etag` moves ahead as soon as a change is
+        # fetched, `applied_etag` only once it has been applied
+        self.applied_etag = self.state.get("etags", self.key)
+        self.etag = self.applied_etag
+        # policy id -> {"digest", "on_remove"} of what is applied on this host
+        self.applied: dict[str, dict[str, Any]] = dict(self.state.get("policies", self.key) or {})
+        self.rev = self.state.get("revs", self.key)
+        self.policies: list[dict[str, Any]] | None = None  # current set, once fetched
+        self.reconcile_sec = float(cfg.get("full_reconcile_sec", 21600))
+        last = self.state.get("reconciled", self.key)
+        if last is None:
+            last = time.time()
+            self.state.set("reconciled", self.key, last)
+        self.next_full = float(last) + self.reconcile_sec
+        self.schedule = PollSchedule(self.agent_id, float(cfg.get("interval_sec", 60)),
+                                     max_interval=float(cfg.get("poll_max_sec", 600)),
+                                     stretch_after=int(cfg.get("poll_stretch_after", 10)))
+
+    def fetch(self) -> tuple[Any | None, float]:
+        if self.reconcile_sec > 0 and time.time() >= self.next_full:
+            _, policies, new_etag, rev = self.api.effective_policy_etag(self.agent_id, None)
+            self.next_full = time.time() + self.reconcile_sec
+            self.etag = new_etag
+            log.info("Full reconcile (rev=%s)", rev)
+            return (policies, rev, new_etag, "full"), 0.0
+        since = self.rev if self.applied else None
+        changed, policies, new_etag, rev = self.api.watch_policy(
+            self.agent_id, self.etag, wait=int(self.cfg.get("long_poll_sec", 55)), since=since)
+        delay = self.schedule.after(changed, self.api.long_poll, self.api.next_poll)
+        if not changed:
+            log.debug("No policy change (etag=%s)", self.etag)
+            return None, delay
+        self.etag = new_etag
+        return (policies, rev, new_etag, "delta" if self.api.delta else "diff"), delay
+
+    def _diff(self, policies: list[dict[str, Any]], mode: str) -> tuple[list[dict[str, Any]], list[str]]:
+        """(policies to apply, ids of policies to remove) against what is applied."""
+        if mode == "delta":
+            removed = [str(p["id"]) for p in policies if p.get("removed") and str(p["id"]) in self.applied]
+            policies = [p for p in policies if not p.get("removed")]
+        else:
+            ids = {str(p.get("id")) for p in policies}
+            removed = [pid for pid in self.applied if pid not in ids]
+        if mode != "full":
+            policies = [p for p in policies
+                        if (self.applied.get(str(p.get("id"))) or {}).get("digest") != policy_digest(p)]
+        return policies, removed
+
+    def apply(self, change: Any) -> None:
+        policies, rev, new_etag, mode = change
+        with metrics.tracer.cycle("apply", rev=rev, mode=mode), \
+                metrics.registry.timer("lpp_apply_seconds", mode=mode):
+            self._apply(policies, rev, new_etag, mode)
+        self.ctx.export()
+
+    def _apply(self, policies: list[dict[str, Any]], rev: Any, new_etag: str | None, mode: str) -> None:
+        todo, removed = self._diff(policies, mode)
+        log.info("Policy change detected (rev=%s, %s). Applying %d of %d policies, removing %d…",
+                 rev, mode, len(todo), len(policies), len(removed))
+        t0 = time.monotonic()
+        run_id = uuid.uuid4().hex[:12]
+        live = None
+        if self.cfg.get("live_output"):
+            live = lambda rid, stream, text: self.api.post_output(self.agent_id, rid, stream, text)
+        opts = dict(allow_bash=bool(self.cfg.get("allow_bash", True)),
+                    max_workers=int(self.cfg.get("max_parallel", 4)),
+                    on_result=lambda r: self.outbox.append(
+                        {**r, "agent_id": self.agent_id, "rev": rev, "run": run_id}),
+                    live=live)
+        try:
+            hooks = {pid: self.applied[pid].get("on_remove") or [] for pid in removed}
+            gone = []
+            if any(hooks.values()):
+                gone = remove_policies({pid: rules for pid, rules in hooks.items() if rules}, **opts)
+            results = apply_policies(todo, fingerprints=self.fingerprints, **opts) if todo else []
+        except Exception:
+            self.etag = self.applied_etag  # fetch it again
+            raise
+        for pid in removed:
+            self.applied.pop(pid, None)
+        if mode == "delta":
+            changed = {str(p.get("id")): p for p in policies if not p.get("removed")}
+            if self.policies is not None:
+                self.policies = [changed.pop(str(p.get("id")), p) for p in self.policies
+                                 if str(p.get("id")) not in removed] + list(changed.values())
+        else:
+            self.policies = list(policies)
+        failed = {str(r.get("policy_id")) for r in results if r.get("status") in ("error", "skipped", "deferred")}
+        for p in todo:
+            pid = str(p.get("id"))
+            # no digest for a failed policy: it is retried on the next change or reconcile
+            self.applied[pid] = {"digest": None if pid in failed else policy_digest(p),
+                                 "on_remove": on_remove_rules(p)}
+        # persist new etag; results are safe in the outbox even if the send fails
+        self.state.set("etags", self.key, new_etag)
+        self.state.set("revs", self.key, rev)
+        self.state.set("policies", self.key, dict(self.applied))
+        if mode == "full":
+            self.state.set("reconciled", self.key, time.time())
+        if self.reconcile_sec > 0 and any(r.get("status") == "deferred" for r in results):
+            # held off by the budget: bring the next full reconcile forward to
+            # when they may run (stored so `lpp-agent once` sees it too)
+            retry = budget.retry_in()
+            self.next_full = min(self.next_full, time.time() + retry)
+            self.state.set("reconciled", self.key, self.next_full - self.reconcile_sec)
+            log.info("Package changes deferred; retrying in %.0fs", retry)
+        self.state.flush()
+        self.ctx.record(run_id, mode, rev, (time.monotonic() - t0) * 1000, gone + results)
+        self.rev = rev
+        self.applied_etag = new_etag
+        log.info("Applied policies. Stored ETag %s", new_etag)
+
+    def scan(self) -> None:
+        if self.policies is None:
+            _, self.policies, _, _ = self.api.effective_policy_etag(self.agent_id, None)
+        t0 = time.monotonic()
+        with metrics.tracer.cycle("scan"):
+            results = check_policies(self.policies)
+        ms = (time.monotonic() - t0) * 1000
+        drift = [r for r in results if r["status"] in ("drift", "error")]
+        run_id = uuid.uuid4().hex[:12]
+        for r in drift:
+            self.outbox.append({**r, "agent_id": self.agent_id, "rev": self.rev, "run": run_id, "mode": "scan"})
+        if drift:  # clean scans would crowd real runs out of the history
+            self.ctx.record(run_id, "scan", self.rev, ms, drift)
+        log.log(logging.WARNING if drift else logging.DEBUG,
+                "Drift scan: %d of %d rules not compliant", len(drift), len(results))
+        from .plugins import pkg
+        pkg.prefetcher.kick()  # retry a failed prefetch of deferred packages
+
+    def heartbeat(self) -> None:
+        self.api.heartbeat(self.agent_id, facts.snapshot())
+
+    def send(self) -> None:
+        self.outbox.drain(self.api.post_batch, force=True)
+        self.state.flush()
+        self.ctx.export()
+
+    def close(self) -> None:
+        self.ctx.close()
+
+def run_once(cfg: dict[str, Any]) -> bool:
+    """
+    One iteration, in sequence:
+      - Drain the outbox (gzip batches, backoff while the server is away)
+      - GET effective policy using If-None-Match (ETag), long-polled when the
+        server supports it
+      - If changed, apply YAML policies, spooling each rule result to the
+        outbox, and send them
+      - Heartbeat; cache ETag so restarts don’t re-apply
+    Returns True when the server held the request open (no need to sleep).
+    The HTTP pool, state and outbox are shared by every call in the process.
+    Its duration goes to lpp_run_once_seconds.
+    """
+    with metrics.registry.timer("lpp_run_once_seconds"):
+        agent = PolicyAgent(cfg)
+        agent.send()
+        change, _ = agent.fetch()
+        if change is not None:
+            agent.apply(change)
+            agent.send()
+        agent.heartbeat()
+    agent.ctx.export()
+    return bool(agent.api.long_poll)
+
+def cmd_plan() -> int:
+    """Show what applying the effective policy would change, without changing it."""
+    cfg = load_conf(); setup_logging(logging.WARNING, cfg)
+    if not cfg.get("agent_id"):
+        log.error("Not enrolled. Run: sudo lpp-agent enroll <TOKEN> <API-with-/api>")
+        return 2
+    _, policies, _, rev = context.get(cfg).api.effective_policy_etag(cfg["agent_id"], None)
+    results = check_policies(policies)
+    for r in results:
+        detail = f"  {r['detail']}" if r.get("detail") else ""
+        print(f"{r['status']:<9} {r.get('policy_id')}/{r.get('id')} ({r.get('type')}){detail}")
+    counts: dict[str, int] = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    print(f"rev {rev}: {len(results)} rules, " + ", ".join(f"{n} {s}" for s, n in sorted(counts.items())))
+    return 1 if counts.get("drift") or counts.get("error") else 0
 
 def cmd_run() -> int:
-    cfg = load_conf(); setup_logging()
+    cfg = load_conf(); setup_logging(cfg=cfg)
     if not cfg.get("agent_id"):
         log.error("Not enrolled. Run: sudo lpp-agent enroll <TOKEN> <API-with-/api>")
         return 2
-
-    attempt = 0
-    base_interval = int(cfg.get("interval_sec", 60))
-    while True:
-        try:
-            run_once(cfg)
-            attempt = 0
-            time.sleep(base_interval + random.uniform(0, 5))  # small jitter
-        except Exception as e:
-            log.error("loop error: %s", e)
-            attempt += 1
-            backoff_sleep(attempt, cap=int(cfg.get("max_backoff_sec", 600)))
-            continue
-
-def cli(argv: list[str] | None = None) -> int:
-    parser = argparse.ArgumentParser(prog="lpp-agent")
-    sub = parser.add_subparsers(dest="cmd", required=True)
-
-    p_enr = sub.add_parser("enroll", help="Enroll device")
-    p_enr.add_argument("token", help="enr_… token")
-    p_enr.add_argument("api", help="API base (include /api), e.g. http://host:3000/api")
-
-    sub.add_parser("run", help="Run agent loop")
-
-    args = parser.parse_args(argv)
-    if args.cmd == "enroll":
-        return cmd_enroll(args.token, args.api)
-    if args.cmd == "run":
-        return cmd_run()
-    return 0
-
-if __name__ == "__main__":
-    raise SystemExit(cli())
+    core = AgentCore(PolicyAgent(cfg), heartbeat_sec=float(cfg.get("heartbeat_sec", 30)),
+                     send_sec=float(cfg.get("send_sec", 10)),
+                     max_backoff_sec=float(cfg.get("max_backoff_sec", 600)),
+                     scan_sec=float(cfg.get("drift_scan_sec", 300)))
+    if cfg.get("allow_bash", True):
+        # environment snapshot and idle shells ready before the first bash rule
+        threading.Thread(target=shell.pool.warm, name="lpp-shell-warm", daemon=True).start()
+    return core.run()
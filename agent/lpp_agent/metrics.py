@@ -0,0 +1,251 @@
+from __future__ import annotations
+import bisect, collections, contextlib, contextvars, json, logging, os, sys, threading, time, uuid
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from socketserver import ThreadingUnixStreamServer
+from typing import Any, Callable, Iterator
+
+from . import logs
+from .util import atomic_write
+
+log = logging.getLogger(__name__)
+
+# seconds; spans a fast HTTP call up to a package transaction
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# name -> (type, help); anything else is exported untyped
+METRICS = {
+    "lpp_run_once_seconds": ("histogram", "One `run_once` iteration: send, fetch, apply, heartbeat."),
+    "lpp_apply_seconds": ("histogram", "Applying one policy change, by mode (delta, diff, full)."),
+    "lpp_rule_seconds": ("histogram", "Running one rule, by plugin type and result status."),
+    "lpp_phase_seconds": ("histogram", "End-of-run flushes and batched steps of an apply, by phase."),
+    "lpp_policy_last_seconds": ("gauge", "Rule time of each policy in its last apply."),
+    "lpp_http_request_seconds": ("histogram", "Control-plane requests, by endpoint and status (long-polls include the wait)."),
+    "lpp_exec_overhead_seconds": ("histogram", "Time to get a shell for a bash rule, by executor (worker, spawn)."),
+    "lpp_forks_total": ("counter", "Processes started by the agent, by audit event."),
+    "lpp_fingerprint_total": ("counter", "Rule fingerprint lookups, by result (hit, miss)."),
+    "lpp_outbox_bytes": ("gauge", "Result bytes spooled and not yet accepted by the server."),
+    "lpp_outbox_send_failures_total": ("counter", "Failed result batch sends."),
+    "lpp_outbox_dead_letters_total": ("counter", "Result batches the server rejected for good, moved to dead/."),
+}
+
+FORK_EVENTS = frozenset({"subprocess.Popen", "os.fork", "os.forkpty", "os.posix_spawn", "os.spawn", "os.exec"})
+
+Labels = tuple[tuple[str, str], ...]
+
+def _key(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _fmt(labels: Labels, extra: tuple[str, str] | None = None) -> str:
+    items = labels + ((extra,) if extra else ())
+    if not items:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+class Registry:
+    """
+    In-process counters, gauges and histograms, rendered in the Prometheus
+    text format. Collectors run at render time to refresh gauges whose value
+    lives elsewhere (outbox depth…).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: dict[str, dict[Labels, float]] = {}
+        self._hists: dict[str, dict[Labels, list[Any]]] = {}  # [bucket counts, sum, count]
+        self._collectors: list[Callable[[], None]] = []
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        k = _key(labels)
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[k] = series.get(k, 0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values.setdefault(name, {})[_key(labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        k = _key(labels)
+        with self._lock:
+            h = self._hists.setdefault(name, {}).get(k)
+            if h is None:
+                h = self._hists[name][k] = [[0] * len(BUCKETS), 0.0, 0]
+            i = bisect.bisect_left(BUCKETS, seconds)
+            if i < len(BUCKETS):
+                h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        t = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - t, **labels)
+
+    def collector(self, fn: Callable[[], None]) -> None:
+        with self._lock:
+            self._collectors.append(fn)
+
+    def render(self) -> str:
+        for fn in list(self._collectors):
+            try:
+                fn()
+            except Exception as e:
+                log.debug("metrics collector failed: %s", e)
+        out: list[str] = []
+        with self._lock:
+            for name in sorted(set(self._values) | set(self._hists)):
+                kind, text = METRICS.get(name, ("untyped", ""))
+                if text:
+                    out.append(f"# HELP {name} {text}")
+                out.append(f"# TYPE {name} {kind}")
+                for labels, v in sorted(self._values.get(name, {}).items()):
+                    out.append(f"{name}{_fmt(labels)} {v:g}")
+                for labels, (counts, total, n) in sorted(self._hists.get(name, {}).items()):
+                    cum = 0
+                    for le, c in zip(BUCKETS, counts):
+                        cum += c
+                        out.append(f"{name}_bucket{_fmt(labels, ('le', f'{le:g}'))} {cum}")
+                    out.append(f"{name}_bucket{_fmt(labels, ('le', '+Inf'))} {n}")
+                    out.append(f"{name}_sum{_fmt(labels)} {total:.6f}")
+                    out.append(f"{name}_count{_fmt(labels)} {n}")
+        return "\n".join(out) + "\n"
+
+    def write_textfile(self, path: str | Path) -> None:
+        """For node_exporter's textfile collector: replaced atomically so a scrape never sees half a file."""
+        try:
+            atomic_write(path, self.render())
+        except OSError as e:
+            log.warning("could not write metrics to %s: %s", path, e)
+
+class Tracer:
+    """
+    Spans per apply cycle. cycle() opens the root span; span() inside it
+    records a child (the parent is the enclosing span on this thread, else the
+    root, so rules on pool threads hang off the cycle). When the cycle ends
+    its spans go to `path` as JSON lines and the last few cycles are kept for
+    the socket's /trace; the trace id is the cycle id on its log lines. Disabled (no-op spans) until enabled.
+    """
+    MAX_FILE_BYTES = 16 << 20
+
+    def __init__(self):
+        self.enabled = False
+        self.path: Path | None = None
+        self.recent: collections.deque[list[dict[str, Any]]] = collections.deque(maxlen=8)
+        self._lock = threading.Lock()
+        self._spans: list[dict[str, Any]] = []
+        self._root: dict[str, Any] | None = None
+        self._current: contextvars.ContextVar[dict[str, Any] | None] = contextvars.ContextVar("lpp_span", default=None)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[dict[str, Any] | None]:
+        root = self._root
+        if not self.enabled or root is None:
+            yield None
+            return
+        parent = self._current.get() or root
+        s = {"trace": root["trace"], "span": uuid.uuid4().hex[:16], "parent": parent["span"],
+             "name": name, "start": time.time(), "attrs": attrs}
+        token = self._current.set(s)
+        t = time.monotonic()
+        try:
+            yield s
+        finally:
+            s["ms"] = round((time.monotonic() - t) * 1000, 3)
+            self._current.reset(token)
+            with self._lock:
+                self._spans.append(s)
+
+    @contextlib.contextmanager
+    def cycle(self, name: str, **attrs: Any) -> Iterator[None]:
+        with logs.cycle() as trace:  # log lines of the cycle carry its trace id, traced or not
+            if not self.enabled:
+                yield
+                return
+            root = {"trace": trace, "span": uuid.uuid4().hex[:16], "parent": None,
+                    "name": name, "start": time.time(), "attrs": attrs}
+            with self._lock:
+                self._root, self._spans = root, []
+            token = self._current.set(root)
+            t = time.monotonic()
+            try:
+                yield
+            finally:
+                root["ms"] = round((time.monotonic() - t) * 1000, 3)
+                self._current.reset(token)
+                with self._lock:
+                    spans, self._spans, self._root = [root] + self._spans, [], None
+                self.recent.append(spans)
+                self._export(spans)
+
+    def _export(self, spans: list[dict[str, Any]]) -> None:
+        if not self.path:
+            return
+        try:
+            if self.path.exists() and self.path.stat().st_size > self.MAX_FILE_BYTES:
+                os.replace(self.path, self.path.with_name(self.path.name + ".1"))
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(s, separators=(",", ":"), default=str) + "\n" for s in spans))
+        except OSError as e:
+            log.warning("could not write trace to %s: %s", self.path, e)
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self) -> str:
+        return "unix"
+
+    def do_GET(self):
+        path = self.path.partition("?")[0]
+        if path == "/metrics":
+            body, ctype = registry.render().encode(), "text/plain; version=0.0.4"
+        elif path == "/trace":
+            body, ctype = json.dumps(list(tracer.recent), default=str).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsServer(ThreadingUnixStreamServer):
+    """GET /metrics (Prometheus text) and /trace (recent cycles) on a unix socket."""
+    daemon_threads = True
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.unlink(missing_ok=True)  # left over from a previous run
+        super().__init__(str(self.path), _Handler)
+        os.chmod(self.path, 0o660)
+        threading.Thread(target=self.serve_forever, name="lpp-metrics", daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        self.path.unlink(missing_ok=True)
+
+_counting_forks = False
+
+def count_forks() -> None:
+    """Count process starts into lpp_forks_total. Audit hooks can't be removed; installs once."""
+    global _counting_forks
+    if _counting_forks:
+        return
+    _counting_forks = True
+
+    def audit(event: str, args: Any) -> None:
+        if event in FORK_EVENTS:
+            registry.inc("lpp_forks_total", event=event)
+    sys.addaudithook(audit)
+
+registry = Registry()
+tracer = Tracer()
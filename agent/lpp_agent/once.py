@@ -0,0 +1,86 @@
+from __future__ import annotations
+import json, logging, os, time
+
+from .config import OUTBOX_DIR, USER_AGENT, load_conf, setup_logging, state_key
+
+log = logging.getLogger(__name__)
+
+# `lpp-agent once`: one iteration for hosts that run the agent from a systemd
+# timer. The common case, nothing changed since the last clean apply, is
+# answered by a conditional GET over http.client plus a heartbeat on the same
+# connection; nothing else is imported and nothing is written. Anything else
+# (a change, results waiting in the outbox, a full reconcile due, any error)
+# falls through to main.run_once.
+
+def _pending_results() -> bool:
+    try:
+        return any(e.is_file() and e.stat().st_size for e in os.scandir(OUTBOX_DIR))
+    except OSError:
+        return False
+
+def _unchanged(cfg: dict) -> bool:
+    """True when the server answered 304 to the etag of the last clean apply."""
+    agent_id = str(cfg["agent_id"])
+    key = state_key(cfg["api"], agent_id)
+    import sqlite3
+    from .store import Store
+    try:
+        db = Store(readonly=True)  # no store yet (or state.json still to migrate): take the full path
+        try:
+            etag, last = db.get("etags", key), db.get("reconciled", key)
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return False
+    if not etag:
+        return False
+    reconcile = float(cfg.get("full_reconcile_sec", 21600))
+    if reconcile > 0 and (last is None or time.time() >= float(last) + reconcile):
+        return False
+    if _pending_results():
+        return False
+
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib.parse import urlsplit
+    u = urlsplit(cfg["api"])
+    conn = (HTTPSConnection if u.scheme == "https" else HTTPConnection)(u.hostname, u.port, timeout=20)
+    base = u.path.rstrip("/")
+    try:
+        conn.request("GET", f"{base}/agents/{agent_id}/effective-policy",
+                     headers={"If-None-Match": etag, "User-Agent": USER_AGENT})
+        r = conn.getresponse()
+        r.read()
+        if r.status != 304:
+            return False
+        from .facts import facts
+        h = {"Content-Type": "application/json", "User-Agent": USER_AGENT}
+        if cfg.get("jwt"):
+            h["Authorization"] = f"Bearer {cfg['jwt']}"
+        body = json.dumps({"ts": int(time.time()), "facts": facts.snapshot()})
+        try:
+            conn.request("POST", f"{base}/agents/{agent_id}/heartbeat", body=body, headers=h)
+            conn.getresponse().read()
+        except (OSError, HTTPException):
+            pass  # best effort, like Api.heartbeat
+        return True
+    except (OSError, HTTPException):
+        return False  # let the full path retry and report it
+    finally:
+        conn.close()
+
+def cmd_once() -> int:
+    cfg = load_conf()
+    if cfg.get("agent_id") and _unchanged(cfg):
+        return 0
+    setup_logging(cfg=cfg)
+    if not cfg.get("agent_id"):
+        log.error("Not enrolled. Run: sudo lpp-agent enroll <TOKEN> <API-with-/api>")
+        return 2
+    from .main import run_once
+    try:
+        # a timer run must not hang on the server, nor on downloads for a later window
+        run_once({**cfg, "long_poll_sec": 0, "pkg_prefetch": False})
+    except Exception:
+        log.exception("Iteration failed")
+        return 1
+    return 0
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import gzip, json, logging, os, threading, time
+from pathlib import Path
+from typing import Any, Callable
+
+from . import metrics
+from .config import OUTBOX_DIR
+from .schedule import Backoff, error_hint
+
+log = logging.getLogger(__name__)
+
+CURRENT = "current.jsonl"
+DEAD = "dead"     # batches the server rejected for good, kept for inspection
+DEAD_KEEP = 32    # newest dead batches kept
+# client errors about the batch itself; retrying the same body can't succeed
+# (401/403/404/408/409/425/429 and 5xx are about the server or the agent, and retried)
+TERMINAL = {400, 410, 413, 415, 422}
+
+class Outbox:
+    """
+    Durable spool for result records. append() adds one JSON line to the
+    current segment; a segment is sealed once it holds batch_bytes or its first
+    record is batch_age seconds old. drain() posts sealed segments oldest first
+    as gzip batches, keyed by segment name so a retried batch is idempotent,
+    and deletes them once the server accepted them. Failed sends back off
+    with decorrelated jitter, at least as long as the server's Retry-After;
+    a batch the server rejects for good (a TERMINAL status) is moved to dead/
+    and the drain goes on with the next one. The spool never grows past
+    max_bytes; the oldest segments are dropped first.
+    """
+    def __init__(self, path: Path = OUTBOX_DIR, max_bytes: int = 64 << 20,
+                 batch_bytes: int = 256 << 10, batch_age: float = 5.0,
+                 backoff_cap: float = 600.0):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.batch_bytes = batch_bytes
+        self.batch_age = batch_age
+        self.failures = 0
+        self.backoff = Backoff(cap=backoff_cap)
+        self.next_try = 0.0
+        self._first_at: float | None = None
+        self._lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _cur(self) -> Path:
+        return self.path/CURRENT
+
+    def append(self, record: dict[str, Any]) -> None:
+        line = (json.dumps(record, separators=(",", ":"), default=str) + "\n").encode()
+        with self._lock:
+            with open(self._cur(), "ab") as f:
+                f.write(line)
+                size = f.tell()
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            if size >= self.batch_bytes:
+                self._seal()
+            self._enforce_cap()
+
+    def _seal(self) -> None:
+        cur = self._cur()
+        if cur.exists() and cur.stat().st_size:
+            seg = self.path/f"seg-{time.time_ns()}-{os.getpid()}.jsonl"
+            with open(cur, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(cur, seg)
+        self._first_at = None
+
+    def _segments(self) -> list[Path]:
+        return sorted(self.path.glob("seg-*.jsonl"))
+
+    def _enforce_cap(self) -> None:
+        segs = self._segments()
+        total = sum(p.stat().st_size for p in segs)
+        if self._cur().exists():
+            total += self._cur().stat().st_size
+        dropped = 0
+        while segs and total > self.max_bytes:
+            p = segs.pop(0)
+            total -= p.stat().st_size
+            p.unlink(missing_ok=True)
+            dropped += 1
+        if dropped:
+            log.warning("outbox over %d bytes; dropped %d oldest batches", self.max_bytes, dropped)
+
+    def depth(self) -> int:
+        """Bytes waiting to be sent."""
+        with self._lock:
+            files = self._segments() + ([self._cur()] if self._cur().exists() else [])
+            return sum(p.stat().st_size for p in files)
+
+    def drain(self, send: Callable[[bytes, str], None], force: bool = False) -> int:
+        """
+        Send sealed batches via send(gzip_body, idempotency_key). force seals the
+        current segment regardless of its age. Returns the number of batches sent.
+        """
+        with self._lock:
+            if force or self._first_at is None or time.monotonic() - self._first_at >= self.batch_age:
+                self._seal()
+            segs = self._segments()
+        if not segs or time.monotonic() < self.next_try:
+            return 0
+        sent = 0
+        for seg in segs:
+            try:
+                records = [json.loads(ln) for ln in seg.read_bytes().splitlines() if ln.strip()]
+            except (OSError, ValueError) as e:
+                log.warning("outbox: dropping unreadable batch %s: %s", seg.name, e)
+                seg.unlink(missing_ok=True)
+                continue
+            body = gzip.compress(json.dumps(_payload(records), separators=(",", ":")).encode())
+            try:
+                send(body, seg.stem)
+            except Exception as e:
+                if _status(e) in TERMINAL:
+                    self._bury(seg, e)
+                    continue
+                self.failures += 1
+                metrics.registry.inc("lpp_outbox_send_failures_total")
+                delay = self.backoff.next(error_hint(e))
+                self.next_try = time.monotonic() + delay
+                log.warning("outbox: send failed (%s); %d batches pending, retry in %.0fs",
+                            e, len(segs) - sent, delay)
+                break
+            seg.unlink(missing_ok=True)
+            self.failures = 0
+            self.backoff.reset()
+            sent += 1
+        return sent
+
+    def _bury(self, seg: Path, e: BaseException) -> None:
+        dead = self.path/DEAD
+        dead.mkdir(exist_ok=True)
+        os.replace(seg, dead/seg.name)
+        for old in sorted(dead.glob("seg-*.jsonl"))[:-DEAD_KEEP]:
+            old.unlink(missing_ok=True)
+        metrics.registry.inc("lpp_outbox_dead_letters_total")
+        log.error("outbox: server rejected batch %s (%s); moved to %s", seg.name, e, dead)
+
+def _status(e: BaseException) -> int | None:
+    """HTTP status of the response an exception carries (requests.HTTPError), if any."""
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _payload(records: list[dict[str, Any]]) -> dict[str, Any]:
+    revs = [r["rev"] for r in records if r.get("rev") is not None]
+    return {
+        "agent_id": next((r["agent_id"] for r in records if r.get("agent_id")), None),
+        "results": records,
+        "rev": max(revs) if revs else None,
+    }
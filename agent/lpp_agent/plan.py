@@ -0,0 +1,165 @@
+from __future__ import annotations
+import hashlib, json, logging, threading
+from pathlib import Path
+from typing import Any
+import yaml
+
+from . import registry
+from .config import STATE_DIR
+from .util import atomic_write
+
+log = logging.getLogger(__name__)
+
+PLAN_DIR = STATE_DIR/"plans"
+PLAN_VERSION = 1    # bump when validation or the plan layout changes
+MAX_PLANS = 256     # compiled plans kept in memory and on disk
+
+# libyaml when PyYAML was built with it, the pure-Python loader otherwise
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# rule types exec runs itself; the rest come from plugins (see registry)
+BUILTIN_SCHEMAS: dict[str, dict[str, Any]] = {"bash": {"code": str}}
+
+# rule keys the scheduler reads (see exec.RESERVED); string or list of strings
+REFS = ("after", "requires", "locks")
+
+class PolicyError(ValueError):
+    """A policy that can't be applied as written; raised before any of its rules run."""
+
+class Plan:
+    """A parsed, validated policy: rules ready for exec plus its on_remove rules."""
+    __slots__ = ("digest", "rules", "on_remove")
+
+    def __init__(self, digest: str, rules: list[dict[str, Any]], on_remove: list[dict[str, Any]]):
+        self.digest, self.rules, self.on_remove = digest, rules, on_remove
+
+def _type_ok(v: Any, spec: Any) -> bool:
+    if isinstance(spec, tuple) and spec and isinstance(spec[0], str):
+        return v in spec
+    types = spec if isinstance(spec, tuple) else (spec,)
+    if isinstance(v, bool) and bool not in types:
+        return False  # `yes`/`no` in YAML; the value must be quoted
+    return isinstance(v, types)
+
+def _describe(spec: Any) -> str:
+    if isinstance(spec, tuple) and spec and isinstance(spec[0], str):
+        return "one of " + "|".join(spec)
+    return "/".join(t.__name__ for t in (spec if isinstance(spec, tuple) else (spec,)))
+
+def _rule(r: Any, where: str) -> dict[str, Any]:
+    if not isinstance(r, dict):
+        raise PolicyError(f"{where}: expected a mapping, got {type(r).__name__}")
+    if "id" in r:
+        where = f"{where} ({r['id']})"
+    rtype = r.get("type")
+    schema = (BUILTIN_SCHEMAS.get(rtype) or registry.schema(rtype)) if isinstance(rtype, str) else None
+    if schema is None:
+        raise PolicyError(f"{where}: unknown rule type {rtype!r}")
+    out: dict[str, Any] = {"type": rtype}
+    if "id" in r:
+        if not isinstance(r["id"], (str, int)) or isinstance(r["id"], bool):
+            raise PolicyError(f"{where}: id must be a string")
+        out["id"] = str(r["id"])
+    for key in REFS:
+        if key in r:
+            v = r[key]
+            refs = v if isinstance(v, list) else [v]
+            if not all(isinstance(x, (str, int)) and not isinstance(x, bool) for x in refs):
+                raise PolicyError(f"{where}: {key} must be a rule id or a list of them")
+            out[key] = [str(x) for x in refs]
+    params = {k: v for k, v in r.items() if k not in ("id", "type", *REFS)}
+    for name, spec in schema.items():
+        key = name.rstrip("?")
+        if key not in params:
+            if not name.endswith("?"):
+                raise PolicyError(f"{where}: {rtype} needs `{key}`")
+            continue
+        if not _type_ok(params[key], spec):
+            raise PolicyError(f"{where}: `{key}` must be {_describe(spec)}, got {params[key]!r}")
+        out[key] = params[key]
+    unknown = sorted(set(params) - {n.rstrip("?") for n in schema})
+    if unknown:
+        raise PolicyError(f"{where}: unknown parameter `{unknown[0]}` for {rtype}")
+    return out
+
+def _section(doc: dict[str, Any], name: str) -> list[dict[str, Any]]:
+    rules = doc.get(name) or []
+    if not isinstance(rules, list):
+        raise PolicyError(f"`{name}` must be a list of rules")
+    return [_rule(r, f"{name}[{n}]") for n, r in enumerate(rules)]
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(f"{PLAN_VERSION}\0{text}".encode()).hexdigest()
+
+def compile_text(text: str) -> Plan:
+    """Parse and validate one policy document. Raises PolicyError."""
+    try:
+        doc = yaml.load(text, Loader=Loader) if text.strip() else {}
+    except yaml.YAMLError as e:
+        raise PolicyError(f"invalid YAML: {e}") from None
+    doc = doc or {}
+    if not isinstance(doc, dict):
+        raise PolicyError(f"expected a mapping at the top level, got {type(doc).__name__}")
+    return Plan(_digest(text), _section(doc, "rules"), _section(doc, "on_remove"))
+
+class PlanCache:
+    """
+    Compiled plans by content hash, in memory and as JSON under PLAN_DIR, so
+    an unchanged policy is never parsed again, not even after a restart.
+    Rejections are remembered in memory and re-raised without re-parsing.
+    """
+    def __init__(self, path: Path = PLAN_DIR, size: int = MAX_PLANS):
+        self.path = Path(path)
+        self.size = size
+        self._mem: dict[str, Plan | PolicyError] = {}
+        self._lock = threading.Lock()
+
+    def get(self, text: str) -> Plan:
+        digest = _digest(text)
+        with self._lock:
+            hit = self._mem.get(digest)
+        if hit is None:
+            hit = self._load(digest)
+        if hit is None:
+            try:
+                hit = compile_text(text)
+                self._store(hit)
+            except PolicyError as e:
+                hit = e
+        with self._lock:
+            self._mem[digest] = hit
+            while len(self._mem) > self.size:
+                self._mem.pop(next(iter(self._mem)))
+        if isinstance(hit, PolicyError):
+            raise hit
+        return hit
+
+    def _load(self, digest: str) -> Plan | None:
+        try:
+            data = json.loads((self.path/f"{digest}.json").read_bytes())
+            return Plan(digest, data["rules"], data["on_remove"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            log.debug("plan cache: recompiling %s: %s", digest[:12], e)
+            return None
+
+    def _store(self, plan: Plan) -> None:
+        try:
+            atomic_write(self.path/f"{plan.digest}.json",
+                         json.dumps({"rules": plan.rules, "on_remove": plan.on_remove},
+                                    separators=(",", ":"), default=str), mode=0o600)
+            files = sorted(self.path.glob("*.json"), key=lambda p: p.stat().st_mtime)
+            for p in files[:max(0, len(files) - self.size)]:
+                p.unlink(missing_ok=True)
+        except OSError as e:
+            log.debug("plan cache: could not store %s: %s", plan.digest[:12], e)
+
+cache = PlanCache()
+
+def compile_policy(policy: dict[str, Any]) -> Plan:
+    """The plan for one effective-policy entry; PolicyError names the policy."""
+    try:
+        return cache.get(policy.get("yaml") or "")
+    except PolicyError as e:
+        raise PolicyError(f"policy {policy.get('id')}: {e}") from None
@@ -1,34 +1,188 @@
 from __future__ import annotations
+from collections import Counter
 from pathlib import Path
-import re
+import hashlib, os, re, threading
+from ..handlers import HandlerQueue
+from ..util import atomic_write
+
+_KEY = re.compile(r"\s*(\S+)\s")
+
+# rule parameters -> accepted types (or allowed values); "?" marks optional ones
+SCHEMA = {
+    "file.replace_kv": {"file": str, "key": str, "value": (str, int, float), "notify?": str},
+    "file.kv_set": {"file": str, "values": dict, "notify?": str},
+    "file.ensure_lines": {"file": str, "present": list, "notify?": str},
+}
+
+class _Doc:
+    """One file held in memory: its lines plus a key -> line positions index."""
+    def __init__(self, path: Path):
+        raw = path.read_bytes() if path.exists() else b""
+        self.path = path
+        self.digest = hashlib.sha256(raw).hexdigest()
+        # split on "\n" only, and keep the file's line ending and final newline
+        # (or lack of one), so a file no rule changed renders to the same bytes
+        lines = raw.decode(errors="surrogateescape").split("\n")
+        self.final_nl = lines[-1] == ""
+        if self.final_nl:
+            lines.pop()
+        ended = lines if self.final_nl else lines[:-1]
+        self.eol = "\r\n" if ended and all(ln.endswith("\r") for ln in ended) else "\n"
+        if self.eol == "\r\n":
+            lines = [ln[:-1] for ln in ended] + lines[len(ended):]
+        self.lines = lines
+        self.dirty = False
+        self.keys: dict[str, list[int]] = {}
+        self.members = Counter(self.lines)
+        self.notify: list[str] = []
+        for n, ln in enumerate(self.lines):
+            self._index(n, ln)
+
+    def _index(self, n: int, ln: str) -> None:
+        m = _KEY.match(ln)
+        if m:
+            self.keys.setdefault(m.group(1), []).append(n)
+
+    def append(self, ln: str) -> None:
+        self.dirty = True
+        self.lines.append(ln)
+        self.members[ln] += 1
+        self._index(len(self.lines) - 1, ln)
+
+    def set_kv(self, key: str, value) -> bool:
+        new = f"{key} {value}"
+        if any(c.isspace() for c in key):
+            key_re = re.compile(rf"^\s*{re.escape(key)}\s+.*$")
+            pos = [n for n, ln in enumerate(self.lines) if key_re.match(ln)]
+        else:
+            pos = [n for n in self.keys.get(key, ()) if _KEY.match(self.lines[n]).group(1) == key]
+        if not pos:
+            self.append(new)
+            return True
+        changed = False
+        for n in pos:
+            if self.lines[n] != new:
+                self.members[self.lines[n]] -= 1
+                self.members[new] += 1
+                self.lines[n] = new
+                changed = self.dirty = True
+        return changed
+
+    def render(self) -> bytes:
+        if not self.lines:
+            return b""
+        return (self.eol.join(self.lines) + (self.eol if self.final_nl else "")).encode(errors="surrogateescape")
+
+class Transaction:
+    """
+    File edits for one run. Every target file is read once, all rules for it are
+    applied in memory, and commit() writes each changed file once, atomically,
+    then queues its notify commands on the run's handler queue. Files no rule
+    changed, or whose content hash is unchanged, are left alone. commit() also
+    forgets the files it wrote, so a rule after it (e.g. after a bash rule
+    that rewrote the file) reads the file afresh. Nothing touches the disk
+    before commit(), so an uncommitted transaction is a dry run.
+    """
+    def __init__(self, handlers: HandlerQueue | None = None):
+        self.handlers = handlers or HandlerQueue()
+        self._docs: dict[str, _Doc] = {}
+        self._lock = threading.RLock()
+        self.errors: dict[str, str] = {}
+
+    def _status(self, file: str, notify: str | None, changed: bool) -> str:
+        if changed and notify and notify not in self._docs[file].notify:
+            self._docs[file].notify.append(notify)
+        return "fixed" if changed else "pass"
+
+    def _load(self, file: str) -> str:
+        path = os.path.abspath(file)
+        if path not in self._docs:
+            self._docs[path] = _Doc(Path(path))
+        return path
+
+    def replace_kv(self, file: str, key: str, value: str, notify: str | None = None):
+        with self._lock:
+            path = self._load(file)
+            return self._status(path, notify, self._docs[path].set_kv(key, value))
+
+    def kv_set(self, file: str, values: dict, notify: str | None = None):
+        if not isinstance(values, dict):
+            raise TypeError("values must be a mapping of key to value")
+        with self._lock:
+            path = self._load(file)
+            doc = self._docs[path]
+            changed = False
+            for k, v in values.items():
+                changed = doc.set_kv(str(k), v) or changed
+            return self._status(path, notify, changed)
+
+    def ensure_lines(self, file: str, present: list[str], notify: str | None = None):
+        with self._lock:
+            path = self._load(file)
+            doc = self._docs[path]
+            changed = False
+            for ln in present:
+                if not doc.members[ln]:
+                    doc.append(ln); changed = True
+            return self._status(path, notify, changed)
+
+    def commit(self) -> dict[str, str]:
+        """Write pending files. Returns {path: error} for every write that failed so far."""
+        with self._lock:
+            for path, doc in self._docs.items():
+                if not doc.dirty:
+                    doc.notify.clear()
+                    continue
+                data = doc.render()
+                digest = hashlib.sha256(data).hexdigest()
+                if digest == doc.digest:
+                    doc.notify.clear()
+                    continue
+                try:
+                    atomic_write(doc.path, data)
+                except OSError as e:
+                    self.errors[path] = str(e)
+                    continue
+                doc.digest = digest
+                self.errors.pop(path, None)
+                for cmd in doc.notify:
+                    self.handlers.notify(cmd)
+                doc.notify.clear()
+            # a failed write is retried by the next commit; the rest is re-read when used again
+            self._docs = {path: doc for path, doc in self._docs.items() if path in self.errors}
+            return dict(self.errors)
+
+def _once(method: str, file: str, *args, **kws):
+    t = Transaction()
+    status = getattr(t, method)(file, *args, **kws)
+    errors = t.commit()
+    if errors:
+        raise OSError(next(iter(errors.values())))
+    t.handlers.flush()
+    return status
+
+def _preview(method: str, file: str, *args, **kws):
+    # an uncommitted transaction is a dry run
+    status = getattr(Transaction(), method)(file, *args, **kws)
+    return "drift" if status == "fixed" else status
+
+def check_replace_kv(file: str, key: str, value: str, notify: str | None = None):
+    return _preview("replace_kv", file, key, value)
+
+def check_kv_set(file: str, values: dict, notify: str | None = None):
+    return _preview("kv_set", file, values)
+
+def check_ensure_lines(file: str, present: list[str], notify: str | None = None):
+    return _preview("ensure_lines", file, present)
 
 def replace_kv(file: str, key: str, value: str, notify: str | None = None):
-    p = Path(file)
-    old = p.read_text() if p.exists() else ""
-    key_re = re.compile(rf"^\s*{re.escape(key)}\s+.*$", re.M)
-    if key_re.search(old):
-        new = key_re.sub(f"{key} {value}", old)
-    else:
-        new = old + ("" if old.endswith("\n") else "\n") + f"{key} {value}\n"
-    if new != old:
-        p.parent.mkdir(parents=True, exist_ok=True)
-        p.write_text(new)
-        if notify:
-            import subprocess; subprocess.call(notify.split())
-        return "fixed"
-    return "pass"
+    return _once("replace_kv", file, key, value, notify=notify)
+
+def kv_set(file: str, values: dict, notify: str | None = None):
+    return _once("kv_set", file, values, notify=notify)
 
 def ensure_lines(file: str, present: list[str], notify: str | None = None):
-    p = Path(file)
-    lines = p.read_text().splitlines() if p.exists() else []
-    s = set(lines); changed = False
-    for ln in present:
-        if ln not in s:
-            lines.append(ln); changed = True
-    if changed:
-        p.parent.mkdir(parents=True, exist_ok=True)
-        p.write_text("\n".join(lines) + "\n")
-        if notify:
-            import subprocess; subprocess.call(notify.split())
-        return "fixed"
-    return "pass"
+    return _once("ensure_lines", file, present, notify=notify)
+
+APPLY = {"file.replace_kv": replace_kv, "file.kv_set": kv_set, "file.ensure_lines": ensure_lines}
+CHECK = {"file.replace_kv": check_replace_kv, "file.kv_set": check_kv_set, "file.ensure_lines": check_ensure_lines}
@@ -1,29 +1,465 @@
 from __future__ import annotations
-import shutil, subprocess
+import logging, os, re, subprocess, threading, time
+from pathlib import Path
+from .. import capture, metrics, shell
+from ..budget import budget
+from ..facts import facts
 
-def ensure(name: str, state: str = "present"):
-    # present/absent; supports apt, dnf, pacman
-    apt = shutil.which("apt-get")
-    dnf = shutil.which("dnf")
-    pac = shutil.which("pacman")
-
-    if state == "present":
-        if apt:
-            subprocess.call(["bash","-lc", f"dpkg -s {name} >/dev/null 2>&1 || (apt-get update -y && apt-get install -y {name})"])
-        elif dnf:
-            subprocess.call(["bash","-lc", f"rpm -q {name} >/dev/null 2>&1 || dnf install -y {name}"])
-        elif pac:
-            subprocess.call(["bash","-lc", f"pacman -Qi {name} >/dev/null 2>&1 || pacman -S --noconfirm {name}"])
-        else:
-            return "error"
-        return "fixed"
-    else:  # absent
-        if apt:
-            subprocess.call(["bash","-lc", f"dpkg -s {name} >/dev/null 2>&1 && apt-get remove -y {name}"])
-        elif dnf:
-            subprocess.call(["bash","-lc", f"rpm -q {name} >/dev/null 2>&1 && dnf remove -y {name}"])
-        elif pac:
-            subprocess.call(["bash","-lc", f"pacman -Qi {name} >/dev/null 2>&1 && pacman -R --noconfirm {name}"])
+log = logging.getLogger(__name__)
+
+# rule parameters -> accepted types (or allowed values); "?" marks optional ones
+SCHEMA = {"pkg.ensure": {"name": str, "state?": ("present", "absent")}}
+
+# package databases that can be read without forking the package manager
+DB = {
+    "apt-get": "/var/lib/dpkg/status",
+    "pacman": "/var/lib/pacman/local",
+    "apk": "/lib/apk/db/installed",
+}
+
+# one snapshot of the installed package database per manager
+QUERY = {
+    "apt-get": ["dpkg-query", "-W", "-f=${Package}\t${Status}\n"],
+    "dnf": ["rpm", "-qa", "--qf", "%{NAME}\n"],
+    "yum": ["rpm", "-qa", "--qf", "%{NAME}\n"],
+    "zypper": ["rpm", "-qa", "--qf", "%{NAME}\n"],
+    "pacman": ["pacman", "-Qq"],
+    "apk": ["apk", "info"],
+    "brew": ["brew", "list", "-1"],
+}
+
+INSTALL = {
+    "apt-get": ["apt-get", "install", "-y"],
+    "dnf": ["dnf", "install", "-y"],
+    "yum": ["yum", "install", "-y"],
+    "zypper": ["zypper", "--non-interactive", "install"],
+    "pacman": ["pacman", "-S", "--noconfirm"],
+    "apk": ["apk", "add", "--no-cache"],
+    "brew": ["brew", "install"],
+}
+
+REMOVE = {
+    "apt-get": ["apt-get", "remove", "-y"],
+    "dnf": ["dnf", "remove", "-y"],
+    "yum": ["yum", "remove", "-y"],
+    "zypper": ["zypper", "--non-interactive", "remove"],
+    "pacman": ["pacman", "-R", "--noconfirm"],
+    "apk": ["apk", "del"],
+    "brew": ["brew", "uninstall"],
+}
+
+# index refresh, run at most once per transaction and only when installing
+REFRESH = {
+    "apt-get": ["apt-get", "update", "-y"],
+    "pacman": ["pacman", "-Sy", "--noconfirm"],
+}
+
+# download-only: fetch into the package manager's cache, install nothing
+DOWNLOAD = {
+    "apt-get": ["apt-get", "install", "-y", "--download-only"],
+    "dnf": ["dnf", "install", "-y", "--downloadonly"],
+    "yum": ["yum", "install", "-y", "--downloadonly"],
+    "zypper": ["zypper", "--non-interactive", "install", "--download-only"],
+    "pacman": ["pacman", "-Sw", "--noconfirm"],
+    "brew": ["brew", "fetch"],
+}
+
+# where downloaded archives land (apt's is asked from apt-config, so APT_CONFIG applies)
+CACHE = {
+    "dnf": "/var/cache/dnf",
+    "yum": "/var/cache/yum",
+    "zypper": "/var/cache/zypp/packages",
+    "pacman": "/var/cache/pacman/pkg",
+}
+ARCHIVE = re.compile(r".*(\.deb|\.rpm|\.pkg\.tar\.\w+|\.bottle\.tar\.gz)$")
+# one line per archive fetched, for progress
+FETCHED = {
+    "apt-get": re.compile(rb"^Get:\d+ "),
+    "dnf": re.compile(rb"^\(\d+/\d+\): "),
+    "yum": re.compile(rb"^\(\d+/\d+\): "),
+    "zypper": re.compile(rb"^Retrieving: "),
+}
+PREFETCH_TIMEOUT = 1800
+
+# one package manager run at a time in this process: a transaction or a background prefetch
+LOCK = threading.Lock()
+
+def detect() -> str | None:
+    return facts.get("pkg_manager")
+
+def _read_db(pm: str) -> set[str] | None:
+    path = DB.get(pm)
+    if not path:
+        return None
+    try:
+        if pm == "pacman":
+            # one <name>-<pkgver>-<pkgrel> directory per package
+            return {e.name.rsplit("-", 2)[0] for e in os.scandir(path) if e.is_dir()}
+        text = Path(path).read_text(errors="replace")
+    except OSError:
+        return None
+    if pm == "apk":
+        return {ln[2:] for ln in text.splitlines() if ln.startswith("P:")}
+    names = set()
+    for stanza in text.split("\n\n"):
+        name = status = ""
+        for ln in stanza.splitlines():
+            if ln.startswith("Package:"):
+                name = ln[8:].strip()
+            elif ln.startswith("Status:"):
+                status = ln[7:].strip()
+        if name and status.endswith(" installed"):
+            names.add(name)
+    return names
+
+def installed(pm: str) -> set[str] | None:
+    """Names of installed packages, or None if the database can't be read."""
+    names = _read_db(pm)
+    if names is not None:
+        return names
+    try:
+        cp = subprocess.run(QUERY[pm], text=True, capture_output=True)
+    except (KeyError, OSError):
+        return None
+    if cp.returncode != 0:
+        return None
+    names = set()
+    for ln in cp.stdout.splitlines():
+        name, _, status = ln.partition("\t")
+        # dpkg keeps removed-but-configured packages around; only count installed ones
+        if name and (pm != "apt-get" or status.endswith(" installed")):
+            names.add(name.strip())
+    return names
+
+def _uniq(names):
+    return list(dict.fromkeys(names))
+
+def _cache_dir(pm: str) -> str | None:
+    if pm == "apt-get":
+        try:
+            cp = subprocess.run(["apt-config", "shell", "D", "Dir::Cache::archives/d"], text=True, capture_output=True)
+            m = re.match(r"D='(.*)'", cp.stdout.strip())
+            return m.group(1) if m else "/var/cache/apt/archives"
+        except OSError:
+            return "/var/cache/apt/archives"
+    if pm == "brew":
+        try:
+            return subprocess.run(["brew", "--cache"], text=True, capture_output=True).stdout.strip() or None
+        except OSError:
+            return None
+    return CACHE.get(pm)
+
+def _archives(top: str | None) -> dict[str, int]:
+    """Archive file -> size under a package cache (not counting partial downloads)."""
+    out: dict[str, int] = {}
+    if not top:
+        return out
+    for root, dirs, files in os.walk(top):
+        dirs[:] = [d for d in dirs if d != "partial"]
+        for f in files:
+            if ARCHIVE.match(f):
+                try:
+                    out[f] = os.stat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+    return out
+
+class Prefetcher:
+    """
+    Downloads packages a deferred transaction will install, so the run
+    inside the maintenance window only unpacks from the cache. want()
+    queues them and returns at once; a background thread fetches the queue
+    download-only under the resource budget (niced, ioniced, cgroup), not
+    held by the window, which is the point. A failed fetch stays queued and
+    is retried on the next kick() (each drift scan) or want(). Fetches and
+    transactions take LOCK, so the agent never runs the package manager
+    twice at once. transact() skips the index refresh when everything it
+    installs was prefetched. Try it without a mirror by pointing APT_CONFIG
+    at a copy: repository and a scratch cache.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.last: dict = {}  # stats of the last prefetch
+        self._ready: dict[str, float] = {}  # package -> monotonic time it was fetched
+        # (pm, extra, sudo, timeout) -> packages to fetch with them
+        self._queue: dict[tuple, list[str]] = {}
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def want(self, pm: str, names: list[str], extra: list[str] | None = None,
+             sudo: list[str] | None = None, timeout: float | None = None) -> list[str]:
+        """Queue names for a background fetch. Returns those not in the cache yet."""
+        if not self.enabled or pm not in DOWNLOAD:
+            return []
+        key = (pm, tuple(extra or ()), tuple(sudo or ()), timeout)
+        with self._lock:
+            names = [n for n in _uniq(names) if not self._fresh(n)]
+            if names:
+                self._queue[key] = _uniq(self._queue.get(key, []) + names)
+        if names:
+            self.kick()
+        return names
+
+    def pending(self) -> list[str]:
+        """Queued packages not fetched yet."""
+        with self._lock:
+            return _uniq(n for names in self._queue.values() for n in names)
+
+    def kick(self) -> None:
+        """Start the background fetch if anything is queued and it isn't running."""
+        with self._lock:
+            if not self._queue or (self._thread and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._work, name="lpp-prefetch", daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait for a running background fetch; True once none is running."""
+        t = self._thread
+        if t:
+            t.join(timeout)
+        return not (t and t.is_alive())
+
+    def _work(self) -> None:
+        failed: dict[tuple, list[str]] = {}
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._queue.update(failed)  # retried on the next kick
+                    return
+                key, names = self._queue.popitem()
+            pm, extra, sudo, timeout = key
+            if not self.fetch(pm, names, list(extra), list(sudo), timeout):
+                failed[key] = names
+
+    def fetch(self, pm: str, names: list[str], extra: list[str] | None = None,
+              sudo: list[str] | None = None, timeout: float | None = None) -> bool:
+        """Download those of names not fetched yet. True if all of them are in the cache now."""
+        if not self.enabled or pm not in DOWNLOAD:
+            return False
+        with self._lock:
+            names = [n for n in _uniq(names) if not self._fresh(n)]
+        if not names:
+            return True
+        try:
+            with LOCK:
+                ok = self._fetch(pm, names, list(extra or []), list(sudo or []), timeout or PREFETCH_TIMEOUT)
+        except Exception as e:
+            log.warning("Package prefetch failed: %s", e)
+            return False
+        if ok:
+            now = time.monotonic()
+            with self._lock:
+                self._ready.update((n, now) for n in names)
+        return ok
+
+    def _fresh(self, name: str) -> bool:
+        t = self._ready.get(name)
+        return t is not None and time.monotonic() - t < facts.ttl
+
+    def ready(self, names: list[str]) -> list[str]:
+        """Those of names whose archives are in the cache from a prefetch."""
+        with self._lock:
+            return [n for n in names if self._fresh(n)]
+
+    def forget(self, names: list[str]) -> None:
+        """Drop installed packages from the fetched and the queued ones."""
+        gone = set(names)
+        with self._lock:
+            for n in gone:
+                self._ready.pop(n, None)
+            for key in list(self._queue):
+                self._queue[key] = [n for n in self._queue[key] if n not in gone]
+                if not self._queue[key]:
+                    del self._queue[key]
+
+    def _fetch(self, pm: str, names: list[str], extra: list[str], sudo: list[str], timeout: float) -> bool:
+        log.info("Prefetching %d packages via %s: %s", len(names), pm, " ".join(names))
+        cache = _cache_dir(pm)
+        before = _archives(cache)
+        steps = ([REFRESH[pm]] if pm in REFRESH else []) + [DOWNLOAD[pm] + names + extra]
+        env = dict(os.environ, DEBIAN_FRONTEND="noninteractive") if pm == "apt-get" else None
+        progress = _Progress(FETCHED.get(pm), len(names))
+        t0 = time.monotonic()
+        rc, err = 0, ""
+        for argv in steps:
+            try:
+                cp = capture.run((sudo if pm != "brew" else []) + argv, timeout=timeout, env=env,
+                                 on_output=progress if argv is steps[-1] else None)
+            except subprocess.TimeoutExpired:
+                rc, err = -1, f"timed out after {timeout:.0f}s"
+                break
+            if cp.returncode != 0:
+                rc, err = cp.returncode, (cp.stderr.strip().splitlines() or [""])[-1]
+                break
+        secs = time.monotonic() - t0
+        new = {f: size for f, size in _archives(cache).items() if before.get(f) != size}
+        fetched = [n for n in names if any(re.match(re.escape(n) + r"(_|-\d|--)", f) for f in new)]
+        self.last = {"pm": pm, "packages": len(names), "fetched": len(fetched), "cached": len(names) - len(fetched),
+                     "archives": len(new), "kb": sum(new.values()) >> 10, "rc": rc, "s": round(secs, 3)}
+        metrics.registry.observe("lpp_pkg_prefetch_seconds", secs)
+        metrics.registry.inc("lpp_pkg_prefetch_bytes_total", sum(new.values()))
+        if rc != 0:
+            metrics.registry.inc("lpp_pkg_prefetch_total", len(names), result="error")
+            log.warning("Package prefetch via %s failed (rc=%s) after %.1fs: %s", pm, rc, secs, err)
+            return False
+        metrics.registry.inc("lpp_pkg_prefetch_total", len(fetched), result="fetched")
+        metrics.registry.inc("lpp_pkg_prefetch_total", len(names) - len(fetched), result="cached")
+        log.info("Prefetched %d packages via %s in %.1fs: %d archives (%d KiB) downloaded, %d already cached",
+                 len(names), pm, secs, len(new), self.last["kb"], len(names) - len(fetched))
+        return True
+
+class _Progress:
+    """on_output for a prefetch: counts fetched archives and logs them now and then."""
+    def __init__(self, pattern: re.Pattern | None, total: int, every: float = 10.0):
+        self.pattern, self.total, self.every = pattern, total, every
+        self.count = 0
+        self._buf = b""
+        self._last = time.monotonic()
+
+    def __call__(self, stream: str, chunk: bytes) -> None:
+        if stream != "stdout" or self.pattern is None:
+            return
+        *lines, self._buf = (self._buf + chunk).split(b"\n")
+        n = sum(1 for ln in lines if self.pattern.match(ln))
+        if not n:
+            return
+        self.count += n
+        metrics.registry.inc("lpp_pkg_prefetch_archives_total", n)
+        if time.monotonic() - self._last >= self.every:
+            self._last = time.monotonic()
+            log.info("Prefetch: %d archives fetched so far (%d packages requested)", self.count, self.total)
+
+prefetcher = Prefetcher()
+
+def transact(pm: str, install: list[str], remove: list[str], extra: list[str] | None = None,
+             sudo: list[str] | None = None, timeout: int | None = None, on_output=None) -> dict:
+    """
+    Run one install and one remove transaction. Returns rc, bounded output and
+    usage; usage["prefetched"] counts packages installed from a prefetch.
+    Waits for a prefetch in flight, so what it fetches installs from the cache.
+    """
+    with LOCK:
+        return _transact(pm, install, remove, extra or [], sudo or [], timeout, on_output)
+
+def _transact(pm: str, install: list[str], remove: list[str], extra: list[str],
+              sudo: list[str], timeout: int | None, on_output) -> dict:
+    steps = []
+    prefetched: list[str] = []
+    if install:
+        prefetched = prefetcher.ready(install)
+        metrics.registry.inc("lpp_pkg_cache_total", len(prefetched), result="hit")
+        metrics.registry.inc("lpp_pkg_cache_total", len(install) - len(prefetched), result="miss")
+        # prefetched archives match the index they were fetched with; a refresh could make them stale
+        if pm in REFRESH and len(prefetched) < len(install):
+            steps.append(REFRESH[pm])
+        steps.append(INSTALL[pm] + install + extra)
+    if remove:
+        steps.append(REMOVE[pm] + remove + extra)
+    env = dict(os.environ, DEBIAN_FRONTEND="noninteractive") if pm == "apt-get" else None
+    rc, out, err = 0, [], []
+    usage: dict[str, float] = {}
+    for argv in steps:
+        cp = capture.run((sudo if pm != "brew" else []) + argv, timeout=timeout, env=env, on_output=on_output)
+        out.append(cp.stdout); err.append(cp.stderr)
+        for k, v in cp.usage.items():
+            usage[k] = max(usage.get(k, 0), v) if k == "max_rss_kb" else round(usage.get(k, 0) + v, 3)
+        if cp.returncode != 0:
+            rc = cp.returncode
+            break
+    if prefetched:
+        usage["prefetched"] = len(prefetched)
+    if rc == 0:
+        prefetcher.forget(install)
+    # a transaction may add or drop package managers (or sudo) themselves,
+    # and profile.d scripts that bash rules see
+    facts.invalidate("pkg_manager", "sudo")
+    shell.invalidate()
+    return {"rc": rc, "stdout": "".join(out), "stderr": "".join(err), "usage": usage}
+
+def ensure_many(items: list[tuple[str, str]], extra: list[str] | None = None,
+                sudo: list[str] | None = None, timeout: int | None = None,
+                on_output=None, prefetch: bool = False) -> tuple[list[str], dict]:
+    """
+    Plan every (name, state) pair against one snapshot of the package database and
+    converge them in a single transaction. Returns per-item statuses and the run output.
+    A transaction waits for budget.hold(); items it would have changed are
+    "deferred" when the budget holds it off (out["deferred"] says why). With
+    prefetch, packages a deferred transaction would install are queued for
+    a background download (see Prefetcher); out["prefetching"] lists them.
+    """
+    pm = detect()
+    if not pm:
+        return ["error"] * len(items), {"rc": 127, "stdout": "", "stderr": "unsupported package manager", "pm": None}
+    want = {}
+    for name, state in items:
+        want.setdefault(name, set()).add(state)
+    conflict = {n for n, s in want.items() if len(s) > 1}
+
+    have = installed(pm)
+    install = _uniq(n for n, s in items if s == "present" and n not in conflict and (have is None or n not in have))
+    remove = _uniq(n for n, s in items if s == "absent" and n not in conflict and (have is None or n in have))
+
+    out: dict = {"rc": 0, "stdout": "", "stderr": ""}
+    deferred = budget.hold() if install or remove else None
+    if deferred:
+        out["deferred"] = deferred
+        if prefetch and install:
+            # fetch meanwhile so the run inside the window only unpacks
+            out["prefetching"] = prefetcher.want(pm, install, extra=extra, sudo=sudo, timeout=timeout)
+    elif install or remove:
+        out = transact(pm, install, remove, extra=extra, sudo=sudo, timeout=timeout, on_output=on_output)
+    after = installed(pm) if out["rc"] != 0 else None
+
+    statuses = []
+    for name, state in items:
+        if name in conflict or state not in ("present", "absent"):
+            statuses.append("error")
+        elif name not in install and name not in remove:
+            statuses.append("pass")
+        elif deferred:
+            statuses.append("deferred")
+        elif after is None:
+            statuses.append("fixed" if out["rc"] == 0 else "error")
         else:
-            return "error"
-        return "fixed"
+            # the batch failed: find out which packages still reached their state
+            statuses.append("fixed" if (name in after) == (state == "present") else "error")
+    out["pm"] = pm
+    return statuses, out
+
+def check_many(items: list[tuple[str, str]]) -> list[str]:
+    """Side-effect-free ensure_many: "pass" or "drift" per (name, state), from one snapshot."""
+    pm = detect()
+    have = installed(pm) if pm else None
+    if have is None:
+        return ["error"] * len(items)
+    want: dict[str, set[str]] = {}
+    for name, state in items:
+        want.setdefault(name, set()).add(state)
+    return ["error" if len(want[name]) > 1 or state not in ("present", "absent")
+            else "pass" if (name in have) == (state == "present") else "drift"
+            for name, state in items]
+
+def items(name: str, state: str = "present") -> list[tuple[str, str]]:
+    """(name, state) per package of a rule; `name` may list several, space-separated."""
+    names = str(name).split()
+    if not names:
+        raise ValueError("pkg.ensure: empty package name")
+    return [(n, state) for n in names]
+
+def rollup(statuses: list[str]) -> str:
+    """One rule's status from those of its packages: the worst of them."""
+    for s in ("error", "deferred", "drift", "fixed"):
+        if s in statuses:
+            return s
+    return "pass"
+
+def check(name: str, state: str = "present"):
+    return rollup(check_many(items(name, state)))
+
+def ensure(name: str, state: str = "present"):
+    # present/absent; supports apt, dnf, yum, zypper, pacman, apk, brew
+    return rollup(ensure_many(items(name, state))[0])
+
+APPLY = {"pkg.ensure": ensure}
+CHECK = {"pkg.ensure": check}
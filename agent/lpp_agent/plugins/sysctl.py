@@ -1,11 +1,123 @@
 from __future__ import annotations
-import subprocess
+import errno, logging, subprocess, threading
 from pathlib import Path
+from ..util import atomic_write
+
+log = logging.getLogger(__name__)
+
+PROC = Path("/proc/sys")
+DROPIN = Path("/etc/sysctl.d/99-lpp.conf")
+HEADER = "# Managed by lpp-agent. Local changes will be overwritten.\n"
+# write errors that a later `sysctl -p` can't fix either: no such key, value rejected
+FATAL = {errno.ENOENT, errno.ENOTDIR, errno.EINVAL, errno.ERANGE}
+
+# rule parameters -> accepted types (or allowed values); "?" marks optional ones
+SCHEMA = {"sysctl.set": {"param": str, "value": (str, int, float), "persist?": bool}}
+
+def _path(param: str) -> Path:
+    # sysctl accepts both net.ipv4.ip_forward and net/ipv4/ip_forward
+    return PROC / (param if "/" in param else param.replace(".", "/"))
+
+def _norm(value) -> str:
+    # multi-value keys (tcp_rmem …) read back tab-separated
+    return " ".join(str(value).split())
+
+def read(param: str) -> str | None:
+    try:
+        return _norm(_path(param).read_text())
+    except OSError:
+        return None
+
+def _load_dropin() -> dict[str, str]:
+    out: dict[str, str] = {}
+    try:
+        text = DROPIN.read_text()
+    except OSError:
+        return out
+    for ln in text.splitlines():
+        k, sep, v = ln.partition("=")
+        if sep and not ln.lstrip().startswith(("#", ";")):
+            out[k.strip()] = _norm(v)
+    return out
+
+class Sysctl:
+    """
+    sysctl rules for one run. Live values are read from and written to
+    /proc/sys directly; persisted keys are merged into one managed drop-in that
+    flush() writes atomically. `sysctl -p` runs at most once, and only for keys
+    that couldn't be written live for a transient reason; a key that doesn't
+    exist or a value the kernel rejects fails the rule and isn't persisted.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dropin: dict[str, str] | None = None
+        self._dirty = False
+        self._reload = False
+
+    def _persisted(self, param: str) -> str | None:
+        with self._lock:
+            if self._dropin is None:
+                self._dropin = _load_dropin()
+            return self._dropin.get(param)
+
+    def check(self, param: str, value, persist: bool = True):
+        want = _norm(value)
+        if read(param) != want or (persist and self._persisted(param) != want):
+            return "drift"
+        return "pass"
+
+    def set(self, param: str, value, persist: bool = True):
+        want = _norm(value)
+        status = "pass"
+        if read(param) != want:
+            if not _path(param).exists():
+                log.warning("sysctl %s: no such key", param)
+                return "error"  # persisting it would only break every later sysctl -p
+            try:
+                _path(param).write_text(want + "\n")
+                status = "fixed"
+            except OSError as e:
+                if e.errno in FATAL:
+                    log.warning("sysctl %s=%s: %s", param, want, e.strerror or e)
+                    return "error"
+                if not persist:
+                    rc = subprocess.call(["sysctl", "-w", f"{param}={want}"])
+                    return "fixed" if rc == 0 else "error"
+                with self._lock:
+                    self._reload = True
+                status = "fixed"
+        if persist:
+            with self._lock:
+                if self._dropin is None:
+                    self._dropin = _load_dropin()
+                if self._dropin.get(param) != want:
+                    self._dropin[param] = want
+                    self._dirty = True
+                    status = "fixed"
+        return status
+
+    def flush(self) -> str | None:
+        """Write the drop-in and reload if needed. Returns an error message on failure."""
+        with self._lock:
+            dropin, dirty, reload = self._dropin, self._dirty, self._reload
+            self._dirty = self._reload = False
+        try:
+            if dirty and dropin is not None:
+                atomic_write(DROPIN, HEADER + "".join(f"{k} = {v}\n" for k, v in sorted(dropin.items())))
+        except OSError as e:
+            log.warning("sysctl drop-in write failed: %s", e)
+            return str(e)
+        if reload and subprocess.call(["sysctl", "-p", str(DROPIN)]) != 0:
+            return f"sysctl -p {DROPIN} failed"
+        return None
+
+def check(param: str, value: str, persist: bool = True):
+    return Sysctl().check(param, value, persist=persist)
 
 def set(param: str, value: str, persist: bool = True):
-    subprocess.call(["sysctl", f"{param}={value}"])
-    if persist:
-        Path("/etc/sysctl.d").mkdir(parents=True, exist_ok=True)
-        Path("/etc/sysctl.d/99-lpp.conf").write_text(f"{param} = {value}\n")
-        subprocess.call(["sysctl", "-p", "/etc/sysctl.d/99-yggdrasil.conf"])
-    return "fixed"
+    s = Sysctl()
+    status = s.set(param, value, persist=persist)
+    return "error" if s.flush() else status
+
+APPLY = {"sysctl.set": set}
+CHECK = {"sysctl.set": check}
@@ -1,16 +1,117 @@
 from __future__ import annotations
-import subprocess
+import subprocess, threading
+from ..facts import facts
+from ..handlers import HandlerQueue, unit_name
+
+ACTIVE = ("active", "reloading", "activating")
+# unit file states that need no `systemctl enable` (or can't have one)
+ENABLED = ("enabled", "enabled-runtime", "static", "indirect", "generated", "alias")
+DISABLED = ("disabled", "static", "masked", "masked-runtime", "indirect", "")
+
+# rule parameters -> accepted types (or allowed values); "?" marks optional ones
+SCHEMA = {"service.manage": {"service": str,
+                             "state": ("started", "stopped", "restarted", "enabled", "disabled")}}
+
+def show(units: list[str]) -> dict[str, dict[str, str]]:
+    """ActiveState/UnitFileState of many units with one `systemctl show`."""
+    if not units:
+        return {}
+    cp = subprocess.run(["systemctl", "show", "--property=ActiveState,UnitFileState", "--", *units],
+                        text=True, capture_output=True)
+    if cp.returncode != 0:
+        return {}
+    out: dict[str, dict[str, str]] = {}
+    # one Key=Value block per unit, blank-line separated, in argument order
+    for unit, block in zip(units, cp.stdout.strip("\n").split("\n\n")):
+        props = {}
+        for ln in block.splitlines():
+            k, _, v = ln.partition("=")
+            props[k] = v
+        out[unit] = props
+    return out
+
+class Systemd:
+    """
+    Service rules for one run. prefetch() reads the state of every unit in the
+    run with a single `systemctl show`; manage() only calls systemctl for units
+    that drifted. Restarts go to the handler queue and run once at flush.
+    """
+    def __init__(self, handlers: HandlerQueue | None = None):
+        self.handlers = handlers
+        self._state: dict[str, dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, services: list[str]) -> None:
+        units = list(dict.fromkeys(unit_name(s) for s in services))
+        got = show(units)
+        with self._lock:
+            self._state.update(got)
+
+    def _get(self, unit: str) -> dict[str, str]:
+        with self._lock:
+            if unit in self._state:
+                return self._state[unit]
+        got = show([unit]).get(unit, {})
+        with self._lock:
+            self._state[unit] = got
+        return got
+
+    def _action(self, unit: str, state: str) -> list[str] | None:
+        """systemctl arguments that bring the unit to `state`, None if it is there already."""
+        cur = self._get(unit)
+        active = cur.get("ActiveState") in ACTIVE
+        ufs = cur.get("UnitFileState", "")
+        if state == "started":
+            return None if active and ufs in ENABLED else ["enable", "--now"]
+        if state == "stopped":
+            return None if not active and ufs in DISABLED else ["disable", "--now"]
+        if state == "enabled":
+            return None if ufs in ENABLED else ["enable"]
+        if state == "disabled":
+            return None if ufs in DISABLED else ["disable"]
+        raise ValueError(f"unknown service state {state!r}")
+
+    def check(self, service: str, state: str):
+        # a restart is an action, not a state: nothing to drift from
+        if facts.get("init") != "systemd":
+            return "error"
+        if state == "restarted":
+            return "pass"
+        try:
+            return "pass" if self._action(unit_name(service), state) is None else "drift"
+        except ValueError:
+            return "error"
+
+    def manage(self, service: str, state: str):
+        # state: started|stopped|restarted|enabled|disabled
+        if facts.get("init") != "systemd":
+            return "error"
+        unit = unit_name(service)
+        if state == "restarted":
+            if self.handlers is None:
+                return "fixed" if subprocess.call(["systemctl", "restart", unit]) == 0 else "error"
+            self.handlers.restart(unit)
+            return "fixed"
+        try:
+            argv = self._action(unit, state)
+        except ValueError:
+            return "error"
+        if argv is None:
+            return "pass"
+        rc = subprocess.call(["systemctl", *argv, unit])
+        with self._lock:
+            self._state.pop(unit, None)
+        return "fixed" if rc == 0 else "error"
+
+def check(service: str, state: str):
+    return Systemd().check(service, state)
 
 def manage(service: str, state: str):
-    # state: started|stopped|restarted|enabled|disabled
-    if state == "started":
-        subprocess.call(["systemctl", "enable", "--now", service])
-    elif state == "stopped":
-        subprocess.call(["systemctl", "disable", "--now", service])
-    elif state == "restarted":
-        subprocess.call(["systemctl", "restart", service])
-    elif state == "enabled":
-        subprocess.call(["systemctl", "enable", service])
-    elif state == "disabled":
-        subprocess.call(["systemctl", "disable", service])
-    return "pass"
+    handlers = HandlerQueue()
+    status = Systemd(handlers).manage(service, state)
+    if any(handlers.flush().values()):
+        return "error"
+    return status
+
+APPLY = {"service.manage": manage}
+CHECK = {"service.manage": check}
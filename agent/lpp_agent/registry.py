@@ -0,0 +1,65 @@
+from __future__ import annotations
+import importlib, logging, threading
+from types import ModuleType
+from typing import Any, Callable
+
+log = logging.getLogger(__name__)
+
+# Rule types map to plugin modules, which are imported the first time a plan
+# uses one of their types. A plugin module defines
+#   SCHEMA = {rule_type: {param: type, …}}   (see plan)
+#   APPLY  = {rule_type: fn(**params) -> "pass" | "fixed"}
+#   CHECK  = {rule_type: fn(**params) -> "pass" | "drift"}   (optional)
+# Third-party plugins register their rule types as entry points in GROUP:
+#   [project.entry-points."lpp_agent.plugins"]
+#   "nginx.site" = "lpp_nginx.plugin"
+GROUP = "lpp_agent.plugins"
+
+# looked up first, so built-in types resolve without reading package metadata
+# (which a zipapp doesn't have); keep in sync with pyproject.toml
+BUILTIN = {
+    "file.replace_kv": "lpp_agent.plugins.file_edit",
+    "file.ensure_lines": "lpp_agent.plugins.file_edit",
+    "file.kv_set": "lpp_agent.plugins.file_edit",
+    "service.manage": "lpp_agent.plugins.systemd",
+    "pkg.ensure": "lpp_agent.plugins.pkg",
+    "sysctl.set": "lpp_agent.plugins.sysctl",
+}
+
+_lock = threading.Lock()
+_external: dict[str, str] | None = None
+
+def _entry_points() -> dict[str, str]:
+    global _external
+    with _lock:
+        if _external is None:
+            from importlib.metadata import entry_points
+            try:
+                _external = {ep.name: ep.value for ep in entry_points(group=GROUP)}
+            except Exception as e:
+                log.warning("could not read %s entry points: %s", GROUP, e)
+                _external = {}
+        return _external
+
+def module(rtype: str) -> ModuleType | None:
+    """The plugin module for a rule type, imported on first use; None if no plugin provides it."""
+    name = BUILTIN.get(rtype) or _entry_points().get(rtype)
+    if not name:
+        return None
+    try:
+        return importlib.import_module(name.partition(":")[0])
+    except ImportError as e:
+        log.error("plugin %s for %s failed to load: %s", name, rtype, e)
+        return None
+
+def schema(rtype: str) -> dict[str, Any] | None:
+    m = module(rtype)
+    return getattr(m, "SCHEMA", {}).get(rtype) if m else None
+
+def applier(rtype: str) -> Callable[..., Any] | None:
+    m = module(rtype)
+    return getattr(m, "APPLY", {}).get(rtype) if m else None
+
+def checker(rtype: str) -> Callable[..., Any] | None:
+    m = module(rtype)
+    return getattr(m, "CHECK", {}).get(rtype) if m else None
@@ -1,74 +1,33 @@
-import os
-import json
 import time
-import random
-import tempfile
+import shlex
 import subprocess
-import signal
 from typing import Optional, Tuple, Dict, Any
 
 import requests
 
+from . import http, shell, store
+from .config import state_key
+from .core import AgentCore
+from .facts import facts
+from .outbox import Outbox
+from .schedule import PollSchedule, hint
+from .plugins import pkg
+
 
-STATE_DIR = "/var/lib/lpp"
-STATE_FILE = os.path.join(STATE_DIR, "state.json")
 USER_AGENT = "lpp-agent/0.2.0"
 DEFAULT_TIMEOUT_POLICY = 1800  # 30m per policy step
-DEFAULT_SLEEP_CHANGED = 20
-DEFAULT_SLEEP_NOCHANGE = 60
+POLL_INTERVAL = 60  # without long-poll; each agent polls in its own slot of it
+LONG_POLL_WAIT = 55  # seconds the server may hold a policy request
 MAX_STD_CAPTURE = 4000  # chars per stream
 
 
-def _ensure_state_dir():
-    try:
-        os.makedirs(STATE_DIR, exist_ok=True)
-    except Exception:
-        pass
-
-
-def _load_state() -> Dict[str, Any]:
-    try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-
-def _save_state(data: Dict[str, Any]) -> None:
-    _ensure_state_dir()
-    tmp = STATE_FILE + ".tmp"
-    try:
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f)
-        os.replace(tmp, STATE_FILE)
-    except Exception:
-        pass
-
-
-def _is_root() -> bool:
-    try:
-        return os.geteuid() == 0  # type: ignore[attr-defined]
-    except Exception:
-        # On platforms without geteuid (Windows), assume not root
-        return False
-
-
-def _cmd_exists(cmd: str) -> bool:
-    return subprocess.call(["bash", "-lc", f"command -v {cmd} >/dev/null 2>&1"]) == 0
-
-
 def _pm_detect() -> Optional[str]:
-    # order matters; pick a “canonical” manager
-    for pm in ("apt-get", "dnf", "yum", "zypper", "pacman", "apk", "brew"):
-        if _cmd_exists(pm):
-            return pm
-    return None
+    return facts.get("pkg_manager")
 
 
 def _sudo_prefix() -> str:
-    if _is_root():
-        return ""
-    return "sudo " if _cmd_exists("sudo") else ""
+    # facts report no sudo when already root
+    return "sudo " if facts.get("sudo") else ""
 
 
 def _trim(s: str) -> str:
@@ -81,63 +40,74 @@ class Runner:
     def __init__(self, api_base: str, agent_id: str):
         self.api = api_base.rstrip("/")
         self.agent_id = str(agent_id)
-        self.session = requests.Session()
+        self.session = http.session()
         self.session.headers.update({"User-Agent": USER_AGENT})
         self.etag: Optional[str] = None
-
-        # graceful shutdown
-        signal.signal(signal.SIGTERM, self._sig_exit)
-        signal.signal(signal.SIGINT, self._sig_exit)
-
-        # restore previous etag, if any
-        st = _load_state()
-        if st.get("agent_id") == self.agent_id and st.get("api") == self.api:
-            self.etag = st.get("etag") or None
+        self.long_poll = False  # server honoured `Prefer: wait` on the last 304
+        self.next_poll: Optional[float] = None  # Retry-After / X-Next-Poll of the last response
+        self.schedule = PollSchedule(self.agent_id, POLL_INTERVAL)
+        self.outbox = Outbox()
+
+        # restore previous etag, if any; `etag` moves ahead as soon as a change
+        # is fetched, `applied_etag` once it has been applied. Kept apart from
+        # PolicyAgent's etags: the two fetch different documents.
+        self.store = store.get()
+        self.key = state_key(self.api, self.agent_id)
+        self.etag = self.store.get("runner_etags", self.key)
+        self.applied_etag = self.etag
 
     # ------------- plumbing -------------
 
     def _persist_etag(self, etag: Optional[str]):
-        self.etag = etag
-        st = _load_state()
-        st.update({"agent_id": self.agent_id, "api": self.api, "etag": etag})
-        _save_state(st)
-
-    def _sig_exit(self, *_args):
-        # allow quick termination in the loop
-        raise SystemExit(0)
+        if etag != self.applied_etag:
+            try:
+                self.store.put([("runner_etags", self.key, etag)])
+            except Exception:
+                pass
+        self.applied_etag = etag
 
     def _heartbeat(self):
         try:
             self.session.post(
-                f"{self.api}/agents/{self.agent_id}/heartbeat", timeout=5
+                f"{self.api}/agents/{self.agent_id}/heartbeat",
+                json={"ts": int(time.time()), "facts": facts.snapshot()}, timeout=5
             )
         except Exception:
             pass
 
+    def _post_batch(self, body: bytes, key: str):
+        r = self.session.post(
+            f"{self.api}/results/ingest", data=body, timeout=10,
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip",
+                     "Idempotency-Key": key},
+        )
+        r.raise_for_status()
+
     def _ingest(self, payload: dict):
+        # spool first so nothing is lost while the server is unreachable
         try:
-            body = {"agent_id": self.agent_id, **payload}
-            self.session.post(
-                f"{self.api}/results/ingest", json=body, timeout=10
-            )
-        except Exception:
+            if "result" in payload:
+                for res in payload["result"]:
+                    self.outbox.append({"agent_id": self.agent_id, "rev": payload.get("rev"), **res})
+            else:
+                self.outbox.append({"agent_id": self.agent_id, **payload})
+        except OSError:
             pass
 
     def _fetch_policy(self) -> Tuple[Optional[dict], Optional[str]]:
-        headers = {}
+        # long-poll: a server that supports it holds the request until the rev changes
+        headers = {"Prefer": f"wait={LONG_POLL_WAIT}"}
         if self.etag:
             headers["If-None-Match"] = self.etag
-        try:
-            r = self.session.get(
-                f"{self.api}/agents/{self.agent_id}/effective-policy",
-                headers=headers, timeout=30
-            )
-        except Exception as e:
-            # network error: no change applied
-            self._ingest({"error": f"fetch_policy: {e!r}"})
-            return None, self.etag
-
+        # network errors propagate: AgentCore backs off before the next try
+        r = self.session.get(
+            f"{self.api}/agents/{self.agent_id}/effective-policy",
+            headers=headers, params={"wait": LONG_POLL_WAIT},
+            timeout=(30, LONG_POLL_WAIT + 30)
+        )
+        self.next_poll = hint(r.headers)
         if r.status_code == 304:
+            self.long_poll = "wait" in r.headers.get("Preference-Applied", "")
             return None, r.headers.get("ETag")
         r.raise_for_status()
         try:
@@ -149,87 +119,74 @@ class Runner:
 
     # ------------- apply logic -------------
 
-    def _apply_pkg(self, pkg: str, args: Optional[str], timeout: int):
+    def _apply_pkgs(self, policies: list) -> Dict[int, dict]:
+        """
+        Install the packageName of every policy in one transaction per distinct
+        `args`, planned against a single snapshot of the package database.
+        """
         pm = _pm_detect()
-        sudo = _sudo_prefix()
-        args = (args or "").strip()
-        # build a single bash -lc string that tries the detected manager first
-        if pm == "apt-get":
-            cmd = f'{sudo}apt-get update -y && {sudo}apt-get install -y {pkg} {args}'
-        elif pm in ("dnf", "yum"):
-            cmd = f'{sudo}{pm} install -y {pkg} {args}'
-        elif pm == "zypper":
-            cmd = f'{sudo}zypper --non-interactive install {pkg} {args}'
-        elif pm == "pacman":
-            # pacman has separate sync/update semantics; assume DB is reasonably fresh
-            cmd = f'{sudo}pacman -Sy --noconfirm {pkg} {args}'
-        elif pm == "apk":
-            cmd = f'{sudo}apk add --no-cache {pkg} {args}'
-        elif pm == "brew":
-            # macOS Homebrew
-            sudob = ""  # brew typically not via sudo
-            cmd = f'{sudob}brew install {pkg} {args}'
-        else:
-            # try a generic multi-manager fallback
-            cmd = (
-                f'if command -v apt-get >/dev/null 2>&1; then {sudo}apt-get update -y && {sudo}apt-get install -y {pkg} {args}; '
-                f'elif command -v dnf >/dev/null 2>&1; then {sudo}dnf install -y {pkg} {args}; '
-                f'elif command -v yum >/dev/null 2>&1; then {sudo}yum install -y {pkg} {args}; '
-                f'elif command -v zypper >/dev/null 2>&1; then {sudo}zypper --non-interactive install {pkg} {args}; '
-                f'elif command -v pacman >/dev/null 2>&1; then {sudo}pacman -Sy --noconfirm {pkg} {args}; '
-                f'elif command -v apk >/dev/null 2>&1; then {sudo}apk add --no-cache {pkg} {args}; '
-                f'elif command -v brew >/dev/null 2>&1; then brew install {pkg} {args}; '
-                f'else echo "unsupported package manager"; exit 0; fi'
-            )
+        sudo = _sudo_prefix().split()
+        groups: Dict[str, list] = {}
+        for i, p in enumerate(policies):
+            if p.get("packageName"):
+                groups.setdefault((p.get("args") or "").strip(), []).append(i)
+
+        done: Dict[int, dict] = {}
+        for args, idxs in groups.items():
+            if not pm:
+                for i in idxs:
+                    done[i] = {"rc": 0, "stdout": "unsupported package manager", "stderr": "", "pm": "auto"}
+                continue
+            timeout = max(int(policies[i].get("timeout") or DEFAULT_TIMEOUT_POLICY) for i in idxs)
+            names = {i: str(policies[i]["packageName"]).split() for i in idxs}
+            try:
+                statuses, out = pkg.ensure_many(
+                    [(n, "present") for i in idxs for n in names[i]],
+                    extra=shlex.split(args), sudo=sudo, timeout=timeout,
+                )
+            except subprocess.TimeoutExpired as e:
+                for i in idxs:
+                    done[i] = {"type": "timeout", "error": repr(e)}
+                continue
+            if out.get("deferred"):  # held off by the budget's maintenance window / load limit
+                for i in idxs:
+                    done[i] = {"type": "deferred", "detail": out["deferred"], "pm": out.get("pm") or "auto"}
+                continue
+            st = iter(statuses)
+            for i in idxs:
+                ok = "error" not in [next(st) for _ in names[i]]
+                done[i] = {
+                    "type": "package",
+                    "rc": 0 if ok else (out["rc"] or 1),
+                    "stdout": out["stdout"],
+                    "stderr": out["stderr"],
+                    "pm": out.get("pm") or "auto",
+                    "usage": out.get("usage") or {},
+                }
+        return done
 
-        # run
-        out = subprocess.run(
-            ["bash", "-lc", cmd],
-            capture_output=True, text=True, timeout=timeout
-        )
+    def _apply_bash(self, script: str, timeout: int):
+        out = shell.run("set -euo pipefail\n" + script, timeout=timeout)
         return {
             "rc": out.returncode,
-            "stdout": _trim(out.stdout),
-            "stderr": _trim(out.stderr),
-            "pm": pm or "auto",
+            "stdout": out.stdout,
+            "stderr": out.stderr,
+            "usage": out.usage,
         }
 
-    def _apply_bash(self, script: str, timeout: int):
-        # Write script atomically, execute, then remove
-        fd, path = tempfile.mkstemp(prefix="lpp-", suffix=".sh")
-        try:
-            with os.fdopen(fd, "w", encoding="utf-8") as f:
-                f.write("#!/usr/bin/env bash\nset -euo pipefail\n")
-                f.write(script)
-            os.chmod(path, 0o700)
-            out = subprocess.run(
-                ["bash", path],
-                capture_output=True, text=True, timeout=timeout
-            )
-            return {
-                "rc": out.returncode,
-                "stdout": _trim(out.stdout),
-                "stderr": _trim(out.stderr),
-            }
-        finally:
-            try:
-                os.remove(path)
-            except Exception:
-                pass
-
     def _apply_policies(self, data: dict):
         results = []
-        for p in data.get("policies", []):
+        policies = data.get("policies", [])
+        try:
+            pkgs = self._apply_pkgs(policies)
+        except Exception as e:
+            pkgs = {i: {"type": "error", "error": repr(e)} for i, p in enumerate(policies) if p.get("packageName")}
+        for i, p in enumerate(policies):
             pid = p.get("id", "?")
             timeout = int(p.get("timeout") or DEFAULT_TIMEOUT_POLICY)
             try:
-                if p.get("packageName"):
-                    pkg_res = self._apply_pkg(
-                        p["packageName"], p.get("args"), timeout
-                    )
-                    results.append({
-                        "id": pid, "type": "package", **pkg_res
-                    })
+                if i in pkgs:
+                    results.append({"id": pid, "type": "package", **pkgs[i]})
                 if p.get("bash"):
                     bash_res = self._apply_bash(p["bash"], timeout)
                     results.append({
@@ -244,36 +201,43 @@ class Runner:
                 results.append({"id": pid, "type": "error", "error": repr(e)})
         return results
 
+    # ------------- core.Agent interface -------------
+
+    def fetch(self):
+        try:
+            data, new_etag = self._fetch_policy()
+        except Exception as e:
+            self._ingest({"error": f"loop: {e!r}"})
+            raise
+        delay = self.schedule.after(data is not None, self.long_poll, self.next_poll)
+        if data is None:
+            return None, delay
+        self.etag = new_etag
+        return (data, new_etag), delay
+
+    def apply(self, change):
+        data, new_etag = change
+        try:
+            res = self._apply_policies(data)
+        except Exception:
+            self.etag = self.applied_etag  # fetch it again
+            raise
+        self._ingest({
+            "result": res,
+            "rev": data.get("rev"),
+        })
+        self._persist_etag(new_etag)
+
+    def heartbeat(self):
+        self._heartbeat()
+
+    def send(self):
+        self.outbox.drain(self._post_batch, force=True)
+
+    def close(self):
+        self.session.close()
+
     # ------------- main loop -------------
 
     def run(self):
-        sleep_changed = DEFAULT_SLEEP_CHANGED
-        sleep_nochange = DEFAULT_SLEEP_NOCHANGE
-
-        while True:
-            try:
-                data, new_etag = self._fetch_policy()
-                if data is None:
-                    # No change (304 or fetch error handled), heartbeat & sleep longer
-                    self._heartbeat()
-                    # small jitter to avoid thundering herd
-                    time.sleep(sleep_nochange + random.uniform(0, 5))
-                    continue
-
-                # Apply and report
-                res = self._apply_policies(data)
-                self._ingest({
-                    "result": res,
-                    "rev": data.get("rev"),
-                })
-                self._persist_etag(new_etag)
-                self._heartbeat()
-                time.sleep(sleep_changed + random.uniform(0, 3))
-
-            except SystemExit:
-                # termination signal
-                break
-            except Exception as e:
-                # Network or other transient errors → backoff a bit
-                self._ingest({"error": f"loop: {e!r}"})
-                time.sleep(30)
+        return AgentCore(self).run()
@@ -0,0 +1,105 @@
+from __future__ import annotations
+import hashlib, logging, random, time
+from email.utils import parsedate_to_datetime
+from typing import Mapping
+
+from .util import backoff
+
+log = logging.getLogger(__name__)
+
+NEXT_POLL = "X-Next-Poll"  # server hint: seconds until this agent should poll again
+MAX_HINT_SEC = 3600        # ignore hints beyond this; a misconfigured server shouldn't park the fleet
+
+def splay(agent_id: str) -> float:
+    """Stable fraction in [0, 1) derived from the agent id: where in each interval it polls."""
+    h = hashlib.sha256(str(agent_id).encode()).digest()
+    return int.from_bytes(h[:8], "big") / 2**64
+
+def _seconds(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def hint(headers: Mapping[str, str] | None) -> float | None:
+    """
+    Seconds the server asked us to wait, from Retry-After (delta-seconds or
+    HTTP-date) or X-Next-Poll, the longer of the two; None when neither is
+    present or parseable.
+    """
+    if not headers:
+        return None
+    waits = [s for s in (_seconds(headers.get("Retry-After")), _seconds(headers.get(NEXT_POLL))) if s is not None]
+    if not waits:
+        return None
+    return min(max(waits), MAX_HINT_SEC)
+
+def error_hint(e: BaseException) -> float | None:
+    """hint() of the HTTP response an exception carries (requests.HTTPError on 429/503…)."""
+    r = getattr(e, "response", None)
+    return hint(getattr(r, "headers", None))
+
+class Backoff:
+    """Decorrelated-jitter retry delays (see util.backoff); reset() after a success."""
+    def __init__(self, base: float = 1.0, cap: float = 600):
+        self.base, self.cap = base, cap
+        self.delay = 0.0
+
+    def next(self, server_hint: float | None = None) -> float:
+        """The next delay; never shorter than what the server asked for."""
+        self.delay = backoff(self.delay, self.base, self.cap)
+        return max(self.delay, server_hint or 0.0)
+
+    def reset(self) -> None:
+        self.delay = 0.0
+
+class PollSchedule:
+    """
+    When to poll next. Each agent polls at a fixed phase of the interval
+    (splay of its id) on the wall clock, so agents restarted together still
+    spread evenly over the interval instead of polling in lockstep. Every
+    `stretch_after` 304s in a row double the interval, up to max_interval;
+    a change resets it. A server hint (Retry-After, X-Next-Poll) wins over
+    the slot, and a long-poll server is re-polled right away.
+    """
+    def __init__(self, agent_id: str, interval: float = 60, max_interval: float = 600,
+                 stretch_after: int = 10, jitter: float = 1.0):
+        self.phase = splay(agent_id)
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.stretch_after = stretch_after
+        self.jitter = jitter
+        self.unchanged = 0  # 304s in a row
+
+    @property
+    def current(self) -> float:
+        """The poll interval, stretched for the current run of 304s."""
+        if self.stretch_after <= 0:
+            return self.interval
+        doublings = min(self.unchanged // self.stretch_after, 16)
+        return min(self.max_interval, self.interval * 2 ** doublings)
+
+    def slot(self, now: float | None = None) -> float:
+        """Seconds until this agent's next slot, plus a little jitter to break ties."""
+        iv = self.current
+        now = time.time() if now is None else now
+        d = (self.phase * iv - now) % iv
+        if d < 1.0:
+            d += iv  # just polled in this slot
+        return d + random.uniform(0, self.jitter)
+
+    def after(self, changed: bool, long_poll: bool | None = None, server_hint: float | None = None) -> float:
+        """Delay after a successful fetch."""
+        self.unchanged = 0 if changed else self.unchanged + 1
+        if server_hint is not None:
+            log.debug("server asked to poll again in %.0fs", server_hint)
+            return server_hint + random.uniform(0, self.jitter)
+        if long_poll:
+            return random.uniform(0, 1)  # the server already waited for us
+        return self.slot()
@@ -0,0 +1,67 @@
+from __future__ import annotations
+import contextvars, logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable
+
+log = logging.getLogger(__name__)
+
+class DependencyCycle(Exception):
+    pass
+
+class Task:
+    """A unit of work in the rule graph. deps are indexes of other tasks."""
+    __slots__ = ("fn", "locks", "deps")
+
+    def __init__(self, fn: Callable[[], Any], locks: set[str] | None = None):
+        self.fn = fn
+        self.locks = set(locks or ())
+        self.deps: set[int] = set()
+
+def run(tasks: list[Task], max_workers: int = 1) -> list[Any]:
+    """
+    Run tasks on a bounded pool once their deps are done and none of their
+    locks is held by a running task. Returns each task's return value (or the
+    exception it raised) in task order; tasks stuck behind a cycle get a
+    DependencyCycle instead. Ready tasks are started lowest index first, so
+    max_workers=1 degrades to plain in-order execution.
+    """
+    workers = max(1, int(max_workers))
+    out: list[Any] = [None] * len(tasks)
+    waiting = {i: set(t.deps) for i, t in enumerate(tasks)}
+    users: dict[int, list[int]] = {i: [] for i in range(len(tasks))}
+    for i, t in enumerate(tasks):
+        for d in t.deps:
+            users[d].append(i)
+    ready = [i for i, d in waiting.items() if not d]
+    started: set[int] = set()
+    held: set[str] = set()
+    running: dict[Any, int] = {}
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lpp-rule") as pool:
+        while ready or running:
+            for i in sorted(ready):
+                if len(running) >= workers:
+                    break
+                if tasks[i].locks & held:
+                    continue
+                ready.remove(i); started.add(i)
+                held |= tasks[i].locks
+                running[pool.submit(contextvars.copy_context().run, tasks[i].fn)] = i  # keeps the cycle id/span
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                i = running.pop(f)
+                held -= tasks[i].locks
+                try:
+                    out[i] = f.result()
+                except Exception as e:
+                    out[i] = e
+                for u in users[i]:
+                    waiting[u].discard(i)
+                    if not waiting[u] and u not in started:
+                        ready.append(u)
+
+    for i in range(len(tasks)):
+        if i not in started:
+            log.warning("task %d not run: dependency cycle", i)
+            out[i] = DependencyCycle("dependency cycle")
+    return out
@@ -0,0 +1,306 @@
+from __future__ import annotations
+import logging, os, re, selectors, subprocess, threading, time, uuid
+from pathlib import Path
+from typing import Callable
+
+from . import capture, metrics
+from .budget import budget
+from .facts import facts
+
+log = logging.getLogger(__name__)
+
+# Policy bash runs in a non-login shell. The environment a login shell would
+# set up (PATH additions from /etc/profile.d, proxies, …) is captured once with
+# `bash -lc`, sanitized, and reused until facts expire, a package transaction
+# calls invalidate(), or a file a login shell reads changes (checked with a few
+# stat calls before every script, so a policy that drops a profile.d script is
+# seen by the next one). Short scripts go to a small pool of
+# persistent `bash` workers, each running a job in a forked subshell: no exec,
+# no startup, no profile. Scripts that stream live output, or when the pool
+# is off (size 0), get a fresh `bash -c`.
+
+FALLBACK_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+# shell and session state that must not leak from the snapshot into scripts
+DROP = frozenset({"_", "PWD", "OLDPWD", "SHLVL", "PS1", "PS2", "PS3", "PS4", "PROMPT_COMMAND",
+                  "BASH_ENV", "ENV", "HISTFILE", "MAIL", "SSH_AUTH_SOCK", "SSH_CONNECTION", "SSH_TTY"})
+SNAPSHOT_TIMEOUT = 60
+ENV_MARK = b"\0__lpp_env__\0"
+# what a login bash reads
+PROFILE = ("/etc/profile", "/etc/profile.d", "/etc/environment", "/etc/bash.bashrc", "/etc/bashrc")
+HOME_PROFILE = (".bash_profile", ".bash_login", ".profile", ".bashrc")
+
+login_env = True  # snapshot the login environment; False = the agent's own, sanitized
+
+_env: dict[str, str] | None = None
+_env_at = 0.0
+_env_sig: tuple = ()
+_gen = 0  # bumped with every new snapshot; workers started on an older one retire
+_env_lock = threading.Lock()
+
+def _sanitize(raw: dict[str, str]) -> dict[str, str]:
+    env = {k: v for k, v in raw.items() if k not in DROP and not k.startswith("BASH_FUNC_")}
+    env.setdefault("PATH", FALLBACK_PATH)
+    return env
+
+def _snapshot() -> dict[str, str]:
+    if login_env:
+        try:
+            cp = subprocess.run(["bash", "-lc", "printf '\\0__lpp_env__\\0'; env -0"], stdin=subprocess.DEVNULL,
+                                capture_output=True, timeout=SNAPSHOT_TIMEOUT)
+            _, mark, out = cp.stdout.partition(ENV_MARK)  # whatever the profile printed comes first
+            if cp.returncode == 0 and mark:
+                raw = dict(kv.partition("=")[::2] for kv in out.decode(errors="replace").split("\0") if "=" in kv)
+                return _sanitize(raw)
+            log.warning("login environment snapshot failed (rc=%s); using the agent's", cp.returncode)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            log.warning("login environment snapshot failed: %s; using the agent's", e)
+    return _sanitize(dict(os.environ))
+
+def _profile() -> tuple:
+    """Stats of the files a login shell reads; it changes when any of them does."""
+    home = os.environ.get("HOME") or "/root"
+    paths = list(PROFILE) + [os.path.join(home, f) for f in HOME_PROFILE]
+    try:
+        paths += sorted(e.path for e in os.scandir("/etc/profile.d"))
+    except OSError:
+        pass
+    out = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            out.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
+def env() -> dict[str, str]:
+    """The environment policy bash runs with."""
+    global _env, _env_at, _env_sig, _gen
+    with _env_lock:
+        sig = _profile() if login_env else ()
+        if _env is None or sig != _env_sig or time.monotonic() - _env_at >= facts.ttl:
+            _env, _env_at, _env_sig = _snapshot(), time.monotonic(), sig
+            _gen += 1
+        return _env
+
+def invalidate() -> None:
+    """Take a new snapshot on next use (after anything that may change the profile)."""
+    global _env
+    with _env_lock:
+        _env = None
+    pool.retire()
+
+# The worker reads NUL-terminated jobs on stdin and runs each in a subshell
+# with stdin from /dev/null, without the loop's own variables, and (set -m)
+# in a process group of its own: what a job leaves running in the background
+# isn't killed with the worker. After a job it writes "\n<token> <rc>\n" and
+# the output of `times` (its children's CPU so far) to stdout, and
+# "\n<token>\n" to stderr; the leading newline is its own, so the job's
+# output is exact.
+LOOP = r"""__lpp_done=$1; shift
+set -m
+while IFS= read -r -d '' __lpp_job; do
+  ( eval "unset __lpp_done __lpp_job __lpp_rc; $__lpp_job" ) </dev/null
+  __lpp_rc=$?
+  printf '\n%s %d\n' "$__lpp_done" "$__lpp_rc"
+  times
+  printf '\n%s\n' "$__lpp_done" >&2
+done
+"""
+TIMES = re.compile(rb"(\d+)m([\d.]+)s")
+
+class WorkerDied(OSError):
+    pass
+
+class Worker:
+    """One persistent `bash` running jobs in subshells; see LOOP."""
+    def __init__(self):
+        environ = env()
+        self.gen = _gen
+        self.token = f"__lpp_done_{uuid.uuid4().hex}"
+        self.marker = ("\n" + self.token).encode()
+        self.jobs = 0
+        self.cpu = (0.0, 0.0)  # children's user/sys seconds reported after the last job
+        # own session: a timeout kills the worker and everything a job started
+        self.proc = subprocess.Popen(["bash", "-c", LOOP, "bash", self.token], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environ,
+                                     start_new_session=True)
+        self.cg = budget.confine(self.proc.pid)  # jobs share the worker's cgroup; per job, `times` accounts
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def run(self, code: str, timeout: float | None = None) -> capture.Captured:
+        if "\0" in code:
+            raise ValueError("script contains a NUL byte")
+        argv = ["bash", "-c", code]
+        start = time.monotonic()
+        self.proc.stdin.write(code.encode() + b"\0")
+        self.proc.stdin.flush()
+        self.jobs += 1
+        rings = {"stdout": capture.Ring(), "stderr": capture.Ring()}
+        pending = {"stdout": bytearray(), "stderr": bytearray()}
+        found: set[str] = set()
+        keep = len(self.marker) - 1
+        deadline = start + timeout if timeout else None
+
+        def complete() -> bool:
+            # the stdout trailer is three lines: rc, and the two of `times`
+            return ("stdout" in found and pending["stdout"].count(b"\n") >= 3
+                    and "stderr" in found and b"\n" in pending["stderr"])
+
+        sel = selectors.DefaultSelector()
+        sel.register(self.proc.stdout, selectors.EVENT_READ, "stdout")
+        sel.register(self.proc.stderr, selectors.EVENT_READ, "stderr")
+        try:
+            while not complete():
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    self.close(kill=True)
+                    raise subprocess.TimeoutExpired(argv, timeout, output=rings["stdout"].text(),
+                                                    stderr=rings["stderr"].text())
+                for key, _ in sel.select(timeout=wait):
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        self.close(kill=True)
+                        raise WorkerDied("bash worker exited mid-job")
+                    buf = pending[key.data]
+                    buf += chunk
+                    if key.data in found:
+                        continue
+                    i = buf.find(self.marker)
+                    if i < 0:
+                        if len(buf) > keep:  # hold back what could be the start of the marker
+                            rings[key.data].feed(bytes(buf[:-keep]))
+                            del buf[:-keep]
+                        continue
+                    rings[key.data].feed(bytes(buf[:i]))
+                    del buf[:i + len(self.marker)]
+                    found.add(key.data)
+        finally:
+            sel.close()
+        trailer = bytes(pending["stdout"]).split(b"\n")
+        rc = int(trailer[0])
+        children = TIMES.findall(trailer[2])
+        cpu = tuple(int(m) * 60 + float(s) for m, s in children) if len(children) == 2 else self.cpu
+        usage = {
+            "wall_s": round(time.monotonic() - start, 3),
+            "cpu_user_s": round(max(0.0, cpu[0] - self.cpu[0]), 3),
+            "cpu_sys_s": round(max(0.0, cpu[1] - self.cpu[1]), 3),
+        }
+        self.cpu = cpu
+        return capture.Captured(argv, rc, rings["stdout"].text(), rings["stderr"].text(), usage)
+
+    def close(self, kill: bool = False) -> None:
+        if kill:
+            for pid in _children(self.proc.pid):
+                budget.kill(pid)  # the job running, in its own group
+            budget.kill(self.proc.pid, self.cg)
+        for f in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                f.close()
+            except OSError:
+                pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        if self.cg:
+            self.cg.remove()
+
+def _children(pid: int) -> list[int]:
+    """Pids of pid's child processes (empty without /proc)."""
+    try:
+        return [int(c) for c in Path(f"/proc/{pid}/task/{pid}/children").read_text().split()]
+    except (OSError, ValueError):
+        pass  # no CONFIG_PROC_CHILDREN: scan every process
+    out = []
+    for e in os.scandir("/proc") if os.path.isdir("/proc") else ():
+        if e.name.isdigit():
+            try:
+                stat = Path(e.path, "stat").read_text()
+            except OSError:
+                continue
+            if int(stat.rpartition(")")[2].split()[1]) == pid:
+                out.append(int(e.name))
+    return out
+
+class Pool:
+    """
+    Idle workers, up to `size`; a busy pool starts extra ones and closes
+    them when they come back. Workers retire after MAX_JOBS jobs, or when the
+    environment snapshot they were started with is replaced.
+    """
+    MAX_JOBS = 200
+
+    def __init__(self, size: int = 2):
+        self.size = size
+        self._idle: list[Worker] = []
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> Worker:
+        with self._lock:
+            while self._idle:
+                w = self._idle.pop()
+                if w.alive() and w.gen == _gen:
+                    return w
+                w.close()
+        return Worker()
+
+    def _release(self, w: Worker) -> None:
+        with self._lock:
+            if w.alive() and w.gen == _gen and w.jobs < self.MAX_JOBS and len(self._idle) < self.size:
+                self._idle.append(w)
+                return
+        w.close()
+
+    def run(self, code: str, timeout: float | None = None) -> capture.Captured:
+        t = time.monotonic()
+        w = self._acquire()
+        overhead = time.monotonic() - t
+        try:
+            cp = w.run(code, timeout)
+        except BaseException:
+            w.close(kill=True)
+            raise
+        self._release(w)
+        cp.usage.update(executor="worker", overhead_ms=round(overhead * 1000, 3))
+        return cp
+
+    def warm(self) -> None:
+        """Start idle workers up to size (and take the environment snapshot)."""
+        env()
+        while True:
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    return
+            self._release(Worker())
+
+    def retire(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for w in idle:
+            w.close()  # idle: bash exits at end of input, leaving what jobs started
+
+    def close(self) -> None:
+        self.retire()
+
+pool = Pool()
+
+def run(code: str, timeout: float | None = None,
+        on_output: Callable[[str, bytes], None] | None = None) -> capture.Captured:
+    """
+    Run a bash script; returns capture.Captured with `executor` and
+    `overhead_ms` (time to get a shell to run it in) in its usage. Raises
+    subprocess.TimeoutExpired like capture.run.
+    """
+    if on_output is None and pool.size > 0:
+        env()  # a changed login environment retires the pool's workers
+        cp = pool.run(code, timeout)
+    else:
+        cp = capture.run(["bash", "-c", code], timeout=timeout, env=env(), on_output=on_output)
+        cp.usage["executor"] = "spawn"
+    metrics.registry.observe("lpp_exec_overhead_seconds", cp.usage.get("overhead_ms", 0) / 1000,
+                             executor=cp.usage["executor"])
+    return cp
@@ -0,0 +1,231 @@
+from __future__ import annotations
+import gzip, heapq, json, logging, queue, random, tempfile, threading, time
+from pathlib import Path
+from typing import Any
+
+from . import plan
+from .http import Api
+from .schedule import Backoff, PollSchedule, error_hint
+from .standin import StandIn
+
+log = logging.getLogger(__name__)
+
+class Metrics:
+    """Per-request samples, bucketed by report interval."""
+    def __init__(self, bucket_sec: float):
+        self.bucket_sec = bucket_sec
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+        self._buckets: dict[int, dict[str, Any]] = {}
+
+    def _bucket(self) -> dict[str, Any]:
+        n = int((time.monotonic() - self.start) // self.bucket_sec)
+        return self._buckets.setdefault(n, {"requests": 0, "not_modified": 0, "changed": 0, "errors": 0,
+                                            "latency": [], "ingest_bytes": 0, "ingest_results": 0})
+
+    def record(self, status: str, latency: float, ingest: tuple[int, int] | None = None) -> None:
+        with self._lock:
+            b = self._bucket()
+            b["requests"] += 1
+            b["latency"].append(latency)
+            if status in ("not_modified", "changed", "errors"):
+                b[status] += 1
+            if ingest:
+                b["ingest_bytes"] += ingest[0]
+                b["ingest_results"] += ingest[1]
+
+    def buckets(self) -> list[tuple[int, dict[str, Any]]]:
+        with self._lock:
+            return sorted(self._buckets.items())
+
+def _pct(xs: list[float], q: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * (len(xs) - 1) + 0.5))]
+
+def summarize(b: dict[str, Any], seconds: float) -> dict[str, Any]:
+    polls = b["not_modified"] + b["changed"]
+    return {
+        "req_per_s": round(b["requests"] / seconds, 1),
+        "ratio_304": round(b["not_modified"] / polls, 3) if polls else None,
+        "p50_ms": round(_pct(b["latency"], 0.50) * 1000, 1),
+        "p99_ms": round(_pct(b["latency"], 0.99) * 1000, 1),
+        "errors": b["errors"],
+        "ingest_kb": round(b["ingest_bytes"] / 1024, 1),
+        "ingest_results": b["ingest_results"],
+    }
+
+def _merge(buckets: list[dict[str, Any]]) -> dict[str, Any]:
+    out = {"requests": 0, "not_modified": 0, "changed": 0, "errors": 0, "latency": [],
+           "ingest_bytes": 0, "ingest_results": 0}
+    for b in buckets:
+        for k, v in b.items():
+            out[k] += v
+    return out
+
+class VirtualAgent:
+    """One simulated host: the real Api client, poll schedule and ETag, with a no-op executor."""
+    __slots__ = ("agent_id", "api", "schedule", "retry", "etag", "rev")
+
+    def __init__(self, agent_id: str, base: str, pool_size: int, schedule: PollSchedule):
+        self.agent_id = agent_id
+        self.api = Api(base, pool_size=pool_size, retries=0)
+        self.schedule = schedule
+        self.retry = Backoff()
+        self.etag: str | None = None
+        self.rev: int | None = None
+
+class Simulation:
+    """
+    N virtual agents in one process. Each runs the agent's policy loop against
+    `api`: long-poll or conditional GET of the effective policy, a no-op
+    apply that reports one "pass" per rule as a gzip ingest batch, and
+    heartbeats. A pool of daemon worker threads serves whichever agents are
+    due, so polling agents don't need a thread each; workers=0 sizes the pool
+    for the load (one per agent when long-polling, which holds a worker).
+    Plans are compiled into a scratch cache, removed when run() returns,
+    never into the host's.
+    """
+    def __init__(self, api: str, agents: int, interval: float = 60, jitter: float = 1,
+                 long_poll_sec: int = 55, heartbeat_sec: float = 30, ramp: float = 0,
+                 workers: int = 0, report_sec: float = 5, max_interval: float = 600,
+                 stretch_after: int = 10):
+        self.base = api
+        self.long_poll_sec, self.heartbeat_sec = long_poll_sec, heartbeat_sec
+        self.metrics = Metrics(report_sec)
+        self._plan_dir = tempfile.TemporaryDirectory(prefix="lpp-sim-plans-", ignore_cleanup_errors=True)
+        self.plans = plan.PlanCache(Path(self._plan_dir.name))
+        self.agents = [VirtualAgent(f"sim-{n}", api, pool_size=2,
+                                    schedule=PollSchedule(f"sim-{n}", interval, max_interval, stretch_after, jitter))
+                       for n in range(agents)]
+        self._due: list[tuple[float, int, int, str]] = []
+        self._seq = 0
+        self._cv = threading.Condition()
+        self._work: queue.Queue[tuple[int, str]] = queue.Queue()
+        self._stopped = False
+        now = time.monotonic()
+        for n in range(agents):
+            self._push(now + random.uniform(0, ramp), n, "poll")
+            self._push(now + random.uniform(0, heartbeat_sec), n, "heartbeat")
+        if not workers:
+            workers = agents + 64 if long_poll_sec else min(256, agents * 2)
+        self._workers = [threading.Thread(target=self._worker, name=f"sim-{n}", daemon=True)
+                         for n in range(max(1, workers))]
+
+    def _push(self, at: float, n: int, kind: str) -> None:
+        with self._cv:
+            self._seq += 1
+            heapq.heappush(self._due, (at, self._seq, n, kind))
+            self._cv.notify()
+
+    def _poll(self, a: VirtualAgent) -> float:
+        t = time.monotonic()
+        try:
+            changed, policies, etag, rev = a.api.watch_policy(a.agent_id, a.etag, wait=self.long_poll_sec, retries=0)
+        except Exception as e:
+            self.metrics.record("errors", time.monotonic() - t)
+            return a.retry.next(error_hint(e))
+        a.retry.reset()
+        self.metrics.record("changed" if changed else "not_modified", time.monotonic() - t)
+        if changed:
+            a.etag, a.rev = etag, rev
+            self._report(a, policies)
+        return a.schedule.after(changed, a.api.long_poll, a.api.next_poll)
+
+    def _report(self, a: VirtualAgent, policies: list[dict[str, Any]]) -> None:
+        results = []
+        for p in policies:
+            try:
+                rules = self.plans.get(p.get("yaml") or "").rules
+            except plan.PolicyError:
+                rules = []
+            results += [{"id": r.get("id"), "type": r.get("type"), "status": "pass",
+                         "policy_id": p.get("id"), "agent_id": a.agent_id, "rev": a.rev} for r in rules]
+        if not results:
+            return
+        body = gzip.compress(json.dumps({"agent_id": a.agent_id, "results": results, "rev": a.rev},
+                                        separators=(",", ":")).encode())
+        t = time.monotonic()
+        try:
+            a.api.post_batch(body, f"{a.agent_id}-{a.rev}")
+            self.metrics.record("ingest", time.monotonic() - t, (len(body), len(results)))
+        except Exception:
+            self.metrics.record("errors", time.monotonic() - t)
+
+    def _worker(self) -> None:
+        while True:
+            n, kind = self._work.get()
+            a = self.agents[n]
+            if kind == "poll":
+                delay = self._poll(a)
+            else:
+                t = time.monotonic()
+                a.api.heartbeat(a.agent_id)  # never raises
+                self.metrics.record("heartbeat", time.monotonic() - t)
+                delay = self.heartbeat_sec
+            if not self._stopped:
+                self._push(time.monotonic() + delay, n, kind)
+
+    def run(self, duration: float, on_report=None) -> dict[str, Any]:
+        for w in self._workers:
+            w.start()
+        end = time.monotonic() + duration
+        next_report = self.metrics.start + self.metrics.bucket_sec
+        reported = 0
+        while True:
+            now = time.monotonic()
+            if now >= next_report:
+                done = [b for i, b in self.metrics.buckets() if i == reported]
+                if on_report:
+                    on_report(reported * self.metrics.bucket_sec,
+                              summarize(done[0] if done else _merge([]), self.metrics.bucket_sec))
+                reported += 1
+                next_report += self.metrics.bucket_sec
+            if now >= end:
+                break
+            with self._cv:
+                while self._due and self._due[0][0] <= now:
+                    _, _, n, kind = heapq.heappop(self._due)
+                    self._work.put((n, kind))
+                wake = min(end, next_report, self._due[0][0] if self._due else end)
+                self._cv.wait(max(0.0, wake - time.monotonic()))
+        self._stopped = True
+        self._plan_dir.cleanup()
+        elapsed = time.monotonic() - self.metrics.start
+        return summarize(_merge([b for _, b in self.metrics.buckets()]), elapsed)
+
+def run(api: str | None, agents: int, duration: float, bump_every: float = 0, policies: int = 5,
+        **kw: Any) -> int:
+    """`lpp-agent simulate`: drive the fleet and print one line per report interval plus totals."""
+    srv = None
+    if not api:
+        pols = [{"id": f"sim-pol-{n}", "yaml": json.dumps({"rules": [
+            {"id": f"sim-pol-{n}-{m}", "type": "pkg.ensure", "name": f"pkg{m}"} for m in range(10)]})}
+            for n in range(policies)]
+        srv = StandIn(pols, long_poll=kw.get("long_poll_sec", 55) > 0).start()
+        api = srv.url
+        log.info("Stand-in server on %s", api)
+    sim = Simulation(api, agents, **kw)
+
+    def bumper():
+        while not sim._stopped:
+            time.sleep(bump_every)
+            if srv and not sim._stopped:
+                srv.bump()
+                print(f"# policy rev bumped to {srv.rev}", flush=True)
+    if bump_every and srv:
+        threading.Thread(target=bumper, daemon=True).start()
+
+    print(f"{'t':>6} {'req/s':>8} {'304':>6} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7} {'ingest KB':>10}")
+
+    def line(t: float, s: dict[str, Any]):
+        ratio = f"{s['ratio_304']:.0%}" if s["ratio_304"] is not None else "-"
+        print(f"{t:>6.0f} {s['req_per_s']:>8} {ratio:>6} {s['p50_ms']:>8} {s['p99_ms']:>8} "
+              f"{s['errors']:>7} {s['ingest_kb']:>10}", flush=True)
+
+    total = sim.run(duration, on_report=line)
+    print("total  " + json.dumps(total))
+    if srv:
+        srv.stop()
+    return 0
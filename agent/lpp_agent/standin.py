@@ -0,0 +1,170 @@
+from __future__ import annotations
+import gzip, json, re, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+# Local stand-in for the control-plane endpoints the agent talks to. Used by
+# agent/bench and `lpp-agent simulate`; not a server to deploy.
+
+_POLICY = re.compile(r"^/agents/([^/]+)/effective-policy$")
+_HEARTBEAT = re.compile(r"^/agents/([^/]+)/heartbeat$")
+_OUTPUT = re.compile(r"^/agents/([^/]+)/output$")
+_WAIT = re.compile(r"\bwait=(\d+)")
+
+class Stats:
+    """Counters of what went over the wire; read them under `lock`."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self.statuses: dict[int, int] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ingest_results = 0
+        self.ingest_bytes = 0
+
+    def snapshot(self) -> dict[str, Any]:
+        with self.lock:
+            return {"requests": dict(self.requests), "statuses": dict(self.statuses),
+                    "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "ingest_results": self.ingest_results, "ingest_bytes": self.ingest_bytes}
+
+class _Counting:
+    def __init__(self, raw, stats: Stats):
+        self.raw, self.stats = raw, stats
+
+    def write(self, b) -> int:
+        with self.stats.lock:
+            self.stats.bytes_out += len(b)
+        return self.raw.write(b)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "StandIn"
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def setup(self):
+        super().setup()
+        self.wfile = _Counting(self.wfile, self.server.stats)
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(n) if n else b""
+        with self.server.stats.lock:
+            self.server.stats.bytes_in += len(self.requestline) + 2 + len(str(self.headers)) + len(body)
+        return body
+
+    def _reply(self, endpoint: str, status: int, body: Any = None, headers: dict[str, str] | None = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        with self.server.stats.lock:
+            st = self.server.stats
+            st.requests[endpoint] = st.requests.get(endpoint, 0) + 1
+            st.statuses[status] = st.statuses.get(status, 0) + 1
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def do_GET(self):
+        self._body()
+        path, _, query = self.path.partition("?")
+        m = _POLICY.match(path)
+        if not m:
+            return self._reply("other", 404, {"error": "not found"})
+        srv = self.server
+        etag = f'W/"rev-{srv.rev}"'
+        if self.headers.get("If-None-Match") == etag:
+            wait = 0
+            if srv.long_poll:
+                w = _WAIT.search(self.headers.get("Prefer", "")) or _WAIT.search(query)
+                wait = min(int(w.group(1)), srv.max_wait) if w else 0
+            if wait:
+                with srv.changed:
+                    srv.changed.wait_for(lambda: f'W/"rev-{srv.rev}"' != etag, timeout=wait)
+                etag = f'W/"rev-{srv.rev}"'
+            if self.headers.get("If-None-Match") == etag:
+                hdrs = {"ETag": etag, **({"Preference-Applied": f"wait={wait}"} if wait else {})}
+                return self._reply("effective-policy", 304, None, hdrs)
+        with srv.changed:
+            policies, rev = list(srv.policies), srv.rev
+        self._reply("effective-policy", 200, {"agent_id": m.group(1), "policies": policies, "rev": rev},
+                    {"ETag": f'W/"rev-{rev}"'})
+
+    def do_POST(self):
+        body = self._body()
+        path = self.path.partition("?")[0]
+        if _HEARTBEAT.match(path):
+            return self._reply("heartbeat", 200, {"ok": True})
+        if _OUTPUT.match(path):
+            return self._reply("output", 200, {"ok": True})
+        if path == "/agents/enroll":
+            with self.server.stats.lock:
+                n = sum(self.server.stats.requests.values())
+            return self._reply("enroll", 200, {"agent_id": n + 1, "device_jwt": "standin"})
+        if path == "/results/ingest":
+            raw = gzip.decompress(body) if self.headers.get("Content-Encoding") == "gzip" else body
+            try:
+                results = json.loads(raw).get("results") or []
+            except ValueError:
+                return self._reply("ingest", 400, {"error": "bad json"})
+            with self.server.stats.lock:
+                self.server.stats.ingest_results += len(results)
+                self.server.stats.ingest_bytes += len(body)
+            return self._reply("ingest", 200, {"ok": True})
+        self._reply("other", 404, {"error": "not found"})
+
+class StandIn(ThreadingHTTPServer):
+    """
+    effective-policy (ETag, optional long-poll), heartbeat, output, enroll
+    and results/ingest (gzip) on 127.0.0.1. Every agent gets the same policy
+    set; bump() publishes a new rev. Use as a context manager.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, policies: list[dict[str, Any]] | None = None, long_poll: bool = False,
+                 max_wait: int = 120, port: int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.policies = list(policies or [])
+        self.rev = 1
+        self.long_poll = long_poll
+        self.max_wait = max_wait
+        self.changed = threading.Condition()
+        self.stats = Stats()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def bump(self, policies: list[dict[str, Any]] | None = None) -> None:
+        with self.changed:
+            if policies is not None:
+                self.policies = list(policies)
+            self.rev += 1
+            self.changed.notify_all()
+
+    def start(self) -> "StandIn":
+        self._thread = threading.Thread(target=self.serve_forever, name="standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "StandIn":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,187 @@
+from __future__ import annotations
+import contextlib, json, logging, os, sqlite3, threading, time
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from .config import STATE_DIR, STATE_FILE
+
+log = logging.getLogger(__name__)
+
+# Local state in SQLite (WAL): the sections that used to live in state.json
+# (etags, revs, applied policy digests, …) as key/value rows, plus a bounded
+# history of runs and per-rule results for `lpp-agent history`. Writers (the
+# agent, `lpp-agent once`) and readers (history) can share the file; every
+# write is one transaction.
+DB_FILE = STATE_DIR/"state.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    section TEXT NOT NULL,
+    key     TEXT NOT NULL,
+    value   TEXT NOT NULL,            -- JSON
+    PRIMARY KEY (section, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS runs (
+    id     TEXT PRIMARY KEY,
+    ts     REAL NOT NULL,
+    mode   TEXT,                      -- delta, diff, full, remove, scan
+    rev    TEXT,
+    ms     REAL,
+    rules  INTEGER,
+    failed INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_ts ON runs (ts);
+CREATE TABLE IF NOT EXISTS results (
+    run    TEXT NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    ts     REAL NOT NULL,
+    policy TEXT,
+    rule   TEXT,
+    type   TEXT,
+    status TEXT,
+    ms     REAL,
+    cache  TEXT,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS results_rule ON results (rule, ts);
+CREATE INDEX IF NOT EXISTS results_ts ON results (ts);
+CREATE INDEX IF NOT EXISTS results_run ON results (run);
+"""
+FAILED = ("error", "skipped", "deferred", "drift")
+DETAIL_CHARS = 500
+
+class Store:
+    def __init__(self, path: str | Path = DB_FILE, readonly: bool = False):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        if readonly:
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+            os.close(fd)
+            self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints; a crash loses at most the last commits
+            self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        if not readonly:
+            self.db.executescript(SCHEMA)
+            self._migrate()
+
+    @contextlib.contextmanager
+    def _tx(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def _migrate(self) -> None:
+        """Import state.json once (both its schemas) and move it aside."""
+        if not STATE_FILE.exists():
+            return
+        try:
+            data = json.loads(STATE_FILE.read_text())
+        except (OSError, ValueError) as e:
+            log.warning("not migrating %s: %s", STATE_FILE, e)
+            return
+        rows: list[tuple[str, str, Any]] = []
+        for section, val in data.items():
+            if isinstance(val, dict):
+                rows += [(section, str(k), v) for k, v in val.items()]
+        if data.get("etag") and data.get("api") and data.get("agent_id"):  # runner.py's flat schema
+            from .config import state_key
+            rows.append(("runner_etags", state_key(data["api"], str(data["agent_id"])), data["etag"]))
+        with self._tx() as db:
+            db.executemany("INSERT OR IGNORE INTO kv VALUES (?, ?, ?)",
+                           [(s, k, json.dumps(v)) for s, k, v in rows])
+        try:
+            os.replace(STATE_FILE, STATE_FILE.with_name(STATE_FILE.name + ".migrated"))
+        except OSError:
+            return  # another process got there first
+        log.info("migrated %d entries from %s to %s", len(rows), STATE_FILE, self.path)
+
+    # ---- key/value state ----
+
+    def load(self) -> dict[str, dict[str, Any]]:
+        out: dict[str, dict[str, Any]] = {}
+        with self._lock:
+            for section, key, value in self.db.execute("SELECT section, key, value FROM kv"):
+                out.setdefault(section, {})[key] = json.loads(value)
+        return out
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self.db.execute("SELECT value FROM kv WHERE section = ? AND key = ?", (section, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, items: Iterable[tuple[str, str, Any]]) -> None:
+        """Set (section, key, value) entries in one transaction; a None value deletes."""
+        items = list(items)
+        with self._tx() as db:
+            db.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                           [(s, k, json.dumps(v, separators=(",", ":"))) for s, k, v in items if v is not None])
+            db.executemany("DELETE FROM kv WHERE section = ? AND key = ?",
+                           [(s, k) for s, k, v in items if v is None])
+
+    # ---- history ----
+
+    def record_run(self, run: str, mode: str, rev: Any, ms: float, results: list[dict[str, Any]],
+                   max_runs: int = 500, max_age_sec: float = 30 * 86400) -> None:
+        """Add a run and its per-rule results, then prune past the retention limits."""
+        now = time.time()
+        rows = [(run, now, _s(r.get("policy_id")), _s(r.get("id")), r.get("type"), r.get("status"),
+                 r.get("ms"), r.get("cache"), (str(r["detail"])[:DETAIL_CHARS] if r.get("detail") else None))
+                for r in results]
+        failed = sum(1 for r in results if r.get("status") in FAILED)
+        with self._tx() as db:
+            db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (run, now, mode, _s(rev), round(ms, 1), len(results), failed))
+            db.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            db.execute("DELETE FROM runs WHERE ts < ? OR id IN "
+                       "(SELECT id FROM runs ORDER BY ts DESC LIMIT -1 OFFSET ?)", (now - max_age_sec, max_runs))
+
+    def _query(self, sql: str, args: tuple = ()) -> list[dict[str, Any]]:
+        with self._lock:
+            cur = self.db.execute(sql, args)
+            cols = [c[0] for c in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def runs(self, limit: int = 20, since: float = 0) -> list[dict[str, Any]]:
+        return self._query("SELECT * FROM runs WHERE ts >= ? ORDER BY ts DESC LIMIT ?", (since, limit))
+
+    def rule(self, rule: str, limit: int = 50, since: float = 0) -> list[dict[str, Any]]:
+        return self._query("SELECT results.*, runs.mode, runs.rev FROM results JOIN runs ON runs.id = results.run "
+                           "WHERE rule = ? AND results.ts >= ? ORDER BY results.ts DESC LIMIT ?",
+                           (rule, since, limit))
+
+    def slowest(self, limit: int = 20, since: float = 0) -> list[dict[str, Any]]:
+        return self._query("SELECT policy, rule, type, COUNT(*) AS runs, ROUND(AVG(ms), 1) AS avg_ms, "
+                           "MAX(ms) AS max_ms FROM results WHERE ms IS NOT NULL AND ts >= ? "
+                           "GROUP BY policy, rule, type ORDER BY avg_ms DESC LIMIT ?", (since, limit))
+
+    def failures(self, limit: int = 50, since: float = 0) -> list[dict[str, Any]]:
+        marks = ",".join("?" * len(FAILED))
+        return self._query(f"SELECT * FROM results WHERE status IN ({marks}) AND ts >= ? "
+                           "ORDER BY ts DESC LIMIT ?", (*FAILED, since, limit))
+
+    def close(self) -> None:
+        with self._lock:
+            self.db.close()
+
+def _s(v: Any) -> str | None:
+    return None if v is None else str(v)
+
+_store: Store | None = None
+_store_lock = threading.Lock()
+
+def get() -> Store:
+    """The process-wide store, opened (and state.json migrated) on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = Store()
+        return _store
@@ -1,5 +1,7 @@
 from __future__ import annotations
-import subprocess, time, logging
+import os, random, subprocess, tempfile, time, logging
+from pathlib import Path
+from .facts import facts
 
 log = logging.getLogger(__name__)
 
@@ -10,12 +12,63 @@ def run(cmd: list[str], check=False, input_text: str|None=None) -> subprocess.Co
 
 def distro_id() -> str:
     try:
-        out = run(["bash", "-lc", ". /etc/os-release && echo ${ID}-${VERSION_ID}"]).stdout.strip()
-        return out or "linux-unknown"
+        return facts.get("distro")
     except Exception:
         return "linux-unknown"
 
-def backoff_sleep(attempt: int, base=2.0, cap=600) -> int:
-    delay = min(int(base ** attempt), cap)
+def backoff(prev: float, base: float = 1.0, cap: float = 600) -> float:
+    """
+    Decorrelated jitter: the retry delay after one of `prev` seconds (0 on the
+    first failure). Grows about 3x per failure up to `cap`, but each client
+    draws its own delay, so a fleet recovering from an outage doesn't retry
+    in step.
+    """
+    return min(cap, random.uniform(base, max(base, prev) * 3))
+
+def backoff_sleep(prev: float = 0, base=2.0, cap=600) -> float:
+    """Sleep for backoff(prev); pass the result back in on the next failure."""
+    delay = backoff(prev, base, cap)
     time.sleep(delay)
     return delay
+
+def atomic_write(path: str | Path, data: bytes | str, mode: int = 0o644) -> None:
+    """
+    Write via tempfile + fsync + rename; keeps the mode/owner of an existing
+    file. A symlink is followed: its target is replaced, the link stays.
+    """
+    p = Path(os.path.realpath(path))
+    p.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode()
+    try:
+        st = p.stat()
+        mode, owner = st.st_mode & 0o7777, (st.st_uid, st.st_gid)
+    except FileNotFoundError:
+        owner = None
+    fd, tmp = tempfile.mkstemp(prefix=f".{p.name}.", dir=p.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        if owner:
+            try:
+                os.chown(tmp, *owner)
+            except PermissionError:
+                pass
+        os.replace(tmp, p)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    try:
+        dfd = os.open(p.parent, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+    except OSError:
+        pass
@@ -0,0 +1,10 @@
+"""
+Every test runs with LPP_{CONF,STATE,LOG}_DIR under a temp dir, set before
+lpp_agent is imported, so nothing on the host is read or written.
+"""
+from __future__ import annotations
+import os, tempfile
+
+_root = tempfile.mkdtemp(prefix="lpp-tests-")
+for name in ("CONF", "STATE", "LOG"):
+    os.environ.setdefault(f"LPP_{name}_DIR", os.path.join(_root, name.lower()))
@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import pytest
+
+from lpp_agent import config
+
+@pytest.fixture
+def conf_file(tmp_path, monkeypatch):
+    path = tmp_path/"agent.toml"
+    monkeypatch.setattr(config, "CONF_DIR", tmp_path)
+    monkeypatch.setattr(config, "CONF_FILE", path)
+    return path
+
+def test_save_writes_only_what_differs_from_defaults(conf_file):
+    cfg = config.load_conf()
+    cfg.update(agent_id="42", api=config.DEFAULTS["api"], interval_sec=30)
+    config.save_conf(cfg)
+    text = conf_file.read_text()
+    assert 'agent_id = "42"' in text and "interval_sec = 30" in text
+    assert "api = " in text  # enrollment is pinned even when it equals the default
+    assert "long_poll_sec" not in text and "heartbeat_sec" not in text
+    again = config.load_conf()
+    assert again["agent_id"] == "42" and again["interval_sec"] == 30
+    assert again["long_poll_sec"] == config.DEFAULTS["long_poll_sec"]
+
+def test_keys_set_in_the_file_are_kept(conf_file):
+    conf_file.write_text(f"heartbeat_sec = {config.DEFAULTS['heartbeat_sec']}\n")
+    cfg = config.load_conf()
+    cfg["agent_id"] = "7"
+    config.save_conf(cfg)
+    assert "heartbeat_sec = " in conf_file.read_text()
@@ -0,0 +1,54 @@
+from __future__ import annotations
+import asyncio, threading, time
+
+from lpp_agent.core import AgentCore
+
+class FakeAgent:
+    """Scans are slow; a change arrives while the first one runs."""
+    def __init__(self):
+        self.spans: list[tuple[str, float, float]] = []
+        self.fetches = 0
+        self._lock = threading.Lock()
+
+    def _record(self, name: str, secs: float) -> None:
+        t = time.monotonic()
+        time.sleep(secs)
+        with self._lock:
+            self.spans.append((name, t, time.monotonic()))
+
+    def fetch(self):
+        self.fetches += 1
+        if self.fetches == 1:
+            time.sleep(0.1)
+            return "change", 0.05
+        return None, 0.05
+
+    def apply(self, change):
+        self._record("apply", 0.1)
+
+    def scan(self):
+        self._record("scan", 0.3)
+
+    def heartbeat(self):
+        pass
+
+    def send(self):
+        pass
+
+def test_scan_and_apply_never_overlap():
+    agent = FakeAgent()
+
+    async def main():
+        core = AgentCore(agent, heartbeat_sec=10, send_sec=10, scan_sec=0.05)
+        task = asyncio.create_task(core._main())
+        await asyncio.sleep(1.0)
+        core.stop()
+        await task
+
+    asyncio.run(main())
+    applies = [s for s in agent.spans if s[0] == "apply"]
+    scans = [s for s in agent.spans if s[0] == "scan"]
+    assert applies and scans
+    for _, a0, a1 in applies:
+        for _, s0, s1 in scans:
+            assert a1 <= s0 or s1 <= a0
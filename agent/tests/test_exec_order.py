@@ -0,0 +1,78 @@
+from __future__ import annotations
+import threading, time
+
+import pytest
+
+from lpp_agent import exec as lpp_exec
+from lpp_agent.facts import facts
+
+@pytest.fixture
+def trace(monkeypatch):
+    """Stub rule execution: every step records (kind, start, end) and reports "fixed"."""
+    events: list[tuple[str, float, float]] = []
+    lock = threading.Lock()
+
+    def step(name: str, secs: float = 0.05):
+        t = time.monotonic()
+        time.sleep(secs)
+        with lock:
+            events.append((name, t, time.monotonic()))
+
+    def apply_rule(r, allow_bash, plugins=None, live=None):
+        step(str(r["id"]), 0.15 if r["type"] == "bash" else 0.05)
+        return {"id": r["id"], "type": r["type"], "status": "fixed"}
+
+    def plan_pkgs(rules, live=None, skip=frozenset(), only=None):
+        mine = sorted(i for i in only if i not in skip)
+        step("pkg:" + ",".join(str(rules[i]["id"]) for i in mine))
+        return {i: {"status": "fixed"} for i in mine}
+
+    monkeypatch.setattr(lpp_exec, "_apply_rule", apply_rule)
+    monkeypatch.setattr(lpp_exec, "_plan_pkgs", plan_pkgs)
+    facts.pin("init", "none")
+    return events
+
+def _run(rules, policy_of, workers=4):
+    return lpp_exec._apply_rules(rules, max_workers=workers, policy_of=policy_of)
+
+def _span(events, name):
+    return next((s, e) for n, s, e in events if n == name)
+
+def test_package_after_bash_waits_for_it(trace):
+    rules = [{"id": "repo", "type": "bash", "code": "true"},
+             {"id": "nginx", "type": "pkg.ensure", "name": "nginx"}]
+    res = _run(rules, [0, 0])
+    assert [r["status"] for r in res] == ["fixed", "fixed"]
+    assert _span(trace, "pkg:nginx")[0] >= _span(trace, "repo")[1]
+
+def test_pkg_bash_pkg_is_two_transactions_in_order(trace):
+    rules = [{"id": "curl", "type": "pkg.ensure", "name": "curl"},
+             {"id": "repo", "type": "bash", "code": "true"},
+             {"id": "nginx", "type": "pkg.ensure", "name": "nginx"},
+             {"id": "other", "type": "pkg.ensure", "name": "jq"}]
+    res = _run(rules, [0, 0, 0, 1])
+    assert [r["status"] for r in res] == ["fixed"] * 4
+    first, second = _span(trace, "pkg:curl,other"), _span(trace, "pkg:nginx")
+    bash = _span(trace, "repo")
+    assert first[1] <= bash[0] and bash[1] <= second[0]
+
+def test_bash_of_other_policy_never_overlaps_a_transaction(trace):
+    rules = [{"id": "nginx", "type": "pkg.ensure", "name": "nginx"},
+             {"id": "apt-script", "type": "bash", "code": "apt-get install -y jq"}]
+    _run(rules, [0, 1])
+    (ps, pe), (bs, be) = _span(trace, "pkg:nginx"), _span(trace, "apt-script")
+    assert pe <= bs or be <= ps
+
+def test_bash_with_own_locks_runs_beside_a_transaction(trace):
+    rules = [{"id": "nginx", "type": "pkg.ensure", "name": "nginx"},
+             {"id": "report", "type": "bash", "code": "true", "locks": ["report"]}]
+    _run(rules, [0, 1])
+    (ps, pe), (bs, be) = _span(trace, "pkg:nginx"), _span(trace, "report")
+    assert bs < pe and ps < be
+
+def test_service_before_a_later_phase_is_not_a_cycle(trace):
+    rules = [{"id": "svc", "type": "service.manage", "service": "foo", "state": "started"},
+             {"id": "repo", "type": "bash", "code": "true"},
+             {"id": "nginx", "type": "pkg.ensure", "name": "nginx"}]
+    res = _run(rules, [0, 0, 0])
+    assert [r["status"] for r in res] == ["fixed"] * 3
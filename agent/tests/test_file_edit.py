@@ -0,0 +1,46 @@
+from __future__ import annotations
+import os
+
+from lpp_agent.plugins import file_edit
+from lpp_agent.plugins.file_edit import Transaction
+
+def test_unchanged_file_is_not_rewritten(tmp_path):
+    for raw in (b"a 1\r\nb 2\r\n", b"a 1\nb 2", b"a 1\x0cx\nb 2\n", b"a \xe9\nb 2\n"):
+        p = tmp_path/"f.conf"
+        p.write_bytes(raw)
+        before = p.stat().st_mtime_ns
+        t = Transaction()
+        assert t.replace_kv(str(p), "b", "2") == "pass"
+        assert t.commit() == {}
+        assert p.read_bytes() == raw
+        assert p.stat().st_mtime_ns == before
+
+def test_edits_keep_line_endings_and_final_newline(tmp_path):
+    crlf, bare = tmp_path/"crlf", tmp_path/"bare"
+    crlf.write_bytes(b"a 1\r\nb 2\r\n")
+    bare.write_bytes(b"a 1\nb 2")
+    assert file_edit.kv_set(str(crlf), {"b": 3, "c": 4}) == "fixed"
+    assert file_edit.ensure_lines(str(bare), ["c 3"]) == "fixed"
+    assert crlf.read_bytes() == b"a 1\r\nb 3\r\nc 4\r\n"
+    assert bare.read_bytes() == b"a 1\nb 2\nc 3"
+
+def test_rule_after_commit_sees_external_changes(tmp_path):
+    p = tmp_path/"f.conf"
+    p.write_text("k 1\n")
+    t = Transaction()
+    t.replace_kv(str(p), "k", "2")
+    t.commit()
+    p.write_text("k 2\nfrom_bash 1\n")  # e.g. a bash rule between two file rules
+    t.replace_kv(str(p), "z", "9")
+    t.commit()
+    assert p.read_text() == "k 2\nfrom_bash 1\nz 9\n"
+
+def test_symlink_target_is_edited(tmp_path):
+    target, link = tmp_path/"target.conf", tmp_path/"link.conf"
+    target.write_text("a 1\n")
+    target.chmod(0o600)
+    link.symlink_to(target)
+    assert file_edit.kv_set(str(link), {"a": 2}) == "fixed"
+    assert link.is_symlink()
+    assert target.read_text() == "a 2\n"
+    assert oct(os.stat(target).st_mode & 0o777) == oct(0o600)
@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+from lpp_agent import fingerprint
+from lpp_agent.fingerprint import FingerprintStore
+
+def test_unchanged_file_rule_hits(tmp_path):
+    f = tmp_path/"motd"
+    f.write_text("hello\n")
+    store = FingerprintStore(tmp_path/"fp.json")
+    rule = {"id": "r1", "type": "file.ensure_lines", "file": str(f), "present": ["hello"]}
+    assert store.lookup(rule) == "miss"
+    store.record(rule)
+    assert store.lookup(rule) == "hit"
+    assert store.lookup({**rule, "id": "renamed", "after": ["x"]}) == "hit"  # ids and ordering don't count
+    f.write_text("changed\n")
+    assert store.lookup(rule) == "miss"
+
+def test_actions_are_never_fingerprinted(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprint, "INVOCATIONS", str(tmp_path))
+    store = FingerprintStore(tmp_path/"fp.json")
+    for state in sorted(fingerprint.ACTIONS):
+        rule = {"id": "r", "type": "service.manage", "service": "nginx", "state": state}
+        assert fingerprint.inputs(rule) is None
+        store.record(rule)
+        assert store.lookup(rule) is None  # runs on every apply
+    started = {"id": "r", "type": "service.manage", "service": "nginx", "state": "started"}
+    assert fingerprint.inputs(started) is not None
+
+def test_entries_expire_and_persist(tmp_path):
+    f = tmp_path/"motd"
+    f.write_text("x")
+    rule = {"id": "r", "type": "file.ensure_lines", "file": str(f), "present": ["x"]}
+    store = FingerprintStore(tmp_path/"fp.json")
+    store.record(rule)
+    store.save()
+    assert FingerprintStore(tmp_path/"fp.json").lookup(rule) == "hit"
+    assert FingerprintStore(tmp_path/"fp.json", ttl=0).lookup(rule) == "miss"
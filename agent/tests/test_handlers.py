@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import pytest
+
+from lpp_agent import handlers
+from lpp_agent.handlers import HandlerQueue
+
+@pytest.fixture
+def calls(monkeypatch):
+    out: list[list[str]] = []
+    monkeypatch.setattr(handlers.subprocess, "call", lambda argv: out.append(argv) or 0)
+    return out
+
+def test_parse():
+    assert handlers.parse("systemctl restart nginx sshd.service") == [
+        ("restart", "nginx.service"), ("restart", "sshd.service")]
+    assert handlers.parse("service nginx reload") == [("reload", "nginx.service")]
+    assert handlers.parse("systemctl daemon-reload") is None
+
+def test_restart_covers_reload_and_units_run_once(calls):
+    q = HandlerQueue()
+    q.reload("nginx")
+    q.notify("systemctl restart nginx")
+    q.reload("nginx.service")
+    q.notify("service sshd restart")
+    q.restart("sshd")
+    q.reload("cron")
+    assert q.flush() == {"restart nginx.service": 0, "restart sshd.service": 0, "reload cron.service": 0}
+    assert calls == [["systemctl", "restart", "nginx.service", "sshd.service"],
+                     ["systemctl", "reload", "cron.service"]]
+
+def test_other_commands_deduplicated_verbatim(calls):
+    q = HandlerQueue()
+    for _ in range(3):
+        q.notify("systemctl daemon-reload")
+    assert q.flush() == {"systemctl daemon-reload": 0}
+    assert calls == [["systemctl", "daemon-reload"]]
+    assert q.flush() == {} and len(calls) == 1  # flushed once
+
+def test_failed_batch_retries_only_inactive_units(calls, monkeypatch):
+    rcs = iter([1, 0])
+    monkeypatch.setattr(handlers.subprocess, "call", lambda argv: calls.append(argv) or next(rcs))
+    monkeypatch.setattr(handlers, "_active", lambda units: [u == "a.service" for u in units])
+    q = HandlerQueue()
+    q.restart("a")
+    q.restart("b")
+    assert q.flush() == {"restart a.service": 0, "restart b.service": 0}
+    assert calls == [["systemctl", "restart", "a.service", "b.service"], ["systemctl", "restart", "b.service"]]
+
+def test_missing_systemctl_fails_every_unit(monkeypatch):
+    def missing(argv):
+        raise FileNotFoundError(argv[0])
+    monkeypatch.setattr(handlers.subprocess, "call", missing)
+    q = HandlerQueue()
+    q.restart("a")
+    q.restart("b")
+    assert q.flush() == {"restart a.service": 127, "restart b.service": 127}
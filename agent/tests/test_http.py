@@ -0,0 +1,71 @@
+from __future__ import annotations
+import threading, time
+
+import pytest
+
+from lpp_agent import context
+from lpp_agent.http import Api
+from lpp_agent.main import PolicyAgent
+from lpp_agent.standin import StandIn
+
+POLICIES = [{"id": "p1", "rules": [{"id": "r1", "type": "bash", "run": "true"}]}]
+
+def bump_after(srv: StandIn, delay: float) -> threading.Timer:
+    t = threading.Timer(delay, srv.bump)
+    t.start()
+    return t
+
+@pytest.fixture
+def standin():
+    with StandIn(POLICIES, long_poll=True, max_wait=10) as srv:
+        yield srv
+
+def test_long_poll_waits_then_answers_304(standin):
+    api = Api(standin.url, retries=0)
+    changed, policies, etag, rev = api.watch_policy("1", None, wait=1)
+    assert changed and policies == POLICIES and rev == 1
+    t0 = time.monotonic()
+    changed, _, etag2, _ = api.watch_policy("1", etag, wait=1)
+    assert not changed and etag2 == etag
+    assert time.monotonic() - t0 >= 0.9  # the server held it
+    assert api.long_poll is True
+
+def test_long_poll_returns_as_soon_as_the_rev_changes(standin):
+    api = Api(standin.url, retries=0)
+    _, _, etag, _ = api.watch_policy("1", None, wait=1)
+    bump_after(standin, 0.3)
+    t0 = time.monotonic()
+    changed, _, _, rev = api.watch_policy("1", etag, wait=8)
+    assert changed and rev == 2
+    assert time.monotonic() - t0 < 5
+
+def test_poll_only_server_falls_back_to_plain_gets():
+    with StandIn(POLICIES, long_poll=False) as srv:
+        api = Api(srv.url, retries=0)
+        _, _, etag, _ = api.watch_policy("1", None, wait=5)
+        t0 = time.monotonic()
+        assert api.watch_policy("1", etag, wait=5)[0] is False
+        assert time.monotonic() - t0 < 2 and api.long_poll is False
+
+@pytest.fixture
+def agent(standin, monkeypatch):
+    monkeypatch.setattr(context, "_ctx", None)
+    a = PolicyAgent({"agent_id": "1", "api": standin.url, "long_poll_sec": 1,
+                     "full_reconcile_sec": 0, "http_retries": 0})
+    yield a
+    a.close()
+    context._ctx = None
+
+def test_agent_fetch_long_polls(agent, standin):
+    change, _ = agent.fetch()
+    policies, rev, etag, mode = change
+    assert policies == POLICIES and rev == 1 and etag
+    change, delay = agent.fetch()
+    assert change is None
+    assert delay <= 1  # the server already waited; poll again right away
+    agent.cfg["long_poll_sec"] = 8
+    bump_after(standin, 0.3)
+    t0 = time.monotonic()
+    change, _ = agent.fetch()
+    assert change is not None and change[1] == 2
+    assert time.monotonic() - t0 < 5
@@ -0,0 +1,69 @@
+from __future__ import annotations
+import gzip, json, time
+
+import pytest
+
+from lpp_agent.outbox import DEAD, Outbox
+
+class Rejected(Exception):
+    """Stands in for requests.HTTPError: carries a response with a status."""
+    def __init__(self, status: int, headers: dict[str, str] | None = None):
+        super().__init__(f"HTTP {status}")
+        self.response = type("R", (), {"status_code": status, "headers": headers or {}})()
+
+class Server:
+    def __init__(self, fail: dict[int, int] | None = None):
+        self.fail = dict(fail or {})  # call number -> status to fail it with
+        self.calls: list[tuple[str, list[dict]]] = []
+        self.accepted: list[str] = []
+
+    def __call__(self, body: bytes, key: str) -> None:
+        self.calls.append((key, json.loads(gzip.decompress(body))["results"]))
+        status = self.fail.pop(len(self.calls), None)
+        if status:
+            raise Rejected(status)
+        self.accepted.append(key)
+
+@pytest.fixture
+def box(tmp_path):
+    return Outbox(tmp_path, batch_age=0)
+
+def spool(box: Outbox, *n: int) -> None:
+    for i in n:
+        box.append({"agent_id": "a", "rule": i})
+        box._seal()
+
+def test_batches_sent_oldest_first_and_deleted(box):
+    spool(box, 1, 2)
+    srv = Server()
+    assert box.drain(srv) == 2
+    assert [r[0]["rule"] for _, r in srv.calls] == [1, 2]
+    assert box.depth() == 0
+
+def test_retry_reuses_idempotency_key_after_backoff(box):
+    spool(box, 1)
+    srv = Server(fail={1: 503})
+    assert box.drain(srv) == 0
+    assert box.failures == 1 and box.next_try > time.monotonic()
+    assert box.drain(srv) == 0 and len(srv.calls) == 1  # still backing off
+    box.next_try = 0
+    assert box.drain(srv) == 1
+    assert srv.calls[0][0] == srv.calls[1][0]
+    assert box.failures == 0 and box.backoff.delay == 0
+
+def test_backoff_honours_retry_after(box):
+    spool(box, 1)
+    def send(body, key):
+        raise Rejected(429, {"Retry-After": "120"})
+    box.drain(send)
+    assert box.next_try - time.monotonic() > 100
+
+def test_rejected_batch_is_dead_lettered_and_drain_goes_on(box, tmp_path):
+    spool(box, 1, 2, 3)
+    srv = Server(fail={2: 400})
+    assert box.drain(srv) == 2
+    assert [r[0]["rule"] for _, r in srv.calls] == [1, 2, 3]
+    dead = list((tmp_path/DEAD).iterdir())
+    assert [d.stem for d in dead] == [srv.calls[1][0]]
+    assert box.failures == 0 and box.next_try == 0
+    assert box.depth() == 0
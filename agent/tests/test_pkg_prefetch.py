@@ -0,0 +1,66 @@
+from __future__ import annotations
+import shutil, subprocess
+
+import pytest
+
+from lpp_agent.facts import facts
+from lpp_agent.plugins import pkg
+
+NAME = "lpp-prefetch-test"
+
+pytestmark = pytest.mark.skipif(
+    not all(shutil.which(t) for t in ("apt-get", "dpkg-deb", "dpkg-scanpackages")),
+    reason="needs apt-get, dpkg-deb and dpkg-scanpackages")
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A copy: apt repository with one package, and a scratch apt state and cache."""
+    src = tmp_path/"build"/NAME
+    (src/"DEBIAN").mkdir(parents=True)
+    (src/"DEBIAN/control").write_text(
+        f"Package: {NAME}\nVersion: 1.0\nArchitecture: all\nMaintainer: lpp <lpp@example.com>\n"
+        "Description: prefetch test package\n")
+    debs = tmp_path/"repo"
+    debs.mkdir()
+    subprocess.run(["dpkg-deb", "--build", str(src), str(debs/f"{NAME}_1.0_all.deb")], check=True, capture_output=True)
+    (debs/"Packages").write_bytes(
+        subprocess.run(["dpkg-scanpackages", "."], cwd=debs, check=True, capture_output=True).stdout)
+    for d in ("state/lists/partial", "cache/archives/partial", "etc/parts"):
+        (tmp_path/d).mkdir(parents=True)
+    (tmp_path/"sources.list").write_text(f"deb [trusted=yes] copy:{debs} ./\n")
+    conf = tmp_path/"apt.conf"
+    conf.write_text("\n".join([
+        f'Dir::State "{tmp_path}/state";',
+        'Dir::State::status "/var/lib/dpkg/status";',
+        f'Dir::Cache "{tmp_path}/cache";',
+        f'Dir::Etc::sourcelist "{tmp_path}/sources.list";',
+        f'Dir::Etc::sourceparts "{tmp_path}/etc/parts";',
+        f'Dir::Etc::preferencesparts "{tmp_path}/etc/parts";',
+        'Debug::NoLocking "true";',
+    ]) + "\n")
+    monkeypatch.setenv("APT_CONFIG", str(conf))
+    monkeypatch.setattr(pkg, "prefetcher", pkg.Prefetcher())
+    monkeypatch.setattr(pkg.budget, "hold", lambda: "outside maintenance window 02:00-04:00")
+    facts.pin("pkg_manager", "apt-get")
+    yield tmp_path/"cache/archives"
+    facts.invalidate("pkg_manager")
+
+def test_deferred_install_is_prefetched_in_the_background(repo):
+    statuses, out = pkg.ensure_many([(NAME, "present")], prefetch=True)
+    assert statuses == ["deferred"]
+    assert out["prefetching"] == [NAME]
+    assert pkg.prefetcher.wait(120)
+    assert (repo/f"{NAME}_1.0_all.deb").exists()
+    assert pkg.prefetcher.ready([NAME]) == [NAME] and pkg.prefetcher.pending() == []
+    assert pkg.prefetcher.last["fetched"] == 1 and pkg.prefetcher.last["rc"] == 0
+    # fetched already: nothing queued again
+    assert pkg.ensure_many([(NAME, "present")], prefetch=True)[1]["prefetching"] == []
+
+def test_failed_prefetch_stays_queued(repo):
+    missing = "lpp-no-such-package"
+    assert pkg.ensure_many([(missing, "present")], prefetch=True)[1]["prefetching"] == [missing]
+    assert pkg.prefetcher.wait(120)
+    assert pkg.prefetcher.last["rc"] != 0
+    assert pkg.prefetcher.pending() == [missing]
+    pkg.prefetcher.forget([missing])
+    assert pkg.prefetcher.pending() == []
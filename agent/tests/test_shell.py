@@ -0,0 +1,47 @@
+from __future__ import annotations
+import os, signal, subprocess, time
+
+import pytest
+
+from lpp_agent import shell
+
+@pytest.fixture
+def pool(monkeypatch):
+    p = shell.Pool(size=1)
+    monkeypatch.setattr(shell, "pool", p)
+    yield p
+    p.close()
+
+def alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rpartition(")")[2].split()[0] != "Z"
+    except OSError:
+        return False
+
+def test_loop_variables_are_not_visible(pool):
+    cp = shell.run('echo "[${__lpp_done-}][${__lpp_job-}][${__lpp_rc-}]"; exit 3')
+    assert cp.usage["executor"] == "worker"
+    assert (cp.returncode, cp.stdout) == (3, "[][][]\n")
+    assert shell.run("echo -n x").stdout == "x"  # the worker still works
+
+def test_background_child_neither_stalls_nor_dies_with_the_worker(pool):
+    t0 = time.monotonic()
+    cp = shell.run("sleep 30 & echo $!")
+    assert time.monotonic() - t0 < 10
+    pid = int(cp.stdout)
+    try:
+        assert os.getpgid(pid) != os.getpgid(pool._idle[0].proc.pid)
+        pool.retire()
+        assert alive(pid)
+    finally:
+        os.kill(pid, signal.SIGKILL)
+
+def test_timeout_kills_the_job(pool, tmp_path):
+    with pytest.raises(subprocess.TimeoutExpired):
+        shell.run(f"echo $BASHPID > {tmp_path}/pid; exec sleep 30", timeout=1)
+    pid = int((tmp_path/"pid").read_text())
+    deadline = time.monotonic() + 5
+    while alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not alive(pid)
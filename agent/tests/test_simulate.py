@@ -0,0 +1,18 @@
+from __future__ import annotations
+import json
+from pathlib import Path
+
+from lpp_agent import plan
+from lpp_agent.simulate import Simulation
+from lpp_agent.standin import StandIn
+
+def test_simulated_agents_leave_the_plan_cache_alone():
+    pols = [{"id": "p", "yaml": json.dumps({"rules": [{"id": "r", "type": "pkg.ensure", "name": "x"}]})}]
+    before = set(plan.PLAN_DIR.glob("*.json"))
+    with StandIn(pols, long_poll=False) as srv:
+        sim = Simulation(srv.url, agents=2, interval=1, heartbeat_sec=60, long_poll_sec=0, report_sec=1)
+        scratch = Path(sim.plans.path)
+        totals = sim.run(1.5)
+    assert srv.stats.snapshot()["ingest_results"] >= 2, totals
+    assert set(plan.PLAN_DIR.glob("*.json")) == before
+    assert not scratch.exists()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import pytest
+
+from lpp_agent.plugins import sysctl
+
+@pytest.fixture
+def proc(tmp_path, monkeypatch):
+    root = tmp_path/"proc"
+    (root/"net/ipv4").mkdir(parents=True)
+    (root/"net/ipv4/ip_forward").write_text("0\n")
+    monkeypatch.setattr(sysctl, "PROC", root)
+    monkeypatch.setattr(sysctl, "DROPIN", tmp_path/"99-lpp.conf")
+    calls = []
+    monkeypatch.setattr(sysctl.subprocess, "call", lambda argv: calls.append(argv) or 0)
+    return root, calls
+
+def test_live_write_and_persist(proc):
+    root, calls = proc
+    s = sysctl.Sysctl()
+    assert s.set("net.ipv4.ip_forward", 1) == "fixed"
+    assert s.flush() is None
+    assert (root/"net/ipv4/ip_forward").read_text() == "1\n"
+    assert "net.ipv4.ip_forward = 1" in sysctl.DROPIN.read_text()
+    assert calls == []
+    assert s.check("net.ipv4.ip_forward", 1) == "pass"
+
+def test_missing_key_fails_without_persisting(proc):
+    _, calls = proc
+    s = sysctl.Sysctl()
+    assert s.set("net.ipv4.no_such_key", 1) == "error"
+    assert s.flush() is None
+    assert not sysctl.DROPIN.exists()
+    assert calls == []  # no sysctl -p that would fail on every later flush
+
+def write_fails(monkeypatch, err: OSError):
+    real = sysctl._path
+    class Stuck(type(real("x"))):
+        def write_text(self, *a, **kw):
+            raise err
+    monkeypatch.setattr(sysctl, "_path", lambda param: Stuck(real(param)))
+
+def test_rejected_value_fails_without_persisting(proc, monkeypatch):
+    _, calls = proc
+    write_fails(monkeypatch, OSError(22, "Invalid argument"))
+    s = sysctl.Sysctl()
+    assert s.set("net.ipv4.ip_forward", "x") == "error"
+    assert s.flush() is None
+    assert not sysctl.DROPIN.exists() and calls == []
+
+def test_transient_error_defers_to_reload(proc, monkeypatch):
+    _, calls = proc
+    write_fails(monkeypatch, OSError(16, "Device or resource busy"))
+    s = sysctl.Sysctl()
+    assert s.set("net.ipv4.ip_forward", 1) == "fixed"
+    assert s.flush() is None
+    assert "net.ipv4.ip_forward = 1" in sysctl.DROPIN.read_text()
+    assert calls == [["sysctl", "-p", str(sysctl.DROPIN)]]
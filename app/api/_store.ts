@@ -21,6 +21,7 @@ export type Device = {
   lastSeen: string;
   policyIds: string[];
   policyRev?: number; // server-side “last applied” rev (optional)
+  facts?: Record<string, unknown>; // host facts reported by the agent heartbeat
 };
 
 export type Policy = { id: string; name: string; description?: string; version?: number };
@@ -17,10 +17,28 @@ export async function GET(req: Request, ctx: { params: Promise<{ id: string }> }
     });
   }
 
-  const rev = dev.policyRev ?? (dev.customerId ? (db.customers.find(c => c.id === dev.customerId)?.policyRev ?? 0) : 0);
-  const etag = `W/"rev-${rev}"`;
+  const currentRev = () =>
+    dev.policyRev ?? (dev.customerId ? (db.customers.find(c => c.id === dev.customerId)?.policyRev ?? 0) : 0);
+  let rev = currentRev();
+  let etag = `W/"rev-${rev}"`;
   const inm = req.headers.get("if-none-match");
-  if (inm && inm === etag) return new NextResponse(null, { status: 304, headers: { ETag: etag } });
+  if (inm && inm === etag) {
+    // long-poll: hold the request until the rev changes or the requested wait elapses
+    const wait = requestedWait(req);
+    if (!wait) return new NextResponse(null, { status: 304, headers: { ETag: etag } });
+    const deadline = Date.now() + wait * 1000;
+    while (Date.now() < deadline && !req.signal.aborted) {
+      await new Promise(r => setTimeout(r, LONG_POLL_TICK_MS));
+      if (currentRev() !== rev) break;
+    }
+    rev = currentRev();
+    etag = `W/"rev-${rev}"`;
+    if (inm === etag) {
+      return new NextResponse(null, {
+        status: 304, headers: { ETag: etag, "Preference-Applied": `wait=${wait}` },
+      });
+    }
+  }
 
   const pols = dev.policyIds
     .map(pid => db.policies.find(p => p.id === pid))
@@ -40,6 +58,16 @@ export async function GET(req: Request, ctx: { params: Promise<{ id: string }> }
   });
 }
 
+const LONG_POLL_TICK_MS = 500;
+const LONG_POLL_MAX_SEC = 120;
+
+function requestedWait(req: Request): number {
+  const m = /\bwait=(\d+)/.exec(req.headers.get("prefer") ?? "");
+  const raw = m ? m[1] : new URL(req.url).searchParams.get("wait");
+  const n = Number(raw ?? 0);
+  return Number.isFinite(n) && n > 0 ? Math.min(n, LONG_POLL_MAX_SEC) : 0;
+}
+
 function toYamlFromPolicy(p: any): string {
   const rules: string[] = [];
 
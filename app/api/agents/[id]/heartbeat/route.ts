@@ -2,9 +2,18 @@ export const runtime = "nodejs";
 import { NextResponse } from "next/server";
 import { db, save } from "../../../_store";
 
-export async function POST(_req: Request, ctx: { params: Promise<{ id: string }> }) {
+export async function POST(req: Request, ctx: { params: Promise<{ id: string }> }) {
   const { id } = await ctx.params;
+  const body = await req.json().catch(() => ({}));
   const dev = db.devices.find(d => String(d.id) === String(id));
-  if (dev) { dev.lastSeen = new Date().toISOString(); save(); }
+  if (dev) {
+    dev.lastSeen = new Date().toISOString();
+    // agents report host facts (pkg manager, distro, init, kernel) with each heartbeat
+    if (body?.facts && typeof body.facts === "object") {
+      dev.facts = body.facts;
+      if (body.facts.distro) dev.distro = body.facts.distro;
+    }
+    save();
+  }
   return NextResponse.json({ ok: true });
 }
@@ -0,0 +1,22 @@
+export const runtime = "nodejs";
+import { NextResponse } from "next/server";
+
+// live output of long-running agent steps; kept in memory only, newest last
+type Chunk = { rule_id: string; stream: string; text: string; ts: number };
+const MAX_CHUNKS = 200;
+const tails: Record<string, Chunk[]> = {};
+
+export async function POST(req: Request, ctx: { params: Promise<{ id: string }> }) {
+  const { id } = await ctx.params;
+  const body = await req.json().catch(() => null);
+  if (!body || typeof body.text !== "string") return NextResponse.json({ ok: false }, { status: 400 });
+  const list = (tails[id] ??= []);
+  list.push({ rule_id: String(body.rule_id ?? ""), stream: String(body.stream ?? "stdout"), text: body.text, ts: Number(body.ts ?? Date.now() / 1000) });
+  if (list.length > MAX_CHUNKS) list.splice(0, list.length - MAX_CHUNKS);
+  return NextResponse.json({ ok: true });
+}
+
+export async function GET(_req: Request, ctx: { params: Promise<{ id: string }> }) {
+  const { id } = await ctx.params;
+  return NextResponse.json({ agent_id: id, chunks: tails[id] ?? [] });
+}
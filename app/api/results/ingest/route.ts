@@ -1,9 +1,28 @@
 export const runtime = "nodejs";
 import { NextResponse } from "next/server";
+import { gunzipSync } from "zlib";
 import { db, save } from "../../_store";
 
+// agents retry outbox batches with the same Idempotency-Key; remember recent ones
+const SEEN_MAX = 10_000;
+const seen = new Set<string>();
+
+async function readBody(req: Request): Promise<any> {
+  const raw = Buffer.from(await req.arrayBuffer());
+  const text = req.headers.get("content-encoding") === "gzip" ? gunzipSync(raw).toString("utf8") : raw.toString("utf8");
+  return JSON.parse(text);
+}
+
 export async function POST(req: Request) {
-  const body = await req.json().catch(() => ({}));
+  const key = req.headers.get("idempotency-key");
+  if (key && seen.has(key)) return NextResponse.json({ ok: true, duplicate: true });
+  let body: any;
+  try {
+    body = await readBody(req);
+  } catch (e) {
+    // a body that doesn't parse never will; 400 tells the agent to stop retrying it
+    return NextResponse.json({ ok: false, error: `bad batch: ${(e as Error).message}` }, { status: 400 });
+  }
   const agentId = String(body?.agent_id ?? "");
   const deviceId =
     agentId.startsWith("dev_")
@@ -15,5 +34,10 @@ export async function POST(req: Request) {
     dev.lastSeen = new Date().toISOString();
     save();
   }
+  // only a batch we parsed and stored counts as seen; a failed one may be retried
+  if (key) {
+    seen.add(key);
+    if (seen.size > SEEN_MAX) seen.delete(seen.values().next().value as string);
+  }
   return NextResponse.json({ ok: true });
 }